@@ -1,11 +1,20 @@
 # -*- coding: utf-8 -*-
 
+import startup_profile
+startup_profile.enable() # STARTUP_PROFILE=1 時記錄各套件的匯入時間（需在其他匯入之前）
+
 import os
+import re
 import json
+import random
 import logging
 from dotenv import load_dotenv # 建議使用 python-dotenv 管理環境變數
 import time
+import hmac
 import traceback
+import atexit
+import threading
+from collections import OrderedDict
 from datetime import datetime
 import requests
 
@@ -18,10 +27,6 @@ from linebot.v3.exceptions import (
     InvalidSignatureError
 )
 from linebot.v3.messaging import (
-    Configuration,
-    ApiClient,
-    MessagingApi,
-    ReplyMessageRequest,
     PushMessageRequest,
     TextMessage,
     FlexMessage,
@@ -38,9 +43,22 @@ from linebot.v3.webhooks import (
     PostbackEvent # 處理 Postback 事件
 )
 
-# --- 新增 APScheduler --- 
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.cron import CronTrigger
+from event_dispatcher import ShardedEventQueue, ShardedExecutor, dispatch_event
+from event_dedup import SeenEventIndex
+from keyword_router import KeywordRouter
+from message_cache import MessageCache
+from reply_sender import send_reply, reply_stats
+from line_client import messaging_api, get_messaging_blob_api, connection_stats, rate_limit_stats
+from rich_menu import provision_rich_menu
+from health import HealthCheckMiddleware
+from follower_store import FollowerStore
+from session_store import SessionStore
+import broadcast_jobs
+from db import data_path
+import calendar_client
+from availability import AvailabilityIndex
+import scheduler as calendar_reports
+from job_scheduler import LeaderScheduler
 # ----------------------
 
 #測試自
@@ -73,8 +91,7 @@ google_credentials_json_path = os.getenv('GOOGLE_CREDENTIALS_JSON', None) # 通
 # --- 基本設定 ---
 app = Flask(__name__)
 
-# Line Bot API 設定
-configuration = Configuration(access_token=channel_access_token)
+# Line Bot API 設定：所有呼叫共用 line_client 中的連線池（同樣讀取 LINE_CHANNEL_ACCESS_TOKEN）
 # 檢查 channel_secret 是否成功載入，若無則無法啟動 handler
 if not channel_secret:
     logging.error("LINE_CHANNEL_SECRET not found in environment variables.")
@@ -84,6 +101,39 @@ if not channel_secret:
 else:
     handler = WebhookHandler(channel_secret)
 
+# Webhook 處理模式：async = 驗證簽章後放入背景佇列並立即回 200；sync = 在請求中直接處理
+webhook_mode = os.getenv('WEBHOOK_MODE', 'async').lower()
+webhook_workers = int(os.getenv('WEBHOOK_WORKERS', '4'))
+webhook_queue_size = int(os.getenv('WEBHOOK_QUEUE_SIZE', '200')) # 每個分片的佇列上限
+# /callback/stats 需在 X-Stats-Token 標頭帶入此值；未設定時不開放
+stats_token = os.getenv('STATS_TOKEN', '')
+
+# Webhook 事件去重（LINE 重送時 webhookEventId 不變）
+seen_events = SeenEventIndex(
+    ttl=int(os.getenv('EVENT_DEDUP_TTL', '86400')),
+    max_entries=int(os.getenv('EVENT_DEDUP_MAX_ENTRIES', '20000')),
+    db_path=data_path('seen_events.db') if os.getenv('EVENT_DEDUP_SHARED', 'true').lower() == 'true' else None
+)
+
+def process_event(event, destination=None):
+    """去重後交給 handler 上註冊的處理函式"""
+    is_redelivery = bool(getattr(getattr(event, 'delivery_context', None), 'is_redelivery', False))
+    if not seen_events.check_and_add(getattr(event, 'webhook_event_id', None), is_redelivery):
+        logging.info(f"略過重複的 webhook 事件: {event.webhook_event_id}")
+        return
+    dispatch_event(handler, event, destination)
+
+event_queue = ShardedEventQueue(
+    process_event,
+    workers=webhook_workers,
+    max_queue_size=webhook_queue_size
+)
+atexit.register(event_queue.shutdown)
+
+# 同步模式：同一個 body 內的事件依 user_id 分組平行處理
+sync_executor = ShardedExecutor(process_event, max_workers=webhook_workers)
+atexit.register(sync_executor.shutdown)
+
 # --- 服務與資訊內容 (方便管理) ---
 
 # 主要服務項目
@@ -148,7 +198,33 @@ def create_return_to_menu_button():
 
 # --- Flex Message 產生函式 ---
 
+# --- 靜態訊息快取 ---
+# 選單內容只隨下列設定常數改變，常數變動時快取自動失效重建
+def _menu_content_fingerprint():
+    return repr((main_services_list, ritual_prices_info, payment_details, other_services_keywords))
+
+menu_cache = MessageCache(_menu_content_fingerprint)
+
 def create_main_services_flex():
+    """產生主要服務項目的 Flex Message（快取）"""
+    return menu_cache.get('main_services', _build_main_services_flex)
+
+def create_ritual_prices_flex():
+    """產生法事項目與費用的 Flex Message（快取）"""
+    return menu_cache.get('ritual_prices', _build_ritual_prices_flex)
+
+def create_how_to_book_flex():
+    """產生如何預約的 Flex Message（快取）"""
+    return menu_cache.get('how_to_book', _build_how_to_book_flex)
+
+def create_text_with_menu_button(text_content, alt_text="訊息"):
+    """產生包含文字內容和返回主選單按鈕的 TemplateMessage（快取）"""
+    return menu_cache.get(
+        ('text_with_menu_button', text_content, alt_text),
+        lambda: _build_text_with_menu_button(text_content, alt_text)
+    )
+
+def _build_main_services_flex():
     """產生主要服務項目的 Flex Message (更新按鈕)"""
     bubble = FlexBubble(
         header=FlexBox(
@@ -214,7 +290,7 @@ def create_main_services_flex():
     )
     return FlexMessage(alt_text='主要服務項目', contents=bubble)
 
-def create_ritual_prices_flex():
+def _build_ritual_prices_flex():
     """產生法事項目與費用的 Flex Message (加入返回主選單按鈕)"""
     contents = [
         FlexText(text='法事項目與費用', weight='bold', size='xl', color='#5A3D1E', align='center', margin='md'),
@@ -280,7 +356,7 @@ def create_ritual_prices_flex():
     )
     return FlexMessage(alt_text='法事項目與費用', contents=bubble)
 
-def create_how_to_book_flex():
+def _build_how_to_book_flex():
     """產生如何預約的 Flex Message 選單（簡短版，含多功能按鈕，分段排版）"""
     bubble = FlexBubble(
         header=FlexBox(
@@ -362,7 +438,7 @@ def create_how_to_book_flex():
     return FlexMessage(alt_text='如何預約/資訊查詢', contents=bubble)
 
 # --- Template Message 產生函式 ---
-def create_text_with_menu_button(text_content, alt_text="訊息"):
+def _build_text_with_menu_button(text_content, alt_text="訊息"):
     """產生包含文字內容和返回主選單按鈕的 TemplateMessage"""
     buttons_template = ButtonsTemplate(
         text=text_content[:160], # ButtonsTemplate 的 text 限制為 160 字元
@@ -387,8 +463,7 @@ def notify_teacher(message_text):
         return
 
     try:
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
+        with messaging_api() as line_bot_api:
             line_bot_api.push_message(
                 PushMessageRequest(
                     to=teacher_user_id,
@@ -400,6 +475,38 @@ def notify_teacher(message_text):
         logging.error(f"Error sending notification to teacher: {e}")
 
 
+# --- Webhook 請求內容記錄 ---
+# WEBHOOK_BODY_LOG：off = 不記錄；sample = 依 WEBHOOK_BODY_LOG_RATE 抽樣記錄；error = 只在處理失敗時記錄
+WEBHOOK_BODY_LOG = os.getenv('WEBHOOK_BODY_LOG', 'error').lower()
+WEBHOOK_BODY_LOG_RATE = float(os.getenv('WEBHOOK_BODY_LOG_RATE', '0.01'))
+WEBHOOK_BODY_LOG_MAX = int(os.getenv('WEBHOOK_BODY_LOG_MAX', '2000')) # 記錄的最大字元數
+
+_REDACT_PATTERN = re.compile(r'"(userId|groupId|roomId|replyToken)"\s*:\s*"([^"]*)"')
+
+def _redact_match(match):
+    key, value = match.group(1), match.group(2)
+    if key == 'replyToken':
+        return f'"{key}":"***"'
+    # 保留末 4 碼方便對照，其餘遮蔽
+    return f'"{key}":"***{value[-4:]}"'
+
+def redact_webhook_body(body):
+    """遮蔽用戶 ID 與 reply token，並截斷過長的內容"""
+    redacted = _REDACT_PATTERN.sub(_redact_match, body)
+    if len(redacted) > WEBHOOK_BODY_LOG_MAX:
+        return f"{redacted[:WEBHOOK_BODY_LOG_MAX]}...(共 {len(redacted)} 字元)"
+    return redacted
+
+class RedactedBody:
+    """延遲格式化：只有在 log 真的輸出時才進行遮蔽與截斷"""
+    __slots__ = ('body',)
+
+    def __init__(self, body):
+        self.body = body
+
+    def __str__(self):
+        return redact_webhook_body(self.body)
+
 # --- Webhook 主要處理函式 ---
 @app.route("/callback", methods=['POST'])
 def callback():
@@ -413,118 +520,206 @@ def callback():
 
     # get request body as text
     body = request.get_data(as_text=True)
-    app.logger.info("Request body: " + body)
+    if WEBHOOK_BODY_LOG == 'sample' and random.random() < WEBHOOK_BODY_LOG_RATE:
+        app.logger.info("Request body: %s", RedactedBody(body))
 
     # handle webhook body
     try:
-        handler.handle(body, signature)
+        # 只驗證簽章與解析事件
+        payload = handler.parser.parse(body, signature, as_payload=True)
+        if webhook_mode == 'async':
+            # LINE API 呼叫交給背景工作執行緒
+            for event in payload.events:
+                event_queue.submit(event, payload.destination)
+        else:
+            sync_executor.run(payload.events, payload.destination)
     except InvalidSignatureError:
         print("Invalid signature. Please check your channel access token/secret.")
+        if WEBHOOK_BODY_LOG != 'off':
+            app.logger.warning("Request body (invalid signature): %s", RedactedBody(body))
         abort(400)
     except Exception as e:
         print(f"Error handling webhook: {e}")
         logging.exception("Error handling webhook:") # 記錄詳細錯誤堆疊
+        if WEBHOOK_BODY_LOG != 'off':
+            app.logger.error("Request body: %s", RedactedBody(body))
         abort(500)
 
     return 'OK'
 
+@app.route("/callback/stats", methods=['GET'])
+def callback_stats():
+    """回傳 Webhook 背景佇列的深度、等待時間與丟棄數量（需帶入 STATS_TOKEN）"""
+    if not stats_token or not hmac.compare_digest(request.headers.get('X-Stats-Token', ''), stats_token):
+        abort(403)
+    return {
+        'mode': webhook_mode,
+        'queue': event_queue.stats(),
+        'dedup': seen_events.stats(),
+        'menu_cache': menu_cache.stats(),
+        'line_connections': connection_stats(),
+        'line_rate_limits': rate_limit_stats(),
+        'replies': reply_stats.as_dict(),
+        'rich_menu': dict(rich_menu_cache_stats, linked_users=len(user_linked_menus)),
+        'sessions': user_states.stats(),
+        'availability': availability.stats(),
+        'scheduler': job_scheduler.stats(),
+    }
+
+# --- 關鍵字回覆函式（每個函式回傳要回覆的訊息列表） ---
+KEYBOARD_TIP_TEXT = "💡 小提醒：如果需要打字，可以點一下輸入框旁邊的鍵盤圖示，就能暫時收合下方選單喔！😊"
+SERVICE_END_TEXT = "🙏 感恩您的提問！如還有其他需求，歡迎點選下方『返回主選單』繼續提問或預約其他服務 😊"
+
+def reply_ritual(user_id, msg):
+    # 法事服務，暫時不收起圖文選單
+    # unlink_rich_menu_from_user(user_id)
+    # 加入親切提醒，告知如何手動收合選單
+    return [create_ritual_selection_message(user_id), TextMessage(text=KEYBOARD_TIP_TEXT)]
+
+def reply_consultation(user_id, msg):
+    # 問事/命理服務，暫時不收起圖文選單
+    # 發送問事須知，並加入親切提醒
+    return [TextMessage(text=CONSULTATION_INFO_TEXT), TextMessage(text=KEYBOARD_TIP_TEXT)]
+
+def reply_how_to_book(user_id, msg):
+    # 顯示預約選單，重新連接預設圖文選單 (保留此功能)
+    rich_menu_id = get_default_rich_menu_id()
+    link_rich_menu_to_user(user_id, rich_menu_id)
+    return [create_how_to_book_flex()]
+
+def _service_intro_reply(intro_text):
+    """服務說明 + 收合選單提醒 + 返回主選單按鈕"""
+    return [
+        TextMessage(text=intro_text),
+        TextMessage(text=KEYBOARD_TIP_TEXT),
+        create_text_with_menu_button(SERVICE_END_TEXT, alt_text="服務結束提醒")
+    ]
+
+def reply_shoujing(user_id, msg):
+    return _service_intro_reply("【收驚服務說明】\n收驚適合：驚嚇、睡不好、精神不安等狀況。\n請詳細說明您的狀況與需求，老師會依情況協助。\n\n老師通常三天內會回覆您，感恩您的耐心等候。")
+
+def reply_divination(user_id, msg):
+    return _service_intro_reply("【卜卦服務說明】\n卜卦適合：人生抉擇、疑難雜症、重要決定等。\n請詳細說明您的問題與背景，老師會依情況協助。\n\n老師通常三天內會回覆您，感恩您的耐心等候。")
+
+def reply_fengshui(user_id, msg):
+    return _service_intro_reply("【風水服務說明】\n風水適合：居家、辦公室、店面等空間調理。\n請詳細說明您的需求與空間狀況，老師會依情況協助。\n\n老師通常三天內會回覆您，感恩您的耐心等候。")
+
+def reply_payment(user_id, msg):
+    payment_text = f"""【匯款資訊】\n🌟 匯款帳號：\n銀行代碼：{payment_details['bank_code']}\n銀行名稱：{payment_details['bank_name']}\n帳號：{payment_details['account_number']}\n\n（匯款後請告知末五碼以便核對）"""
+    return [create_text_with_menu_button(payment_text, alt_text="匯款資訊")]
+
+def reply_latest_news(user_id, msg):
+    return [create_text_with_menu_button(other_services_keywords["最新消息"], alt_text="最新消息")]
+
+def reply_explore_self(user_id, msg):
+    explore_text = other_services_keywords["探索自我"].replace("[請在此處放入測驗連結]", "(測驗連結待提供)")
+    return [create_text_with_menu_button(explore_text, alt_text="探索自我")]
+
+def reply_lucky_products(user_id, msg):
+    return [create_text_with_menu_button(other_services_keywords["開運產品"], alt_text="開運產品")]
+
+def reply_courses(user_id, msg):
+    return [create_text_with_menu_button(other_services_keywords["課程介紹"], alt_text="課程介紹")]
+
+def reply_ig(user_id, msg):
+    return [create_text_with_menu_button(other_services_keywords["IG"], alt_text="IG")]
+
+def reply_tiktok(user_id, msg):
+    return [create_text_with_menu_button(other_services_keywords["抖音"], alt_text="抖音")]
+
+def reply_fortune_article(user_id, msg):
+    return [create_text_with_menu_button(other_services_keywords["運勢文"], alt_text="運勢文")]
+
+# --- 可預約時間 ---
+# 日曆本機鏡像（與 scheduler.py 的行程提醒共用同一個），忙碌時段索引只套用變動的事件
+calendar_mirror = calendar_reports.calendar_mirror if google_calendar_id else None
+availability = AvailabilityIndex(
+    calendar_mirror,
+    open_hour=int(os.getenv('BOOKING_OPEN_HOUR', '10')),
+    close_hour=int(os.getenv('BOOKING_CLOSE_HOUR', '18')),
+    weekdays=[int(d) for d in os.getenv('BOOKING_WEEKDAYS', '0,1,2,3,4,5,6').split(',') if d.strip()], # 0 = 星期一
+    slot_step_minutes=int(os.getenv('BOOKING_SLOT_STEP', '30'))
+)
+BOOKING_SLOT_MINUTES = int(os.getenv('BOOKING_SLOT_MINUTES', '60')) # 每個可預約時段的長度
+BOOKING_SLOTS_SHOWN = int(os.getenv('BOOKING_SLOTS_SHOWN', '5')) # 回覆的時段數量
+BOOKING_WINDOW_DAYS = int(os.getenv('BOOKING_WINDOW_DAYS', '14')) # 往後查詢的天數
+WEEKDAY_NAMES = "一二三四五六日"
+
+def format_available_slots(slots):
+    if not slots:
+        return f"未來 {BOOKING_WINDOW_DAYS} 天內暫無可預約的時段，請直接留言，老師會與您另約時間。"
+    lines = [f"以下是近期可預約的時段（每段 {BOOKING_SLOT_MINUTES} 分鐘）："]
+    for start, end in slots:
+        lines.append(f"• {start.month}/{start.day}（{WEEKDAY_NAMES[start.weekday()]}）{start:%H:%M}-{end:%H:%M}")
+    lines.append("\n請告訴我們您方便的時段，老師會與您確認。")
+    return "\n".join(lines)
+
+def reply_available_times(user_id, msg):
+    if calendar_mirror is not None:
+        try:
+            if calendar_client.get_credentials() is None:
+                raise RuntimeError("未設定 Google 憑證")
+            slots = availability.next_free_slots(
+                count=BOOKING_SLOTS_SHOWN,
+                duration_minutes=BOOKING_SLOT_MINUTES,
+                days=BOOKING_WINDOW_DAYS
+            )
+            if slots is None:
+                # 日曆仍在背景進行第一次同步（或同步失敗），不在 webhook 中等待
+                waiting_text = "行事曆資料正在更新中，請稍後再查詢可預約時間。"
+                return [create_text_with_menu_button(waiting_text, alt_text="查詢可預約時間")]
+            return [create_text_with_menu_button(format_available_slots(slots), alt_text="查詢可預約時間")]
+        except Exception as e:
+            logging.error(f"Error accessing Google Calendar: {e}")
+            error_text = "查詢可預約時間失敗，請稍後再試。"
+            return [create_text_with_menu_button(error_text, alt_text="查詢錯誤")]
+    error_text = "Google Calendar 設定不完整，無法查詢預約時間。"
+    return [create_text_with_menu_button(error_text, alt_text="設定錯誤")]
+
+# --- 關鍵字路由表 ---
+# (優先順序, 關鍵字, 處理函式)：數字越小越優先，訊息同時包含多個關鍵字時以優先者為準
+# 關鍵字需為正規化後的形式（去除空白、英文小寫）
+KEYWORD_ROUTES = [
+    (5, ("查詢可預約時間",), reply_available_times), # 需早於「預約」，否則會被「預約」攔截
+    (10, ("法事",), reply_ritual),
+    (20, ("問事", "命理"), reply_consultation),
+    (30, ("預約", "如何預約", "命理問事", "算命"), reply_how_to_book),
+    (40, ("收驚",), reply_shoujing),
+    (50, ("卜卦",), reply_divination),
+    (60, ("風水",), reply_fengshui),
+    (70, ("匯款", "匯款資訊", "帳號"), reply_payment),
+    (80, ("最新消息",), reply_latest_news),
+    (90, ("探索自我", "順流致富"), reply_explore_self),
+    (100, ("開運產品", "開運物"), reply_lucky_products),
+    (110, ("課程",), reply_courses),
+    (120, ("ig",), reply_ig),
+    (130, ("抖音",), reply_tiktok),
+    (140, ("運勢文",), reply_fortune_article),
+]
+
+# 載入時編譯一次，比對時只需掃描訊息一次
+keyword_router = KeywordRouter(KEYWORD_ROUTES)
+
+def normalize_message(text):
+    """去除前後與中間的半形/全形空白，並轉為小寫"""
+    return text.strip().replace(' ', '').replace('　', '').lower()
+
 # --- 處理訊息事件 ---
 @handler.add(MessageEvent, message=TextMessageContent)
 def le_message(event):
     """處理文字訊息"""
-    user_message = event.message.text.strip() # 去除前後空白
-    user_id = event.source.user_id # 取得使用者 ID (保留，可能未來其他地方會用到)
+    user_id = event.source.user_id # 取得使用者 ID
 
     # 檢查 Line Bot API 設定是否有效
     if not channel_access_token:
         logging.error("LINE_CHANNEL_ACCESS_TOKEN not found. Cannot reply.")
         return # 無法回覆
 
-    msg = user_message.replace(' ', '').replace('　', '').lower()
-
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        reply_content = []
-
-        if "法事" in msg:
-            # 法事服務，暫時不收起圖文選單
-            # unlink_rich_menu_from_user(user_id)
-            reply_content.append(create_ritual_selection_message(user_id))
-            # 加入親切提醒，告知如何手動收合選單
-            reply_content.append(TextMessage(text="💡 小提醒：如果需要打字，可以點一下輸入框旁邊的鍵盤圖示，就能暫時收合下方選單喔！😊"))
-        elif "問事" in msg or "命理" in msg:
-            # 問事/命理服務，暫時不收起圖文選單
-            # unlink_rich_menu_from_user(user_id)
-            # 發送問事須知
-            reply_content.append(TextMessage(text=CONSULTATION_INFO_TEXT))
-            # 加入親切提醒，告知如何手動收合選單
-            reply_content.append(TextMessage(text="💡 小提醒：如果需要打字，可以點一下輸入框旁邊的鍵盤圖示，就能暫時收合下方選單喔！😊"))
-        elif "預約" in msg or "如何預約" in msg or "命理問事" in msg or "算命" in msg:
-            # 顯示預約選單，重新連接預設圖文選單 (保留此功能)
-            rich_menu_id = get_default_rich_menu_id()
-            link_rich_menu_to_user(user_id, rich_menu_id)
-            reply_content.append(create_how_to_book_flex())
-        elif "收驚" in msg:
-            # 收驚服務，暫時不收起圖文選單
-            # unlink_rich_menu_from_user(user_id)
-            reply_content.append(TextMessage(text="【收驚服務說明】\n收驚適合：驚嚇、睡不好、精神不安等狀況。\n請詳細說明您的狀況與需求，老師會依情況協助。\n\n老師通常三天內會回覆您，感恩您的耐心等候。"))
-            # 加入親切提醒，告知如何手動收合選單
-            reply_content.append(TextMessage(text="💡 小提醒：如果需要打字，可以點一下輸入框旁邊的鍵盤圖示，就能暫時收合下方選單喔！😊"))
-            reply_content.append(create_text_with_menu_button(
-                "🙏 感恩您的提問！如還有其他需求，歡迎點選下方『返回主選單』繼續提問或預約其他服務 😊",
-                alt_text="服務結束提醒"
-            ))
-        elif "卜卦" in msg:
-            # 卜卦服務，暫時不收起圖文選單
-            # unlink_rich_menu_from_user(user_id)
-            reply_content.append(TextMessage(text="【卜卦服務說明】\n卜卦適合：人生抉擇、疑難雜症、重要決定等。\n請詳細說明您的問題與背景，老師會依情況協助。\n\n老師通常三天內會回覆您，感恩您的耐心等候。"))
-            # 加入親切提醒，告知如何手動收合選單
-            reply_content.append(TextMessage(text="💡 小提醒：如果需要打字，可以點一下輸入框旁邊的鍵盤圖示，就能暫時收合下方選單喔！😊"))
-            reply_content.append(create_text_with_menu_button(
-                "🙏 感恩您的提問！如還有其他需求，歡迎點選下方『返回主選單』繼續提問或預約其他服務 😊",
-                alt_text="服務結束提醒"
-            ))
-        elif "風水" in msg:
-            # 風水服務，暫時不收起圖文選單
-            # unlink_rich_menu_from_user(user_id)
-            reply_content.append(TextMessage(text="【風水服務說明】\n風水適合：居家、辦公室、店面等空間調理。\n請詳細說明您的需求與空間狀況，老師會依情況協助。\n\n老師通常三天內會回覆您，感恩您的耐心等候。"))
-            # 加入親切提醒，告知如何手動收合選單
-            reply_content.append(TextMessage(text="💡 小提醒：如果需要打字，可以點一下輸入框旁邊的鍵盤圖示，就能暫時收合下方選單喔！😊"))
-            reply_content.append(create_text_with_menu_button(
-                "🙏 感恩您的提問！如還有其他需求，歡迎點選下方『返回主選單』繼續提問或預約其他服務 😊",
-                alt_text="服務結束提醒"
-            ))
-        elif "匯款" in msg or "匯款資訊" in msg or "帳號" in msg:
-            payment_text = f"""【匯款資訊】\n🌟 匯款帳號：\n銀行代碼：{payment_details['bank_code']}\n銀行名稱：{payment_details['bank_name']}\n帳號：{payment_details['account_number']}\n\n（匯款後請告知末五碼以便核對）"""
-            reply_content.append(create_text_with_menu_button(payment_text, alt_text="匯款資訊"))
-        elif "最新消息" in msg:
-            reply_content.append(create_text_with_menu_button(other_services_keywords["最新消息"], alt_text="最新消息"))
-        elif "探索自我" in msg or "順流致富" in msg:
-            explore_text = other_services_keywords["探索自我"].replace("[請在此處放入測驗連結]", "(測驗連結待提供)")
-            reply_content.append(create_text_with_menu_button(explore_text, alt_text="探索自我"))
-        elif "開運產品" in msg or "開運物" in msg:
-            text_to_reply = other_services_keywords["開運產品"]
-            reply_content.append(create_text_with_menu_button(text_to_reply, alt_text="開運產品"))
-        elif "課程" in msg:
-            reply_content.append(create_text_with_menu_button(other_services_keywords["課程介紹"], alt_text="課程介紹"))
-        elif "ig" in msg:
-            reply_content.append(create_text_with_menu_button(other_services_keywords["IG"], alt_text="IG"))
-        elif "抖音" in msg:
-            reply_content.append(create_text_with_menu_button(other_services_keywords["抖音"], alt_text="抖音"))
-        elif "運勢文" in msg:
-            reply_content.append(create_text_with_menu_button(other_services_keywords["運勢文"], alt_text="運勢文"))
-        elif "查詢可預約時間" in msg:
-            if google_calendar_id and google_credentials_json_path:
-                try:
-                    calendar_response_text = "查詢可預約時間功能開發中..."
-                    reply_content.append(create_text_with_menu_button(calendar_response_text, alt_text="查詢可預約時間"))
-                except Exception as e:
-                    logging.error(f"Error accessing Google Calendar: {e}")
-                    error_text = "查詢可預約時間失敗，請稍後再試。"
-                    reply_content.append(create_text_with_menu_button(error_text, alt_text="查詢錯誤"))
-            else:
-                error_text = "Google Calendar 設定不完整，無法查詢預約時間。"
-                reply_content.append(create_text_with_menu_button(error_text, alt_text="設定錯誤"))
+    msg = normalize_message(event.message.text)
+
+    with messaging_api() as line_bot_api:
+        route = keyword_router.match(msg)
+        reply_content = route.handler(user_id, msg) if route else []
 
         # 如果沒有任何關鍵字被觸發，回覆預設訊息
         if not reply_content:
@@ -532,12 +727,7 @@ def le_message(event):
 
         # --- 發送回覆 ---
         try:
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=reply_content
-                )
-            )
+            send_reply(line_bot_api, event, reply_content)
         except Exception as e:
             logging.error(f"Error sending reply message: {e}")
 
@@ -551,9 +741,7 @@ def handle_postback(event):
         logging.error("LINE_CHANNEL_ACCESS_TOKEN not found. Cannot handle postback.")
         return
 
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-
+    with messaging_api() as line_bot_api:
         try:
             # 嘗試解析 JSON 格式的 postback data
             postback_data = json.loads(event.postback.data)
@@ -576,31 +764,35 @@ def handle_postback(event):
             logging.info(f"用戶 {user_id} 選擇法事項目: {selected_ritual}")
             
             if selected_ritual:
+                messages = []
                 # 確保用戶狀態初始化
-                if user_id not in user_states or user_states[user_id].get("state") != "selecting_rituals":
+                if user_states.get(user_id, {}).get("state") != "selecting_rituals":
+                    expired = user_states.pop_expired(user_id)
                     user_states[user_id] = {"state": "selecting_rituals", "data": {"selected_rituals": []}}
-                    logging.info(f"初始化用戶狀態: {user_states[user_id]}")
-                
+                    if expired:
+                        # 先前的選擇已逾時：不套用這次點選，請用戶從新的選單重新開始
+                        logging.info(f"用戶 {user_id} 的法事選擇已逾時，重新開始")
+                        messages.append(TextMessage(text=SELECTION_EXPIRED_TEXT))
+                        selected_ritual = None
+                    else:
+                        logging.info(f"初始化用戶狀態: {user_states[user_id]}")
+
                 # 切換選擇狀態：如果已選擇則移除，如果未選擇則添加
                 current_selection = user_states[user_id]["data"]["selected_rituals"]
-                if selected_ritual in current_selection:
-                    current_selection.remove(selected_ritual)
-                    logging.info(f"從選擇中移除: {selected_ritual}")
-                else:
-                    current_selection.append(selected_ritual)
-                    logging.info(f"添加到選擇: {selected_ritual}")
+                if selected_ritual is not None:
+                    if selected_ritual in current_selection:
+                        current_selection.remove(selected_ritual)
+                        logging.info(f"從選擇中移除: {selected_ritual}")
+                    else:
+                        current_selection.append(selected_ritual)
+                        logging.info(f"添加到選擇: {selected_ritual}")
                 
                 # 立即發送更新後的法事選擇界面
-                updated_menu = create_ritual_selection_message(user_id)
+                messages.append(create_ritual_selection_message(user_id))
                 
                 # 使用事件的回覆 token 直接回覆更新的選單
                 try:
-                    line_bot_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[updated_menu]
-                        )
-                    )
+                    send_reply(line_bot_api, event, messages)
                     logging.info(f"已發送更新後的法事選擇介面給用戶 {user_id}")
                     return  # 直接返回，避免後續的回覆處理
                 except Exception as e:
@@ -611,8 +803,9 @@ def handle_postback(event):
 
         # --- 處理完成法事選擇 ---
         elif action == 'confirm_rituals':
-            if user_id in user_states and user_states[user_id].get("state") == "selecting_rituals":
-                selected_rituals = user_states[user_id].get("data", {}).get("selected_rituals", [])
+            session = user_states.get(user_id)
+            if session and session.get("state") == "selecting_rituals":
+                selected_rituals = session.get("data", {}).get("selected_rituals", [])
                 logging.info(f"用戶 {user_id} 確認法事選擇: {selected_rituals}")
                 
                 if not selected_rituals:
@@ -621,12 +814,7 @@ def handle_postback(event):
                     selection_menu = create_ritual_selection_message(user_id)
                     
                     try:
-                        line_bot_api.reply_message(
-                            ReplyMessageRequest(
-                                reply_token=event.reply_token,
-                                messages=[alert_text, selection_menu]
-                            )
-                        )
+                        send_reply(line_bot_api, event, [alert_text, selection_menu])
                         return  # 直接返回，避免後續的回覆處理
                     except Exception as e:
                         logging.error(f"回覆提示消息時出錯: {e}")
@@ -645,27 +833,24 @@ def handle_postback(event):
                     confirmation_text += f"\n🌟銀行代碼：{payment_details['bank_code']}  {payment_details['bank_name']}\n"
                     confirmation_text += f"🌟帳號：{payment_details['account_number']}\n"
                     confirmation_text += "\n🙏 感恩您的信任！老師會在三天內與您聯繫確認，祝福您一切順心如意，運勢亨通！✨"
-                    line_bot_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[
-                                create_text_with_menu_button(confirmation_text, alt_text="法事預約完成")
-                            ]
-                        )
-                    )
-                    if user_id in user_states:
-                        del user_states[user_id]
+                    send_reply(line_bot_api, event, [
+                        create_text_with_menu_button(confirmation_text, alt_text="法事預約完成")
+                    ])
+                    user_states.pop(user_id)
                     return
+            else:
+                # 選擇狀態已逾時或不存在（例如服務重啟），請用戶重新選擇
+                logging.info(f"用戶 {user_id} 確認法事時沒有進行中的選擇")
+                expired = user_states.pop_expired(user_id)
+                user_states[user_id] = {"state": "selecting_rituals", "data": {"selected_rituals": []}}
+                prompt_text = SELECTION_EXPIRED_TEXT if expired else SELECTION_START_TEXT
+                send_reply(line_bot_api, event, [TextMessage(text=prompt_text), create_ritual_selection_message(user_id)])
+                return
 
         # --- 處理其他 action ---
         elif action == 'show_ritual_selection':
             ritual_menu = create_ritual_selection_message(user_id)
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[ritual_menu]
-                )
-            )
+            send_reply(line_bot_api, event, [ritual_menu])
             return
 
 # --- 處理加入好友事件 ---
@@ -673,16 +858,14 @@ def handle_postback(event):
 def handle_follow(event):
     """當使用者加入好友時發送歡迎訊息與按鈕選單"""
     user_id = event.source.user_id
-    followed_users.add(user_id) # 將新用戶 ID 加入集合
-    logging.info(f"User {user_id} followed the bot. Current followed users: {len(followed_users)}")
+    followed_users.add(user_id) # 將新用戶 ID 加入好友清單（背景批次寫入）
+    logging.info(f"User {user_id} followed the bot.")
 
     if not channel_access_token:
         logging.error("LINE_CHANNEL_ACCESS_TOKEN not found. Cannot send follow message.")
         return
 
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-
+    with messaging_api() as line_bot_api:
         welcome_text = """歡迎加入【宇宙玄天院】！
 
 宇宙玄天院｜開啟靈性覺醒的殿堂
@@ -703,27 +886,32 @@ def handle_follow(event):
         services_flex = create_main_services_flex()
 
         try:
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[welcome_message, services_flex]
-                )
-            )
+            send_reply(line_bot_api, event, [welcome_message, services_flex])
             logging.info(f"Successfully sent welcome message to user {user_id}")
         except Exception as e:
             logging.error(f"Error sending follow message to user {user_id}: {e}")
 
 # --- 狀態管理 ---
-# 儲存所有加入好友的使用者 ID（模擬資料庫 - 注意：服務重啟會遺失）
-followed_users = set()
-
-# 儲存使用者的生日（臨時儲存，等待時辰選擇）
-user_birthday_data = {}
+# 儲存所有加入好友的使用者 ID（SQLite，所有 worker 共用，重啟不會遺失）
+followed_users = FollowerStore(
+    data_path('followers.db'),
+    flush_interval=float(os.getenv('FOLLOWER_FLUSH_INTERVAL', '1.0')),
+    batch_size=int(os.getenv('FOLLOWER_FLUSH_BATCH', '200'))
+)
 
 # 統一使用 user_states 進行狀態管理 (替代 user_ritual_selections)
-user_states = {}
+# 閒置逾時或超過數量上限的狀態會自動清除，記憶體用量不隨用戶數增加
+user_states = SessionStore(
+    idle_timeout=int(os.getenv('SESSION_IDLE_TIMEOUT', '1800')),
+    max_sessions=int(os.getenv('SESSION_MAX', '10000'))
+)
+
+SELECTION_EXPIRED_TEXT = "⏰ 您的法事選擇已逾時，請重新開始勾選您要預約的法事項目。"
+SELECTION_START_TEXT = "請先勾選您要預約的法事項目，選好後再點擊完成。"
 
 # --- 每周運勢文群發 --- 
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '4')) # 同時送出的 multicast 批次數上限
+
 def send_weekly_fortune():
     """向所有已加入好友的用戶推播每周運勢文"""
     # !!! 注意：這裡的 fortune_text 需要您定期手動更新，或從外部來源讀取 !!!
@@ -733,42 +921,60 @@ def send_weekly_fortune():
         logging.error("LINE_CHANNEL_ACCESS_TOKEN not found. Cannot send weekly fortune.")
         return
     
-    logging.info(f"準備發送每周運勢文給 {len(followed_users)} 位用戶...")
-    successful_sends = 0
-    failed_sends = 0
-    
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        # 複製一份 set 來迭代，避免在迭代過程中修改 set 導致錯誤
-        current_followed_users = followed_users.copy() 
-        for user_id in current_followed_users:
-            try:
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=user_id,
-                        messages=[TextMessage(text=fortune_text)]
-                    )
-                )
-                logging.info(f"已發送每周運勢文給用戶: {user_id}")
-                successful_sends += 1
-                time.sleep(0.1) # 稍微延遲，避免觸發速率限制
-            except Exception as e:
-                logging.error(f"發送每周運勢文給 {user_id} 時出錯: {e}")
-                failed_sends += 1
-                # 可以考慮在這裡處理錯誤，例如將失敗的 user_id 記錄下來
-                # 或從 followed_users 中移除無效的 user_id (需要更謹慎的錯誤判斷)
-                
-    logging.info(f"每周運勢文發送完成。成功: {successful_sends}, 失敗: {failed_sends}")
+    # 每週一個固定的工作 ID：同一週重複觸發（或中斷後重跑）只會補送尚未送出的批次
+    year, week, _ = datetime.now().isocalendar()
+    job_id = broadcast_jobs.create_job(f"weekly-fortune-{year}-W{week:02d}", [TextMessage(text=fortune_text)])
+    logging.info(f"準備發送每周運勢文（工作 {job_id}）給 {len(followed_users)} 位用戶...")
+
+    # 以 multicast 每 500 人一批並行送出，收件人從資料庫逐批讀取，每批完成即記錄進度
+    result = broadcast_jobs.run_job(job_id, followed_recipients_after, concurrency=BROADCAST_CONCURRENCY)
+    if result is None:
+        return None
+    logging.info(
+        f"每周運勢文發送完成。成功: {result['sent']}, 失敗: {result['failed']}, 略過: {result['skipped']}, "
+        f"批次: {result['batches']}, 未完成批次: {result['remaining_batches']}, 耗時: {result['elapsed']} 秒"
+    )
+    return result
+
+def followed_recipients_after(cursor):
+    """依 user_id 順序產生 cursor 之後的好友（供群發工作分批與續傳使用）"""
+    for batch in followed_users.iter_batches(broadcast_jobs.PLAN_BATCH_SIZE, after=cursor):
+        yield from batch
+
+def resume_broadcast_jobs():
+    """服務啟動時續傳上次中斷的群發工作（在背景執行，不影響啟動）"""
+    try:
+        results = broadcast_jobs.resume_unfinished_jobs(followed_recipients_after, concurrency=BROADCAST_CONCURRENCY)
+        if results:
+            logging.info(f"已續傳 {len(results)} 個未完成的群發工作")
+    except Exception as e:
+        logging.error(f"續傳群發工作時出錯: {e}")
+
+# --- 排程 ---
+# 每個 gunicorn worker 都會呼叫 start_background_services()，但只有取得 data/scheduler.lock 的 worker 會執行排程
+job_scheduler = LeaderScheduler()
+# 排程時間為台北時間；APScheduler 只在成為 leader 的 worker 才載入
+job_scheduler.add_job('weekly_fortune', send_weekly_fortune, day_of_week='fri', hour=9, minute=0) # 每周五 9:00
+job_scheduler.add_job('daily_reminder', calendar_reports.send_daily_reminder, hour=8, minute=0) # 每天 8:00 提醒明天行程
+job_scheduler.add_job('monthly_status', calendar_reports.send_monthly_status, day=1, hour=8, minute=0) # 每月 1 日 8:00
+# 續傳上次中斷的群發工作（租約可避免多個行程重複執行同一個工作）
+job_scheduler.on_elected(resume_broadcast_jobs)
+atexit.register(job_scheduler.shutdown)
+
+def start_background_services():
+    """預熱快取並啟動排程（gunicorn 由 gunicorn.conf.py 在每個 worker 啟動後呼叫；python app.py 則在主程式呼叫）"""
+    threading.Thread(target=warm_caches, name='cache-warmup', daemon=True).start()
+    job_scheduler.start()
 
 # --- 設定圖文選單 ---
+RICH_MENU_IMAGE_PATH = os.getenv('RICH_MENU_IMAGE', 'rich_menu_6grid.jpg') # 圖文選單圖片（內容變動時會自動建立新版選單）
+
 def setup_rich_menu():
     if not channel_access_token:
         logging.error("LINE_CHANNEL_ACCESS_TOKEN not found. Cannot set up rich menu.")
         return
 
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-
+    with messaging_api() as line_bot_api:
         # 定義圖文選單結構 (6個按鈕)
         rich_menu_to_create = {
             "size": {
@@ -809,56 +1015,23 @@ def setup_rich_menu():
         }
 
         try:
-            # 0. 檢查是否已存在同名選單，若有則刪除舊的 (可選)
-            existing_menus = line_bot_api.get_rich_menu_list()
-            for menu in existing_menus:
-                if menu.name == rich_menu_to_create["name"]:
-                    logging.info(f"Deleting existing rich menu: {menu.rich_menu_id}")
-                    line_bot_api.delete_rich_menu(menu.rich_menu_id)
-                    break # 假設名字唯一
-
-            # 1. 建立圖文選單物件
-            rich_menu_response = line_bot_api.create_rich_menu(rich_menu_object=rich_menu_to_create)
-            rich_menu_id = rich_menu_response.rich_menu_id
-            logging.info(f"Rich menu created with ID: {rich_menu_id}")
-
-            # 2. 上傳圖文選單圖片 (!!! 重要：您需要提供圖片 !!!)
-            # 方法一：從本地文件上傳 (需要您將圖片放到項目目錄)
-            image_path = "rich_menu_6grid.jpg" # 假設您的圖片檔名
-            if os.path.exists(image_path):
-                with open(image_path, 'rb') as f:
-                    line_bot_api.set_rich_menu_image(
-                        rich_menu_id=rich_menu_id,
-                        content_type='image/jpeg', # 或 'image/png'
-                        body=f.read()
-                    )
-                logging.info(f"Uploaded rich menu image from {image_path}")
-            else:
-                logging.warning(f"Rich menu image file not found at {image_path}. Please upload manually or provide the correct path.")
-                # 您需要手動到 Line Developer 後台為這個 rich_menu_id 上傳圖片
-            
-            # 方法二：從 URL 上傳 (如果您的圖片在網路上)
-            # image_url = "YOUR_IMAGE_URL_HERE"
-            # import requests
-            # response = requests.get(image_url, stream=True)
-            # if response.status_code == 200:
-            #     line_bot_api.set_rich_menu_image(
-            #         rich_menu_id=rich_menu_id,
-            #         content_type=response.headers['Content-Type'],
-            #         body=response.raw
-            #     )
-            #     logging.info(f"Uploaded rich menu image from URL: {image_url}")
-            # else:
-            #     logging.error(f"Failed to download rich menu image from URL: {image_url}")
-
-            # 3. 設定為預設圖文選單
-            line_bot_api.set_default_rich_menu(rich_menu_id=rich_menu_id)
-            logging.info(f"Set rich menu {rich_menu_id} as default.")
-
+            # 選單定義與圖片都沒變動時不做任何事；有變動時先建立新版並設為預設，之後才刪除舊版
+            provision_rich_menu(
+                line_bot_api,
+                get_messaging_blob_api(),
+                rich_menu_to_create,
+                RICH_MENU_IMAGE_PATH,
+                data_path('rich_menu.json'),
+                on_changed=lambda rich_menu_id: invalidate_rich_menu_cache(),
+                retire_delay=RICH_MENU_CACHE_TTL # 等其他 worker 快取的舊選單 ID 過期後再刪除
+            )
         except Exception as e:
             logging.error(f"Error setting up rich menu: {e}")
             logging.error(traceback.format_exc())
 
+# 由取得排程鎖的 worker 在背景設定一次（不會每個 worker、每次冷啟動都重建）
+job_scheduler.on_elected(setup_rich_menu)
+
 # --- 法事項目與價格對應表 ---
 SERVICE_FEES = {
     "冤親債主（個人）": 680,
@@ -868,13 +1041,33 @@ SERVICE_FEES = {
     "祖先": 1800
 }
 
+# 法事多選選單的項目（順序即選單顯示順序，也是選擇位元遮罩的位元順序）
+RITUAL_ITEMS = ["冤親債主（個人）", "補桃花（個人）", "補財庫（個人）", "三合一（個人）", "祖先"]
+
 # --- 法事選擇多選選單產生函式 ---
+# 選單只取決於勾選狀態，以位元遮罩為 key 快取（5 個項目共 32 種）
+# RITUAL_ITEMS 或 SERVICE_FEES 變動時快取自動失效重建
+ritual_menu_cache = MessageCache(lambda: repr((RITUAL_ITEMS, SERVICE_FEES)), max_entries=1024)
+
+def ritual_selection_mask(selected_rituals):
+    """將已選項目轉成位元遮罩（第 i 個位元代表 RITUAL_ITEMS[i]）"""
+    mask = 0
+    for idx, item in enumerate(RITUAL_ITEMS):
+        if item in selected_rituals:
+            mask |= 1 << idx
+    return mask
+
 def create_ritual_selection_message(user_id):
-    """產生法事多選選單（含已選項目打勾）"""
+    """產生法事多選選單（含已選項目打勾，快取）"""
     selected = set(user_states.get(user_id, {}).get("data", {}).get("selected_rituals", []))
-    all_items = ["冤親債主（個人）", "補桃花（個人）", "補財庫（個人）", "三合一（個人）", "祖先"]
+    mask = ritual_selection_mask(selected)
+    return ritual_menu_cache.get(mask, lambda: _build_ritual_selection_message(mask))
+
+def _build_ritual_selection_message(mask):
+    """依位元遮罩產生法事多選選單"""
+    selected = {item for idx, item in enumerate(RITUAL_ITEMS) if mask & (1 << idx)}
     buttons = []
-    for item in all_items:
+    for item in RITUAL_ITEMS:
         checked = "✅" if item in selected else ""
         label = f"{checked}{item} (NT${SERVICE_FEES.get(item,'洽詢')})"
         buttons.append(
@@ -939,32 +1132,117 @@ def calculate_total_price(selected_rituals):
     total = sum(SERVICE_FEES.get(item, 0) for item in items)
     return total, list(items)
 
+# --- 圖文選單快取 ---
+# 預設圖文選單 ID 的快取秒數，以及每位用戶目前連結的選單（同一個選單不必重複連結）
+RICH_MENU_CACHE_TTL = int(os.getenv('RICH_MENU_CACHE_TTL', '600'))
+USER_MENU_LINK_TTL = int(os.getenv('USER_MENU_LINK_TTL', '86400'))
+USER_MENU_INDEX_MAX = int(os.getenv('USER_MENU_INDEX_MAX', '50000'))
+
+_rich_menu_lock = threading.Lock()
+_default_rich_menu_cache = {"rich_menu_id": None, "expires_at": 0.0}
+user_linked_menus = OrderedDict() # user_id -> (rich_menu_id, 到期時間)
+rich_menu_cache_stats = {"default_hits": 0, "default_misses": 0, "link_skipped": 0, "link_calls": 0}
+
+def invalidate_rich_menu_cache():
+    """圖文選單重新建立後呼叫：清除預設選單 ID 與所有用戶的連結紀錄"""
+    with _rich_menu_lock:
+        _default_rich_menu_cache["rich_menu_id"] = None
+        _default_rich_menu_cache["expires_at"] = 0.0
+        user_linked_menus.clear()
+    logging.info("已清除圖文選單快取")
+
 def unlink_rich_menu_from_user(user_id):
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        line_bot_api.unlink_rich_menu_from_user(user_id)
+    with messaging_api() as line_bot_api:
+        line_bot_api.unlink_rich_menu_id_from_user(user_id)
+    with _rich_menu_lock:
+        user_linked_menus.pop(user_id, None)
 
 def link_rich_menu_to_user(user_id, rich_menu_id):
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        line_bot_api.link_rich_menu_to_user(user_id, rich_menu_id)
+    """將圖文選單連結給用戶；若該用戶已連結同一個選單則略過 API 呼叫"""
+    now = time.time()
+    with _rich_menu_lock:
+        linked = user_linked_menus.get(user_id)
+        if linked and linked[0] == rich_menu_id and linked[1] > now:
+            rich_menu_cache_stats["link_skipped"] += 1
+            return
+    try:
+        with messaging_api() as line_bot_api:
+            line_bot_api.link_rich_menu_id_to_user(user_id, rich_menu_id)
+    except Exception as e:
+        logging.error(f"連結圖文選單給用戶 {user_id} 失敗: {e}")
+        return
+    with _rich_menu_lock:
+        rich_menu_cache_stats["link_calls"] += 1
+        user_linked_menus[user_id] = (rich_menu_id, now + USER_MENU_LINK_TTL)
+        user_linked_menus.move_to_end(user_id)
+        while len(user_linked_menus) > USER_MENU_INDEX_MAX:
+            user_linked_menus.popitem(last=False)
 
 def get_default_rich_menu_id():
     """獲取目前設定的預設圖文選單 ID"""
     # 嘗試從環境變數讀取預設選單 ID
     if default_rich_menu_id and default_rich_menu_id != '16633875':  # 檢查是否是預設值
         return default_rich_menu_id
-        
+
+    # 使用快取，避免每則訊息都呼叫 API
+    with _rich_menu_lock:
+        if _default_rich_menu_cache["rich_menu_id"] and _default_rich_menu_cache["expires_at"] > time.time():
+            rich_menu_cache_stats["default_hits"] += 1
+            return _default_rich_menu_cache["rich_menu_id"]
+        rich_menu_cache_stats["default_misses"] += 1
+
     # 否則通過 API 獲取
     try:
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            return line_bot_api.get_default_rich_menu_id().rich_menu_id
+        with messaging_api() as line_bot_api:
+            rich_menu_id = line_bot_api.get_default_rich_menu_id().rich_menu_id
     except Exception as e:
         logging.error(f"獲取預設圖文選單ID失敗: {e}")
-        # 返回固定的備用 ID
+        # 返回固定的備用 ID（不快取，下次再重新查詢）
         return "16633875"  # 這是您在程式碼中已經使用的固定選單ID
 
+    with _rich_menu_lock:
+        _default_rich_menu_cache["rich_menu_id"] = rich_menu_id
+        _default_rich_menu_cache["expires_at"] = time.time() + RICH_MENU_CACHE_TTL
+    return rich_menu_id
+
+# --- 健康檢查 ---
+APP_STARTED_AT = time.time()
+caches_warmed = threading.Event()
+
+def warm_caches():
+    """預先建立靜態選單訊息並載入可預約時間索引，第一位用戶不必等待"""
+    try:
+        create_main_services_flex()
+        create_ritual_prices_flex()
+        create_how_to_book_flex()
+        availability.refresh(background=False) # 第一次同步在預熱執行緒完成，webhook 不必等待
+    except Exception as e:
+        logging.error(f"預熱快取時出錯: {e}")
+    finally:
+        caches_warmed.set()
+
+def health_status():
+    """/healthz 的內容：快取預熱完成即視為就緒"""
+    return {
+        'ready': caches_warmed.is_set(),
+        'caches_warmed': caches_warmed.is_set(),
+        'scheduler_leader': job_scheduler.is_leader,
+        'uptime': round(time.time() - APP_STARTED_AT, 1),
+        'pid': os.getpid(),
+    }
+
+# /healthz 在 WSGI 層直接回應，不經過 Flask（保活 ping 與監控的成本降到最低）
+app.wsgi_app = HealthCheckMiddleware(app.wsgi_app, health_status)
+
+# --- 冷啟動分析 ---
+startup_profile.mark('app ready')
+startup_profile.report()
+if startup_profile.ENABLED:
+    @app.after_request
+    def profile_first_request(response):
+        startup_profile.mark('first response')
+        return response
+
 # --- 主程式入口 ---
 if __name__ == "__main__":
     # 設定 Log 等級
@@ -977,20 +1255,8 @@ if __name__ == "__main__":
         logging.warning("TEACHER_USER_ID is not set. Notifications to teacher will not work.")
     # ... (其他檢查) ...
 
-    # --- 新增：嘗試設定圖文選單 --- 
-    try:
-        setup_rich_menu()
-    except Exception as e:
-        logging.error(f"Failed to setup rich menu during startup: {e}")
-    # -----------------------------
-
-    # --- 新增：設定每周五發送運勢文的排程 --- 
-    scheduler = BackgroundScheduler(daemon=True) # daemon=True 允許主程序退出
-    # 設定為每周五的上午 9:00 發送
-    scheduler.add_job(send_weekly_fortune, CronTrigger(day_of_week='fri', hour=9, minute=0, timezone='Asia/Taipei'))
-    scheduler.start()
-    logging.info("APScheduler started for weekly fortune messages.")
-    # ---------------------------------------
+    # 排程（每周運勢文、每日行程提醒、月度狀態）、群發續傳與圖文選單設定（皆在背景執行）
+    start_background_services()
 
     port = int(os.environ.get('PORT', 5000))
     logging.info(f"Starting Flask server on port {port}")
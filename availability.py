@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+可預約時間查詢：
+- 將日曆中的忙碌時段存成依開始時間排序的區間列表，以 bisect 找出與查詢範圍重疊的區間
+- 從日曆鏡像的 changes_since() 只取回變動的事件，逐筆插入/移除，不必每次重建
+- 重複事件在滾動的時間範圍內展開成各次事件；master 或其例外事件變動時只重新展開該系列
+- 在營業時間內由近到遠找出前 N 個長度為 D 的空檔；查詢只在記憶體中進行，可直接在 webhook 中執行
+- 查詢時不會在請求的執行緒同步日曆；日曆鏡像尚未完成第一次同步時回傳 None（請用戶稍後再試）
+"""
+
+import bisect
+import datetime
+import logging
+import threading
+import time
+
+from recurrence import TW_TIMEZONE, RecurrenceExpander, event_timestamp, is_master, original_start_timestamp
+
+logger = logging.getLogger(__name__)
+
+
+class AvailabilityIndex:
+    """依開始時間排序的忙碌區間索引"""
+
+    def __init__(self, mirror=None, open_hour=10, close_hour=18, weekdays=(0, 1, 2, 3, 4, 5, 6),
+                 slot_step_minutes=30, refresh_interval=5, horizon_days=60, tz=TW_TIMEZONE):
+        self._mirror = mirror
+        self._open_hour = open_hour
+        self._close_hour = close_hour
+        self._weekdays = frozenset(weekdays)
+        self._slot_step = slot_step_minutes * 60
+        self._refresh_interval = refresh_interval
+        self._tz = tz
+        self._starts = [] # 依開始時間排序的 (start, end, event_id)
+        self._by_id = {} # event_id -> (start, end, event_id)
+        self._max_length = 0.0 # 最長的忙碌區間，用來決定往前找多遠
+        self._horizon = horizon_days * 86400 # 重複事件展開的範圍
+        self._expanded_from = 0.0
+        self._masters = {} # 系列 -> 重複事件 master
+        self._overrides = {} # 系列 -> {例外事件: 原本那一次的開始時間}
+        self._occurrences = {} # 系列 -> 已展開並放進索引的各次 event_id
+        self._dirty = set() # 需要重新展開的系列
+        self._expander = RecurrenceExpander(default_tz=tz)
+        self._generation = None
+        self._version = None
+        self._refreshed_at = 0.0
+        self._loaded = False # 已載入所有日曆都同步過的鏡像資料
+        self._windows = {} # 日期 -> (營業開始, 營業結束) 的 epoch 秒，避免每次查詢都做時區換算
+        self._lock = threading.RLock()
+        # 統計數據
+        self.full_loads = 0
+        self.incremental_updates = 0
+
+    # --- 索引維護 ---
+    def _insert(self, event_id, start, end):
+        entry = (start, end, event_id)
+        bisect.insort(self._starts, entry)
+        self._by_id[event_id] = entry
+        self._max_length = max(self._max_length, end - start)
+
+    def _remove(self, event_id):
+        entry = self._by_id.pop(event_id, None)
+        if entry is not None:
+            i = bisect.bisect_left(self._starts, entry)
+            if i < len(self._starts) and self._starts[i] == entry:
+                del self._starts[i]
+
+    def _upsert(self, event):
+        # 不同日曆的事件 ID 可能相同，以「日曆/事件」作為索引鍵
+        calendar_id = event.get('calendarId', '')
+        event_id = f"{calendar_id}/{event.get('id')}"
+        self._remove(event_id)
+        series_id = event.get('recurringEventId')
+        if series_id:
+            # 例外事件：原本那一次不再佔用時間，改以例外事件本身（若未取消）為準
+            series = f"{calendar_id}/{series_id}"
+            self._overrides.setdefault(series, {})[event_id] = original_start_timestamp(event)
+            self._dirty.add(series)
+        if event_id in self._masters:
+            del self._masters[event_id]
+            self._dirty.add(event_id)
+        # 已取消或標記為「有空」的事件不佔用時間
+        if event.get('status') == 'cancelled' or event.get('transparency') == 'transparent':
+            return
+        if is_master(event):
+            self._masters[event_id] = event
+            self._dirty.add(event_id)
+            return
+        start = event_timestamp(event.get('start'), self._tz)
+        end = event_timestamp(event.get('end'), self._tz)
+        if start is None or end is None or end <= start:
+            return
+        self._insert(event_id, start, end)
+
+    def _expand_dirty(self):
+        """重新展開有變動的重複事件系列（只處理展開範圍內的各次）"""
+        start, end = self._expanded_from, self._expanded_from + self._horizon
+        for series in self._dirty:
+            for event_id in self._occurrences.pop(series, ()):
+                self._remove(event_id)
+            master = self._masters.get(series)
+            if master is None:
+                continue
+            skip = set(self._overrides.get(series, {}).values())
+            ids = []
+            try:
+                occurrences = self._expander.occurrences(master, start, end)
+            except Exception as e:
+                logger.warning(f"無法展開重複事件 {series}: {e}")
+                occurrences = []
+            for begin, finish, _ in occurrences:
+                if begin in skip:
+                    continue
+                event_id = f"{series}@{int(begin)}"
+                self._insert(event_id, begin, finish)
+                ids.append(event_id)
+            self._occurrences[series] = ids
+        self._dirty.clear()
+
+    def _roll_window(self, now):
+        # 展開範圍每天往後移一次，讓重複事件一直涵蓋接下來 horizon_days 天
+        if now - self._expanded_from > 86400:
+            self._expanded_from = now - 86400
+            self._dirty.update(self._masters)
+
+    def load(self, events):
+        """以完整的事件列表重建索引"""
+        with self._lock:
+            self._starts = []
+            self._by_id = {}
+            self._max_length = 0.0
+            self._masters = {}
+            self._overrides = {}
+            self._occurrences = {}
+            self._dirty = set()
+            self._roll_window(time.time())
+            for event in events:
+                self._upsert(event)
+            self._expand_dirty()
+
+    def apply_changes(self, events):
+        """套用變動的事件（新增、修改或取消）"""
+        with self._lock:
+            self._roll_window(time.time())
+            for event in events:
+                self._upsert(event)
+            self._expand_dirty()
+
+    def refresh(self, background=True):
+        """
+        從日曆鏡像取回變動（至多每 refresh_interval 秒一次）。
+        background=True 時同步在背景進行，不會卡住查詢；預熱時可傳入 False，在目前的執行緒完成第一次同步。
+        """
+        if self._mirror is None:
+            return
+        now = time.monotonic()
+        if self._loaded and now - self._refreshed_at < self._refresh_interval:
+            return
+        with self._lock:
+            self._refreshed_at = now
+            self._mirror.ensure_fresh(background=background)
+            # 先確認鏡像已完成第一次同步，再讀取變動，載入的資料才確定完整
+            ready = self._mirror.ready
+            generation, version, full, events = self._mirror.changes_since(self._generation, self._version)
+            if full:
+                self.load(events)
+                self.full_loads += 1
+            elif events:
+                self.apply_changes(events)
+                self.incremental_updates += 1
+            else:
+                self._roll_window(time.time())
+                self._expand_dirty()
+            self._generation, self._version = generation, version
+            self._loaded = ready
+
+    # --- 查詢 ---
+    def busy_between(self, start, end):
+        """回傳與 [start, end) 重疊的忙碌區間 (start, end)，start/end 為 epoch 秒"""
+        with self._lock:
+            starts = self._starts
+            i = bisect.bisect_left(starts, (start - self._max_length,))
+            result = []
+            while i < len(starts) and starts[i][0] < end:
+                busy_start, busy_end, _ = starts[i]
+                if busy_end > start:
+                    result.append((busy_start, busy_end))
+                i += 1
+            return result
+
+    def _business_hours(self, day):
+        window = self._windows.get(day)
+        if window is None:
+            if len(self._windows) > 400:
+                self._windows.clear()
+            if day.weekday() in self._weekdays:
+                window = (
+                    self._tz.localize(datetime.datetime.combine(day, datetime.time(self._open_hour))).timestamp(),
+                    self._tz.localize(datetime.datetime.combine(day, datetime.time(self._close_hour))).timestamp()
+                )
+            else:
+                window = ()
+            self._windows[day] = window
+        return window
+
+    def _business_windows(self, now, days):
+        today = datetime.datetime.fromtimestamp(now, self._tz).date()
+        for offset in range(days):
+            window = self._business_hours(today + datetime.timedelta(days=offset))
+            if window and window[1] > now:
+                opening, closing = window
+                yield max(opening, now), closing, opening
+
+    def next_free_slots(self, count=5, duration_minutes=60, now=None, days=14, refresh=True):
+        """
+        回傳接下來 count 個營業時間內、長度 duration_minutes 的空檔 [(start, end)]（datetime，當地時區）。
+        日曆鏡像尚未完成第一次同步（忙碌時段未知）時回傳 None。
+        """
+        if refresh:
+            self.refresh()
+        if self._mirror is not None and not self._loaded:
+            return None
+        now = time.time() if now is None else now
+        duration = duration_minutes * 60
+        step = self._slot_step
+        slots = []
+        for window_start, window_end, opening in self._business_windows(now, days):
+            # 空檔的開始時間對齊營業時間起點後的 slot_step
+            candidate = opening + -(-(window_start - opening) // step) * step
+            for busy_start, busy_end in self.busy_between(window_start, window_end):
+                while candidate + duration <= min(busy_start, window_end):
+                    slots.append((candidate, candidate + duration))
+                    if len(slots) >= count:
+                        return self._as_datetimes(slots)
+                    candidate += duration
+                if busy_end > candidate:
+                    candidate = opening + -(-(busy_end - opening) // step) * step
+            while candidate + duration <= window_end:
+                slots.append((candidate, candidate + duration))
+                if len(slots) >= count:
+                    return self._as_datetimes(slots)
+                candidate += duration
+        return self._as_datetimes(slots)
+
+    def _as_datetimes(self, slots):
+        return [
+            (datetime.datetime.fromtimestamp(start, self._tz), datetime.datetime.fromtimestamp(end, self._tz))
+            for start, end in slots
+        ]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'busy_intervals': len(self._starts),
+                'recurring_series': len(self._masters),
+                'full_loads': self.full_loads,
+                'incremental_updates': self.incremental_updates,
+                'version': self._version,
+                'loaded': self._loaded,
+            }
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+冷啟動基準測試：從啟動新的 Python 行程到 POST /callback 第一次回應 200 的時間（time-to-first-200）。
+每次都啟動全新的行程（與 Render 休眠後喚醒相同），取中位數與目標比較，超過目標時以結束碼 1 結束，
+可放在 CI 中防止啟動時間退步。第一次執行會開啟 STARTUP_PROFILE，列出匯入最久的套件。
+
+使用方式：
+    python bench_cold_start.py [執行次數] [目標秒數]
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+COLD_START_TARGET = float(os.getenv('COLD_START_TARGET', '3.0')) # time-to-first-200 目標（秒）
+CHANNEL_SECRET = 'benchmark'
+STARTUP_TIMEOUT = 60
+
+# 在子行程中載入 app 並以 werkzeug 提供服務（與 python app.py 相同，但不啟動排程與圖文選單設定）
+SERVER_CODE = """
+import sys
+import app
+from werkzeug.serving import make_server
+make_server('127.0.0.1', int(sys.argv[1]), app.app, threaded=True).serve_forever()
+"""
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _webhook_request(port):
+    # LINE 驗證 webhook 時送出的空事件
+    body = json.dumps({'destination': 'Ubenchmark', 'events': []}).encode()
+    signature = base64.b64encode(hmac.new(CHANNEL_SECRET.encode(), body, hashlib.sha256).digest()).decode()
+    return urllib.request.Request(
+        f"http://127.0.0.1:{port}/callback",
+        data=body,
+        headers={'Content-Type': 'application/json', 'X-Line-Signature': signature}
+    )
+
+
+def measure_once(data_dir, profile=False):
+    """回傳 (time-to-first-200 秒數, 子行程的 [startup] 輸出)"""
+    port = _free_port()
+    env = dict(
+        os.environ,
+        LINE_CHANNEL_SECRET=CHANNEL_SECRET,
+        LINE_CHANNEL_ACCESS_TOKEN='benchmark',
+        WEBHOOK_MODE='sync',
+        DATA_DIR=data_dir,
+        STARTUP_PROFILE='1' if profile else '0',
+        PYTHONDONTWRITEBYTECODE='0',
+    )
+    started = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, '-c', SERVER_CODE, str(port)],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True
+    )
+    try:
+        while True:
+            if proc.poll() is not None:
+                raise RuntimeError(f"伺服器啟動失敗：\n{proc.stderr.read()}")
+            if time.perf_counter() - started > STARTUP_TIMEOUT:
+                raise RuntimeError(f"{STARTUP_TIMEOUT} 秒內沒有回應")
+            try:
+                with urllib.request.urlopen(_webhook_request(port), timeout=5) as response:
+                    if response.status == 200:
+                        elapsed = time.perf_counter() - started
+                        break
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.01)
+    finally:
+        proc.terminate()
+        _, stderr = proc.communicate(timeout=10)
+    return elapsed, [line for line in stderr.splitlines() if line.startswith('[startup]')]
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    target = float(sys.argv[2]) if len(sys.argv) > 2 else COLD_START_TARGET
+
+    timings = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        for i in range(runs):
+            elapsed, profile = measure_once(data_dir, profile=(i == 0))
+            timings.append(elapsed)
+            if profile:
+                print("\n".join(profile))
+                print()
+            print(f"第 {i + 1} 次：{elapsed * 1000:.0f} ms")
+
+    median = statistics.median(timings)
+    print(f"\ntime-to-first-200：中位數 {median * 1000:.0f} ms，最快 {min(timings) * 1000:.0f} ms，"
+          f"最慢 {max(timings) * 1000:.0f} ms（目標 {target * 1000:.0f} ms）")
+    if median > target:
+        print("冷啟動時間超過目標")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+靜態選單快取基準測試：比較每次重建 Flex/Template 訊息與使用 menu_cache 的
+CPU 時間與記憶體配置量。每一欄都包含建立訊息與序列化整個回覆請求
+（與 SDK 送出時相同，呼叫請求的 to_dict()）：
+- 重建：每次重建訊息，以 ReplyMessageRequest 送出
+- 快取+SDK 請求：使用快取訊息，但仍以 ReplyMessageRequest 送出（pydantic 會重新序列化 messages）
+- 快取：使用快取訊息，以 message_request() 建立請求（直接使用預先序列化的 dict，實際送出的路徑）
+
+使用方式：
+    python bench_flex_cache.py [重複次數]
+"""
+
+import os
+import sys
+import timeit
+import tracemalloc
+
+# 匯入 app 需要 LINE_CHANNEL_SECRET，基準測試不會呼叫 LINE API
+os.environ.setdefault('LINE_CHANNEL_SECRET', 'benchmark')
+os.environ.setdefault('WEBHOOK_MODE', 'sync')
+
+import app
+from linebot.v3.messaging import ReplyMessageRequest
+from message_cache import message_request
+
+MENU_TEXT = "🙏 感恩您的提問！如還有其他需求，歡迎點選下方『返回主選單』繼續提問或預約其他服務 😊"
+
+CASES = [
+    ('main_services', app._build_main_services_flex, app.create_main_services_flex),
+    ('how_to_book', app._build_how_to_book_flex, app.create_how_to_book_flex),
+    ('ritual_prices', app._build_ritual_prices_flex, app.create_ritual_prices_flex),
+    ('text_with_menu_button',
+     lambda: app._build_text_with_menu_button(MENU_TEXT, alt_text="服務結束提醒"),
+     lambda: app.create_text_with_menu_button(MENU_TEXT, alt_text="服務結束提醒")),
+]
+
+
+def peak_bytes(func):
+    """單次呼叫的記憶體峰值"""
+    func()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print(f"{'訊息':<24} {'重建 (µs)':>12} {'快取+SDK 請求 (µs)':>20} {'快取 (µs)':>12} "
+          f"{'重建峰值 (KB)':>14} {'快取峰值 (KB)':>14}")
+    for name, build, cached in CASES:
+        uncached_call = lambda: ReplyMessageRequest(reply_token='benchmark', messages=[build()]).to_dict()
+        sdk_call = lambda: ReplyMessageRequest(reply_token='benchmark', messages=[cached()]).to_dict()
+        cached_call = lambda: message_request(ReplyMessageRequest, reply_token='benchmark', messages=[cached()]).to_dict()
+        uncached_us = timeit.timeit(uncached_call, number=number) / number * 1e6
+        sdk_us = timeit.timeit(sdk_call, number=number) / number * 1e6
+        cached_us = timeit.timeit(cached_call, number=number) / number * 1e6
+        uncached_kb = peak_bytes(uncached_call) / 1024
+        cached_kb = peak_bytes(cached_call) / 1024
+        print(f"{name:<24} {uncached_us:>12.1f} {sdk_us:>20.1f} {cached_us:>12.1f} {uncached_kb:>14.1f} {cached_kb:>14.1f}")
+    print(f"快取統計：{app.menu_cache.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+關鍵字路由微基準測試：比較原本 le_message 的 elif 鏈與編譯後的 KeywordRouter。
+
+使用方式：
+    python bench_keyword_router.py [每組訊息重複次數]
+"""
+
+import os
+import random
+import sys
+import timeit
+
+# 匯入 app 需要 LINE_CHANNEL_SECRET，基準測試不會呼叫 LINE API
+os.environ.setdefault('LINE_CHANNEL_SECRET', 'benchmark')
+os.environ.setdefault('WEBHOOK_MODE', 'sync')
+
+import app
+from keyword_router import KeywordRouter
+
+# 真實情境的中文訊息（已正規化：去空白、小寫）
+SAMPLE_MESSAGES = [
+    "法事",
+    "如何預約",
+    "老師您好，我想請問最近工作一直不順利，想問事，請問要準備什麼資料呢？",
+    "請問收驚要怎麼安排",
+    "想請老師幫我看一下家裡的風水，我們最近剛搬家",
+    "請給我匯款帳號，我今天下午會匯過去",
+    "謝謝老師！收到了🙏",
+    "我想知道最近的運勢文在哪裡看",
+    "老師我已經匯款了，末五碼是12345，麻煩老師確認一下，感恩",
+    "請問下個月還有開課程嗎？想報名法術課程",
+    "你好",
+    "我朋友介紹我來的，他說老師算命很準，想了解一下要怎麼開始",
+]
+
+
+def legacy_chain(msg):
+    """原本 le_message 的 elif 鏈（只回傳命中的分支名稱）"""
+    if "法事" in msg:
+        return "reply_ritual"
+    elif "問事" in msg or "命理" in msg:
+        return "reply_consultation"
+    elif "預約" in msg or "如何預約" in msg or "命理問事" in msg or "算命" in msg:
+        return "reply_how_to_book"
+    elif "收驚" in msg:
+        return "reply_shoujing"
+    elif "卜卦" in msg:
+        return "reply_divination"
+    elif "風水" in msg:
+        return "reply_fengshui"
+    elif "匯款" in msg or "匯款資訊" in msg or "帳號" in msg:
+        return "reply_payment"
+    elif "最新消息" in msg:
+        return "reply_latest_news"
+    elif "探索自我" in msg or "順流致富" in msg:
+        return "reply_explore_self"
+    elif "開運產品" in msg or "開運物" in msg:
+        return "reply_lucky_products"
+    elif "課程" in msg:
+        return "reply_courses"
+    elif "ig" in msg:
+        return "reply_ig"
+    elif "抖音" in msg:
+        return "reply_tiktok"
+    elif "運勢文" in msg:
+        return "reply_fortune_article"
+    elif "查詢可預約時間" in msg:
+        return "reply_available_times"
+    return None
+
+
+def router_match(msg):
+    route = app.keyword_router.match(msg)
+    return route.handler.__name__ if route else None
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    messages = [app.normalize_message(m) for m in SAMPLE_MESSAGES]
+
+    # 先確認兩者的路由結果一致
+    for msg in messages:
+        assert legacy_chain(msg) == router_match(msg), msg
+
+    print(f"{'訊息':<24} {'elif 鏈 (µs)':>14} {'router (µs)':>14}")
+    total_legacy = total_router = 0.0
+    for msg in messages:
+        legacy = timeit.timeit(lambda: legacy_chain(msg), number=number) / number * 1e6
+        router = timeit.timeit(lambda: router_match(msg), number=number) / number * 1e6
+        total_legacy += legacy
+        total_router += router
+        print(f"{msg[:12]:<24} {legacy:>14.3f} {router:>14.3f}")
+    print(f"{'平均':<24} {total_legacy / len(messages):>14.3f} {total_router / len(messages):>14.3f}")
+
+    # 關鍵字數量增加時的成長趨勢：elif 鏈隨關鍵字數線性變慢，router 只與訊息長度有關
+    print()
+    print(f"{'關鍵字數':<10} {'elif 鏈 (µs)':>14} {'router (µs)':>14}")
+    rng = random.Random(0)
+    charset = ''.join(sorted(set(''.join(SAMPLE_MESSAGES))))
+    for size in (25, 100, 400):
+        keywords = [''.join(rng.choice(charset) for _ in range(rng.randint(2, 4))) for _ in range(size)]
+        router = KeywordRouter([(idx, (keyword,), keyword) for idx, keyword in enumerate(keywords)])
+
+        def chain(msg):
+            for keyword in keywords:
+                if keyword in msg:
+                    return keyword
+            return None
+
+        legacy = sum(timeit.timeit(lambda: chain(msg), number=number // 10) for msg in messages)
+        compiled = sum(timeit.timeit(lambda: router.match(msg), number=number // 10) for msg in messages)
+        scale = 1e6 / (number // 10) / len(messages)
+        print(f"{size:<10} {legacy * scale:>14.3f} {compiled * scale:>14.3f}")
+
+
+if __name__ == "__main__":
+    main()
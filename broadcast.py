@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+群發引擎：
+將收件人每 500 人（LINE multicast 上限）分成一批，以有上限的並行數同時送出，
+回報每一批的成功/失敗，最後彙總送出、失敗、略過的人數。
+少量收件人（例如管理者通知）可用 push_each() 同時個別推播，取得每位收件人的結果。
+"""
+
+import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from linebot.v3.messaging import MulticastRequest, PushMessageRequest
+
+from line_client import get_messaging_api
+from message_cache import message_request
+
+logger = logging.getLogger(__name__)
+
+MULTICAST_LIMIT = 500 # LINE multicast 每次最多 500 位收件人
+USER_ID_PATTERN = re.compile(r'^U[0-9a-f]{32}$')
+
+
+def chunk_recipients(user_ids, size=MULTICAST_LIMIT):
+    """將收件人串流切成每批最多 size 人，並略過格式不正確的 ID"""
+    batch = []
+    skipped = 0
+    for user_id in user_ids:
+        if not user_id or not USER_ID_PATTERN.match(user_id):
+            skipped += 1
+            continue
+        batch.append(user_id)
+        if len(batch) >= size:
+            yield batch, skipped
+            batch, skipped = [], 0
+    if batch or skipped:
+        yield batch, skipped
+
+
+class BroadcastSummary:
+    """群發結果彙總"""
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.skipped = 0
+        self.batches = [] # 每一批的結果
+        self.started_at = time.monotonic()
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, batch_no, size, ok, error=None, elapsed=0.0):
+        with self._lock:
+            if ok:
+                self.sent += size
+            else:
+                self.failed += size
+            self.batches.append({'batch': batch_no, 'size': size, 'ok': ok, 'error': error, 'elapsed': round(elapsed, 3)})
+
+    def as_dict(self):
+        return {
+            'sent': self.sent,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'batches': len(self.batches),
+            'failed_batches': sum(1 for b in self.batches if not b['ok']),
+            'elapsed': round(self.elapsed, 2),
+        }
+
+
+def send_multicast_batch(user_ids, messages, retry_key=None):
+    """送出一批 multicast；retry_key 相同的請求 LINE 只會處理一次"""
+    get_messaging_api().multicast(
+        message_request(MulticastRequest, to=user_ids, messages=messages),
+        x_line_retry_key=retry_key
+    )
+
+
+def broadcast(user_ids, messages, concurrency=4, retry_key_for=None, on_batch_done=None, batches=None, is_success=None):
+    """
+    群發訊息給 user_ids（可為產生器），回傳 BroadcastSummary。
+    - concurrency：同時送出的批次數上限
+    - retry_key_for(batch_no)：回傳該批的 X-Line-Retry-Key（選填）
+    - on_batch_done(batch_no, user_ids, ok, error)：每批完成時呼叫（選填）
+    - batches：直接提供 (batch_no, user_ids) 的序列，取代 user_ids 的自動分批（選填）
+    - is_success(error)：回傳 True 時將該例外視為已送出（例如重複的 retry key）（選填）
+    """
+    summary = BroadcastSummary()
+
+    def run(batch_no, batch):
+        started = time.monotonic()
+        retry_key = retry_key_for(batch_no) if retry_key_for else None
+        try:
+            send_multicast_batch(batch, messages, retry_key=retry_key)
+            ok, error = True, None
+            logger.info(f"群發第 {batch_no} 批（{len(batch)} 人）已送出")
+        except Exception as e:
+            if is_success and is_success(e):
+                ok, error = True, None
+                logger.info(f"群發第 {batch_no} 批（{len(batch)} 人）先前已送出")
+            else:
+                ok, error = False, str(e)
+                logger.error(f"群發第 {batch_no} 批（{len(batch)} 人）失敗: {e}")
+        summary.record(batch_no, len(batch), ok, error, time.monotonic() - started)
+        if on_batch_done:
+            on_batch_done(batch_no, batch, ok, error)
+
+    if batches is None:
+        def numbered():
+            for batch_no, (batch, skipped) in enumerate(chunk_recipients(user_ids)):
+                summary.skipped += skipped
+                if batch:
+                    yield batch_no, batch
+        batches = numbered()
+
+    # 只保留有限數量的批次在處理中，收件人以串流方式讀取，記憶體用量固定
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix='broadcast') as pool:
+        in_flight = set()
+        for batch_no, batch in batches:
+            if len(in_flight) >= concurrency:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            in_flight.add(pool.submit(run, batch_no, batch))
+        wait(in_flight)
+
+    summary.elapsed = time.monotonic() - summary.started_at
+    return summary
+
+
+def push_each(user_ids, messages, concurrency=4, retry_key_for=None, is_success=None):
+    """
+    以共用的 LINE 用戶端同時推播給每位收件人，回傳 {user_id: None（已送出）或錯誤訊息}。
+    - concurrency：同時送出的推播數上限
+    - retry_key_for(user_id)：回傳該收件人的 X-Line-Retry-Key（選填）
+    - is_success(error)：回傳 True 時將該例外視為已送出（例如重複的 retry key）（選填）
+    """
+    recipients = list(dict.fromkeys(user_id for user_id in user_ids if user_id)) # 去除空白與重複的 ID
+
+    def run(user_id):
+        try:
+            get_messaging_api().push_message(
+                message_request(PushMessageRequest, to=user_id, messages=messages),
+                x_line_retry_key=retry_key_for(user_id) if retry_key_for else None
+            )
+            return None
+        except Exception as e:
+            if is_success and is_success(e):
+                return None
+            return str(e)
+
+    if not recipients:
+        return {}
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(recipients))), thread_name_prefix='push') as pool:
+        return dict(zip(recipients, pool.map(run, recipients)))
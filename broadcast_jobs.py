@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+"""
+可續傳的群發工作：
+- 每次群發是一個有 job_id 的工作，收件人分批與每批的送出狀態都存在本機 SQLite
+- 行程中斷後重新執行同一個 job_id，只會送出尚未完成的批次
+- 每批使用由 job_id 與批次編號產生的固定 X-Line-Retry-Key，
+  即使在「已送出但尚未記錄」時中斷，重送時 LINE 也會拒絕重複的請求（409），不會重複發送
+- 同一個工作同時只會有一次執行（以租約 lease 控制；每次執行使用各自的 owner，
+  同一個行程中的兩個執行緒也不會同時執行同一個工作）
+- 工作建立後 BROADCAST_JOB_TTL 秒（預設 24 小時，與 X-Line-Retry-Key 的有效期間相同）過期；
+  過期的工作不再續傳而標記為 abandoned，避免過期的內容、以及超過重試金鑰期限後重複發送
+- 每批最多嘗試 BROADCAST_BATCH_MAX_ATTEMPTS 次，仍失敗的批次不再重送
+
+命令列用法：
+    python broadcast_jobs.py start --text "訊息內容" [--job-id ID]
+    python broadcast_jobs.py status [JOB_ID]
+    python broadcast_jobs.py resume JOB_ID
+    python broadcast_jobs.py resume-all
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import sys
+import time
+import uuid
+
+from dotenv import load_dotenv
+from linebot.v3.messaging import Message, TextMessage
+from linebot.v3.messaging.exceptions import ApiException
+
+from broadcast import broadcast, chunk_recipients
+from db import data_path, get_connection
+
+logger = logging.getLogger(__name__)
+
+JOBS_DB_PATH = None # 預設為資料目錄下的 broadcast_jobs.db（使用時才依 DATA_DIR 決定，命令列會先載入 .env）
+JOB_LEASE_SECONDS = int(os.getenv('BROADCAST_JOB_LEASE', '300')) # 執行中的工作多久沒有更新就視為中斷
+JOB_TTL = int(os.getenv('BROADCAST_JOB_TTL', '86400')) # 工作建立後多久過期（LINE 的 X-Line-Retry-Key 有效 24 小時）
+BATCH_MAX_ATTEMPTS = int(os.getenv('BROADCAST_BATCH_MAX_ATTEMPTS', '3')) # 每批最多嘗試次數
+PLAN_BATCH_SIZE = 500
+FINISHED_STATUSES = ('done', 'abandoned')
+
+
+def _conn():
+    conn = get_connection(JOBS_DB_PATH or data_path('broadcast_jobs.db'))
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS broadcast_jobs ('
+        ' job_id TEXT PRIMARY KEY,'
+        ' messages TEXT NOT NULL,'
+        ' status TEXT NOT NULL,' # planning / ready / running / done / abandoned（過期或批次重試次數用完）
+        ' cursor TEXT NOT NULL DEFAULT \'\',' # 分批規劃到哪一位收件人（依 user_id 排序）
+        ' planned_batches INTEGER NOT NULL DEFAULT 0,'
+        ' skipped INTEGER NOT NULL DEFAULT 0,'
+        ' owner TEXT,'
+        ' lease_until REAL NOT NULL DEFAULT 0,'
+        ' created_at REAL NOT NULL,'
+        ' updated_at REAL NOT NULL,'
+        ' expires_at REAL)'
+    )
+    # 舊版資料庫沒有 expires_at：以建立時間加上 JOB_TTL 補上
+    if 'expires_at' not in {row[1] for row in conn.execute('PRAGMA table_info(broadcast_jobs)')}:
+        conn.execute('ALTER TABLE broadcast_jobs ADD COLUMN expires_at REAL')
+        conn.execute('UPDATE broadcast_jobs SET expires_at = created_at + ?', (JOB_TTL,))
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS broadcast_batches ('
+        ' job_id TEXT NOT NULL,'
+        ' batch_no INTEGER NOT NULL,'
+        ' user_ids TEXT NOT NULL,'
+        ' size INTEGER NOT NULL,'
+        ' status TEXT NOT NULL,' # pending / sent / failed
+        ' attempts INTEGER NOT NULL DEFAULT 0,'
+        ' error TEXT,'
+        ' updated_at REAL NOT NULL,'
+        ' PRIMARY KEY (job_id, batch_no))'
+    )
+    return conn
+
+
+def batch_retry_key(job_id, batch_no):
+    """同一個工作的同一批永遠產生相同的 X-Line-Retry-Key"""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"xuantian-broadcast/{job_id}/{batch_no}"))
+
+
+def _new_owner():
+    """每次執行產生不同的租約持有者（主機:PID:隨機值）"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+
+
+def create_job(job_id, messages, expires_at=None):
+    """
+    建立工作（若 job_id 已存在則沿用原本的工作），回傳 job_id。
+    expires_at：工作的過期時間（epoch 秒，選填）；不會晚於建立後 JOB_TTL 秒
+    """
+    now = time.time()
+    expires_at = min(expires_at or now + JOB_TTL, now + JOB_TTL)
+    payload = json.dumps([message.to_dict() for message in messages], ensure_ascii=False)
+    _conn().execute(
+        'INSERT OR IGNORE INTO broadcast_jobs (job_id, messages, status, created_at, updated_at, expires_at) '
+        'VALUES (?, ?, ?, ?, ?, ?)',
+        (job_id, payload, 'planning', now, now, expires_at)
+    )
+    return job_id
+
+
+def abandon_expired_jobs():
+    """將已過期、且沒有執行中的未完成工作標記為 abandoned，回傳這些工作的 job_id"""
+    now = time.time()
+    conn = _conn()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        rows = conn.execute(
+            'SELECT job_id FROM broadcast_jobs WHERE status NOT IN (?, ?) AND expires_at <= ? '
+            'AND (owner IS NULL OR lease_until < ?)',
+            (*FINISHED_STATUSES, now, now)
+        ).fetchall()
+        job_ids = [row[0] for row in rows]
+        conn.executemany(
+            'UPDATE broadcast_jobs SET status = \'abandoned\', owner = NULL, lease_until = 0, updated_at = ? '
+            'WHERE job_id = ?',
+            [(now, job_id) for job_id in job_ids]
+        )
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    for job_id in job_ids:
+        logger.warning(f"群發工作 {job_id} 已過期，不再續傳（標記為 abandoned）")
+    return job_ids
+
+
+def _claim(job_id, owner):
+    """取得工作的執行租約；其他執行（不論是否在同一個行程）正在進行時回傳 False"""
+    now = time.time()
+    cur = _conn().execute(
+        'UPDATE broadcast_jobs SET owner = ?, lease_until = ?, updated_at = ? '
+        'WHERE job_id = ? AND status NOT IN (?, ?) AND expires_at > ? AND (owner IS NULL OR lease_until < ?)',
+        (owner, now + JOB_LEASE_SECONDS, now, job_id, *FINISHED_STATUSES, now, now)
+    )
+    return cur.rowcount > 0
+
+
+def _renew(job_id, owner):
+    now = time.time()
+    _conn().execute(
+        'UPDATE broadcast_jobs SET lease_until = ?, updated_at = ? WHERE job_id = ? AND owner = ?',
+        (now + JOB_LEASE_SECONDS, now, job_id, owner)
+    )
+
+
+def _plan(job_id, recipients_after, owner):
+    """將收件人分批寫入資料庫；中斷後從 cursor 之後繼續規劃"""
+    conn = _conn()
+    row = conn.execute(
+        'SELECT status, cursor, planned_batches FROM broadcast_jobs WHERE job_id = ?', (job_id,)
+    ).fetchone()
+    status, cursor, batch_no = row
+    if status != 'planning':
+        return
+    for batch, skipped in chunk_recipients(recipients_after(cursor), PLAN_BATCH_SIZE):
+        now = time.time()
+        conn.execute('BEGIN')
+        if batch:
+            conn.execute(
+                'INSERT OR IGNORE INTO broadcast_batches (job_id, batch_no, user_ids, size, status, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (job_id, batch_no, json.dumps(batch), len(batch), 'pending', now)
+            )
+            cursor = batch[-1]
+            batch_no += 1
+        conn.execute(
+            'UPDATE broadcast_jobs SET cursor = ?, planned_batches = ?, skipped = skipped + ?, updated_at = ? WHERE job_id = ?',
+            (cursor, batch_no, skipped, now, job_id)
+        )
+        conn.execute('COMMIT')
+        _renew(job_id, owner)
+    conn.execute('UPDATE broadcast_jobs SET status = ?, updated_at = ? WHERE job_id = ?', ('ready', time.time(), job_id))
+
+
+def _pending_batches(job_id, expires_at):
+    """
+    逐批讀出尚未送出成功、且還有重試次數的批次（每次查詢少量批次，記憶體用量固定）。
+    工作在送出途中過期時停止，剩下的批次不再送出。
+    """
+    conn = _conn()
+    last = -1
+    while time.time() < expires_at:
+        rows = conn.execute(
+            'SELECT batch_no, user_ids FROM broadcast_batches '
+            'WHERE job_id = ? AND status != \'sent\' AND attempts < ? AND batch_no > ? ORDER BY batch_no LIMIT 20',
+            (job_id, BATCH_MAX_ATTEMPTS, last)
+        ).fetchall()
+        if not rows:
+            return
+        for batch_no, user_ids in rows:
+            yield batch_no, json.loads(user_ids)
+        last = rows[-1][0]
+
+
+def _is_duplicate_retry(error):
+    # 相同 X-Line-Retry-Key 的請求已被 LINE 接受過：代表該批其實已送出
+    return isinstance(error, ApiException) and error.status == 409
+
+
+def run_job(job_id, recipients_after, concurrency=4):
+    """
+    執行（或續傳）工作，回傳該次執行的摘要；工作已完成、已過期或正在執行中時回傳 None。
+    recipients_after(cursor)：回傳 user_id 大於 cursor、依 user_id 排序的收件人產生器
+    """
+    abandon_expired_jobs()
+    owner = _new_owner()
+    if not _claim(job_id, owner):
+        logger.info(f"群發工作 {job_id} 已完成、已過期或正在執行中，略過")
+        return None
+    conn = _conn()
+    _plan(job_id, recipients_after, owner)
+    conn.execute('UPDATE broadcast_jobs SET status = ?, updated_at = ? WHERE job_id = ?', ('running', time.time(), job_id))
+    payload, expires_at = conn.execute(
+        'SELECT messages, expires_at FROM broadcast_jobs WHERE job_id = ?', (job_id,)
+    ).fetchone()
+    messages = [Message.from_dict(item) for item in json.loads(payload)]
+
+    def on_batch_done(batch_no, user_ids, ok, error):
+        # 每批完成立即記錄（checkpoint）
+        _conn().execute(
+            'UPDATE broadcast_batches SET status = ?, attempts = attempts + 1, error = ?, updated_at = ? '
+            'WHERE job_id = ? AND batch_no = ?',
+            ('sent' if ok else 'failed', error, time.time(), job_id, batch_no)
+        )
+        _renew(job_id, owner)
+
+    summary = broadcast(
+        None,
+        messages,
+        concurrency=concurrency,
+        retry_key_for=lambda batch_no: batch_retry_key(job_id, batch_no),
+        on_batch_done=on_batch_done,
+        batches=_pending_batches(job_id, expires_at),
+        is_success=_is_duplicate_retry
+    )
+
+    unsent, remaining = conn.execute(
+        'SELECT COUNT(*), COUNT(CASE WHEN attempts < ? THEN 1 END) FROM broadcast_batches '
+        'WHERE job_id = ? AND status != \'sent\'',
+        (BATCH_MAX_ATTEMPTS, job_id)
+    ).fetchone()
+    if unsent == 0:
+        status = 'done'
+    elif remaining == 0 or time.time() >= expires_at:
+        # 失敗的批次已用完重試次數，或工作已過期：不再續傳
+        status = 'abandoned'
+        logger.warning(f"群發工作 {job_id} 仍有 {unsent} 批未送出，已停止重試（標記為 abandoned）")
+    else:
+        status = 'ready'
+    conn.execute(
+        'UPDATE broadcast_jobs SET status = ?, owner = NULL, lease_until = 0, updated_at = ? WHERE job_id = ? AND owner = ?',
+        (status, time.time(), job_id, owner)
+    )
+    result = summary.as_dict()
+    result.update(job_id=job_id, status=status, remaining_batches=unsent)
+    logger.info(f"群發工作 {job_id} 執行結束：{result}")
+    return result
+
+
+def job_status(job_id):
+    """回傳工作狀態與各狀態的批次/人數統計"""
+    conn = _conn()
+    row = conn.execute(
+        'SELECT job_id, status, planned_batches, skipped, owner, lease_until, created_at, updated_at, expires_at '
+        'FROM broadcast_jobs WHERE job_id = ?', (job_id,)
+    ).fetchone()
+    if row is None:
+        return None
+    counts = {
+        status: {'batches': batches, 'recipients': recipients}
+        for status, batches, recipients in conn.execute(
+            'SELECT status, COUNT(*), SUM(size) FROM broadcast_batches WHERE job_id = ? GROUP BY status', (job_id,)
+        )
+    }
+    return {
+        'job_id': row[0],
+        'status': row[1],
+        'planned_batches': row[2],
+        'skipped': row[3],
+        'owner': row[4],
+        'lease_until': row[5],
+        'created_at': row[6],
+        'updated_at': row[7],
+        'expires_at': row[8],
+        'batches': counts,
+    }
+
+
+def list_jobs(limit=20):
+    rows = _conn().execute(
+        'SELECT job_id FROM broadcast_jobs ORDER BY created_at DESC LIMIT ?', (limit,)
+    ).fetchall()
+    return [job_status(row[0]) for row in rows]
+
+
+def unfinished_jobs():
+    """尚未完成、也還沒過期的工作"""
+    rows = _conn().execute(
+        'SELECT job_id FROM broadcast_jobs WHERE status NOT IN (?, ?) AND expires_at > ? ORDER BY created_at',
+        (*FINISHED_STATUSES, time.time())
+    ).fetchall()
+    return [row[0] for row in rows]
+
+
+def _follower_recipients():
+    # 延遲匯入，避免命令列工具載入整個 Flask app
+    from follower_store import FollowerStore
+    store = FollowerStore(data_path('followers.db'))
+
+    def recipients_after(cursor):
+        for batch in store.iter_batches(PLAN_BATCH_SIZE, after=cursor):
+            yield from batch
+    return recipients_after
+
+
+def resume_unfinished_jobs(recipients_after=None, concurrency=4):
+    """續傳所有未完成的工作（服務重啟後呼叫）；已過期的工作標記為 abandoned，不再續傳"""
+    recipients_after = recipients_after or _follower_recipients()
+    abandon_expired_jobs()
+    results = []
+    for job_id in unfinished_jobs():
+        result = run_job(job_id, recipients_after, concurrency=concurrency)
+        if result:
+            results.append(result)
+    return results
+
+
+def main(argv=None):
+    # 與 app.py / scheduler.py 相同，從 .env 讀取 LINE_CHANNEL_ACCESS_TOKEN、DATA_DIR 等設定
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='可續傳的 LINE 群發工作')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    start = sub.add_parser('start', help='建立並執行新的群發工作')
+    start.add_argument('--text', required=True, help='要群發的文字訊息')
+    start.add_argument('--job-id', help='工作 ID（預設自動產生）')
+    start.add_argument('--concurrency', type=int, default=4)
+
+    status = sub.add_parser('status', help='查看工作狀態')
+    status.add_argument('job_id', nargs='?')
+
+    resume = sub.add_parser('resume', help='續傳指定的工作')
+    resume.add_argument('job_id')
+    resume.add_argument('--concurrency', type=int, default=4)
+
+    resume_all = sub.add_parser('resume-all', help='續傳所有未完成的工作')
+    resume_all.add_argument('--concurrency', type=int, default=4)
+
+    args = parser.parse_args(argv)
+    if args.command == 'start':
+        job_id = args.job_id or f"manual-{time.strftime('%Y%m%d-%H%M%S')}"
+        create_job(job_id, [TextMessage(text=args.text)])
+        result = run_job(job_id, _follower_recipients(), concurrency=args.concurrency)
+    elif args.command == 'status':
+        result = job_status(args.job_id) if args.job_id else list_jobs()
+    elif args.command == 'resume':
+        if job_status(args.job_id) is None:
+            print(f"找不到工作 {args.job_id}", file=sys.stderr)
+            return 1
+        result = run_job(args.job_id, _follower_recipients(), concurrency=args.concurrency)
+    else:
+        result = resume_unfinished_jobs(concurrency=args.concurrency)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
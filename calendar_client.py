@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+共用的 Google Calendar 用戶端：
+- 憑證與 service 物件在整個行程只建立一次（第一次使用時才建立）
+- 使用套件內建的 discovery 文件（static discovery），建立 service 時不需連網
+- 同一組憑證重複使用 access token，到期前才重新取得
+- 每個執行緒一個保持連線的 HTTP 物件（httplib2 不是執行緒安全的）
+- iter_event_pages() 以常駐的小型執行緒池同時分頁取回多個日曆的事件，逐頁產生結果；
+  執行緒池在整個行程共用，每次同步都重複使用各執行緒已建立的 HTTP 連線
+- Google 相關套件在第一次使用時才匯入，不影響 web 服務的冷啟動時間
+"""
+
+import json
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+SCOPES = ['https://www.googleapis.com/auth/calendar.readonly']
+GOOGLE_HTTP_TIMEOUT = float(os.getenv('GOOGLE_HTTP_TIMEOUT', '15'))
+GOOGLE_API_RETRIES = int(os.getenv('GOOGLE_API_RETRIES', '2')) # 5xx / 連線錯誤時的重試次數
+CALENDAR_FETCH_WORKERS = int(os.getenv('CALENDAR_FETCH_WORKERS', '4')) # 同時取回的日曆數上限
+PAGE_SIZE = 2500 # events.list 每頁最多筆數
+
+_lock = threading.Lock()
+_credentials = None
+_service = None
+_generation = 0 # reset() 後遞增，讓各執行緒重新建立 HTTP 物件
+_local = threading.local()
+_fetch_pool = None
+_fetch_pool_pid = None
+
+
+def _load_credentials_info():
+    """讀取服務帳號 JSON：GOOGLE_CREDENTIALS 為 JSON 內容；GOOGLE_CREDENTIALS_JSON 可為 JSON 內容或檔案路徑"""
+    value = os.getenv('GOOGLE_CREDENTIALS') or os.getenv('GOOGLE_CREDENTIALS_JSON')
+    if not value:
+        return None
+    value = value.strip()
+    if value.startswith('{'):
+        return json.loads(value)
+    with open(value, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def get_credentials():
+    """取得共用的服務帳號憑證；未設定時回傳 None"""
+    global _credentials
+    if _credentials is None:
+        with _lock:
+            if _credentials is None:
+                info = _load_credentials_info()
+                if info is None:
+                    return None
+                from google.oauth2 import service_account
+                _credentials = service_account.Credentials.from_service_account_info(info, scopes=SCOPES)
+    return _credentials
+
+
+def get_calendar_service():
+    """取得共用的 Calendar service；未設定憑證時回傳 None"""
+    global _service
+    if _service is None:
+        credentials = get_credentials()
+        if credentials is None:
+            return None
+        with _lock:
+            if _service is None:
+                from googleapiclient.discovery import build
+                _service = build(
+                    'calendar', 'v3',
+                    credentials=credentials,
+                    static_discovery=True,
+                    cache_discovery=False
+                )
+                logger.info("Google Calendar 用戶端已建立")
+    return _service
+
+
+def _http():
+    """目前執行緒專用、帶有共用憑證的 HTTP 物件"""
+    cached = getattr(_local, 'http', None)
+    if cached is not None and cached[0] == _generation:
+        return cached[1]
+    import google_auth_httplib2
+    import httplib2
+    http = google_auth_httplib2.AuthorizedHttp(get_credentials(), http=httplib2.Http(timeout=GOOGLE_HTTP_TIMEOUT))
+    _local.http = (_generation, http)
+    return http
+
+
+def execute(request):
+    """以目前執行緒的連線執行 API 請求"""
+    return request.execute(http=_http(), num_retries=GOOGLE_API_RETRIES)
+
+
+def calendar_ids(value=None):
+    """解析以逗號分隔的日曆 ID（預設讀取 GOOGLE_CALENDAR_ID）"""
+    value = os.getenv('GOOGLE_CALENDAR_ID', '') if value is None else value
+    if isinstance(value, str):
+        value = value.split(',')
+    return [calendar_id.strip() for calendar_id in value if calendar_id and calendar_id.strip()]
+
+
+def _put(out, item, stop):
+    # 使用者提前停止讀取時，不要讓背景執行緒永遠卡在 put
+    while not stop.is_set():
+        try:
+            out.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _fetch_pages(calendar_id, params, out, stop):
+    try:
+        service = get_calendar_service()
+        if service is None:
+            raise RuntimeError("未設定 Google 憑證")
+        page_token = None
+        while not stop.is_set():
+            page = execute(service.events().list(
+                calendarId=calendar_id,
+                maxResults=PAGE_SIZE,
+                pageToken=page_token,
+                **params
+            ))
+            page_token = page.get('nextPageToken')
+            if not _put(out, (calendar_id, page, None), stop) or not page_token:
+                return
+    except Exception as e:
+        _put(out, (calendar_id, None, e), stop)
+
+
+def _get_fetch_pool():
+    """整個行程共用的取回執行緒池（fork 之後在子行程重新建立）"""
+    global _fetch_pool, _fetch_pool_pid
+    if _fetch_pool is None or _fetch_pool_pid != os.getpid():
+        with _lock:
+            if _fetch_pool is None or _fetch_pool_pid != os.getpid():
+                _fetch_pool = ThreadPoolExecutor(
+                    max_workers=max(1, CALENDAR_FETCH_WORKERS),
+                    thread_name_prefix='calendar-fetch'
+                )
+                _fetch_pool_pid = os.getpid()
+    return _fetch_pool
+
+
+def iter_event_pages(requests):
+    """
+    同時分頁取回多個日曆的事件，依到達順序產生 (calendar_id, page, error)。
+    requests：{calendar_id: events.list 的參數}
+    - 每頁都會產生一次；同一日曆的頁面依序到達，最後一頁沒有 nextPageToken
+    - 某個日曆出錯時產生 (calendar_id, None, 例外)，不影響其他日曆
+    - 同時取回的日曆數由共用執行緒池的大小（CALENDAR_FETCH_WORKERS）限制
+    """
+    if not requests:
+        return
+    out = queue.Queue(maxsize=max(2, 2 * CALENDAR_FETCH_WORKERS)) # 有上限：讀取較慢時背景執行緒會暫停取下一頁
+    stop = threading.Event()
+    pool = _get_fetch_pool()
+    try:
+        for calendar_id, params in requests.items():
+            pool.submit(_fetch_pages, calendar_id, params, out, stop)
+        remaining = len(requests)
+        while remaining:
+            calendar_id, page, error = out.get()
+            if error is not None or not page.get('nextPageToken'):
+                remaining -= 1
+            yield calendar_id, page, error
+    finally:
+        stop.set() # 提前停止讀取時讓背景工作結束，執行緒留在池中供下次使用
+
+
+def reset():
+    """清除快取的憑證與 service（例如更換憑證後）"""
+    global _credentials, _service, _generation
+    with _lock:
+        _credentials = None
+        _service = None
+        _generation += 1
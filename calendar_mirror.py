@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+"""
+Google Calendar 本機鏡像：
+- 第一次以完整清單（full sync）把事件存進 SQLite，之後只用 syncToken 取回變動（incremental sync）
+- 可同時鏡像多個日曆（GOOGLE_CALENDAR_ID 以逗號分隔），各日曆並行分頁取回，每頁到達就處理
+- 重複事件只存 master（singleEvents=False），查詢時由 recurrence 模組在本機展開成各次事件
+- 變動包含已刪除/取消的事件（showDeleted），取消的事件保留為標記，讓 changes_since() 的使用者也能得知
+- 每次同步遞增 version，完整同步遞增 generation，其他元件（例如可預約時間索引）可據此只套用變動
+- syncToken 失效（410 Gone）時清除該日曆的鏡像並重新完整同步
+- 查詢直接讀本機資料庫，超過 sync_interval 秒才向 Google 同步一次；同步失敗時沿用現有資料
+- 各日曆分別判斷是否需要同步；同步失敗的日曆同樣等 sync_interval 秒後才重試，不會每次查詢都重新同步
+"""
+
+import datetime
+import json
+import logging
+import threading
+import time
+
+import calendar_client
+from db import get_connection
+from recurrence import (
+    TW_TIMEZONE,
+    RecurrenceExpander,
+    event_timestamp,
+    expand_events,
+    is_master,
+    original_start_timestamp,
+    series_end
+)
+
+logger = logging.getLogger(__name__)
+
+# 無限重複事件的結束時間（9999-12-31）
+FOREVER = 253402300799.0
+# 同步參數：重複事件只取 master；取消的事件（含取消的單次）也要取回
+SYNC_PARAMS = {'singleEvents': False, 'showDeleted': True}
+
+
+def _is_gone(error):
+    resp = getattr(error, 'resp', None)
+    return getattr(resp, 'status', None) == 410
+
+
+class CalendarMirror:
+    """以 syncToken 增量同步的日曆鏡像（可包含多個日曆）"""
+
+    def __init__(self, db_path, calendar_ids, sync_interval=300, window_days=31):
+        self._db_path = db_path
+        self._calendar_ids = calendar_client.calendar_ids(calendar_ids)
+        self._sync_interval = sync_interval
+        self._window_days = window_days # 完整同步時往回抓的天數
+        self._sync_lock = threading.Lock()
+        self._checked_at = 0.0
+        self._failed_at = {} # calendar_id -> 最近一次同步失敗的時間（本行程）
+        self._ready = False
+        self._expander = RecurrenceExpander()
+        # 統計數據
+        self.full_syncs = 0
+        self.incremental_syncs = 0
+        self.sync_errors = 0
+        self._init_db()
+
+    @property
+    def calendar_ids(self):
+        return list(self._calendar_ids)
+
+    def _init_db(self):
+        conn = get_connection(self._db_path)
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS calendar_events ('
+            ' calendar_id TEXT NOT NULL,'
+            ' event_id TEXT NOT NULL,'
+            ' start_ts REAL,'
+            ' end_ts REAL,'
+            ' data TEXT NOT NULL,'
+            ' cancelled INTEGER NOT NULL DEFAULT 0,'
+            ' version INTEGER NOT NULL DEFAULT 0,'
+            ' series_id TEXT,' # 例外事件所屬的重複事件 ID
+            ' original_ts REAL,' # 例外事件原本那一次的開始時間
+            ' PRIMARY KEY (calendar_id, event_id))'
+        )
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS calendar_sync ('
+            ' calendar_id TEXT PRIMARY KEY,'
+            ' sync_token TEXT,'
+            ' synced_at REAL NOT NULL,'
+            ' version INTEGER NOT NULL DEFAULT 0,'
+            ' generation INTEGER NOT NULL DEFAULT 0)'
+        )
+        # 舊版資料庫缺少的欄位：補上欄位並清除 syncToken，下次同步時以目前的參數完整重建
+        migrations = (
+            ('calendar_events', 'cancelled', 'INTEGER NOT NULL DEFAULT 0'),
+            ('calendar_events', 'version', 'INTEGER NOT NULL DEFAULT 0'),
+            ('calendar_events', 'series_id', 'TEXT'),
+            ('calendar_events', 'original_ts', 'REAL'),
+            ('calendar_sync', 'version', 'INTEGER NOT NULL DEFAULT 0'),
+            ('calendar_sync', 'generation', 'INTEGER NOT NULL DEFAULT 0'),
+        )
+        for table, column, definition in migrations:
+            existing = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+            if column not in existing:
+                conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+                conn.execute('UPDATE calendar_sync SET sync_token = NULL')
+        conn.execute('CREATE INDEX IF NOT EXISTS calendar_events_start ON calendar_events (calendar_id, start_ts)')
+        conn.execute('CREATE INDEX IF NOT EXISTS calendar_events_version ON calendar_events (calendar_id, version)')
+        conn.execute('CREATE INDEX IF NOT EXISTS calendar_events_original ON calendar_events (calendar_id, original_ts)')
+
+    # --- 同步 ---
+    @staticmethod
+    def _row_times(item):
+        """回傳 (start_ts, end_ts)；重複事件以第一次的開始到最後一次的結束為範圍"""
+        start_ts = event_timestamp(item.get('start'))
+        end_ts = event_timestamp(item.get('end'))
+        if is_master(item):
+            try:
+                end_ts = series_end(item) or FOREVER
+            except Exception as e:
+                logger.warning(f"無法解析重複事件 {item.get('id')} 的規則，視為無限重複: {e}")
+                end_ts = FOREVER
+        return start_ts, end_ts
+
+    def _apply(self, calendar_id, items, sync_token, full):
+        now = time.time()
+        conn = get_connection(self._db_path)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT version, generation FROM calendar_sync WHERE calendar_id = ?', (calendar_id,)
+            ).fetchone()
+            version, generation = row if row else (0, 0)
+            version += 1
+            if full:
+                generation += 1
+                conn.execute('DELETE FROM calendar_events WHERE calendar_id = ?', (calendar_id,))
+            for item in items:
+                cancelled = item.get('status') == 'cancelled'
+                series_id = item.get('recurringEventId')
+                # 完整同步時只需保留取消的單次（用來排除重複事件的那一次）
+                if cancelled and full and not series_id:
+                    continue
+                item['calendarId'] = calendar_id
+                start_ts, end_ts = self._row_times(item)
+                conn.execute(
+                    'INSERT OR REPLACE INTO calendar_events '
+                    '(calendar_id, event_id, start_ts, end_ts, data, cancelled, version, series_id, original_ts) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (calendar_id, item['id'], start_ts, end_ts, json.dumps(item, ensure_ascii=False),
+                     1 if cancelled else 0, version, series_id,
+                     original_start_timestamp(item) if series_id else None)
+                )
+            conn.execute(
+                'INSERT OR REPLACE INTO calendar_sync (calendar_id, sync_token, synced_at, version, generation) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (calendar_id, sync_token, now, version, generation)
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _sync_states(self):
+        """calendar_id -> (sync_token, synced_at, version, generation)"""
+        rows = get_connection(self._db_path).execute(
+            'SELECT calendar_id, sync_token, synced_at, version, generation FROM calendar_sync'
+        ).fetchall()
+        states = {row[0]: row[1:] for row in rows}
+        return {calendar_id: states.get(calendar_id, (None, 0.0, 0, 0)) for calendar_id in self._calendar_ids}
+
+    def _full_params(self):
+        time_min = datetime.datetime.now(TW_TIMEZONE) - datetime.timedelta(days=self._window_days)
+        return dict(SYNC_PARAMS, timeMin=time_min.isoformat())
+
+    def _fetch(self, requests):
+        """並行取回各日曆的事件並寫入鏡像；回傳 (取回的事件數, syncToken 失效的日曆, 其他錯誤)"""
+        pages = {calendar_id: [] for calendar_id in requests}
+        count = 0
+        gone = []
+        errors = []
+        for calendar_id, page, error in calendar_client.iter_event_pages(requests):
+            if error is not None:
+                if _is_gone(error):
+                    gone.append(calendar_id)
+                else:
+                    errors.append((calendar_id, error))
+                    self._failed_at[calendar_id] = time.time()
+                continue
+            pages[calendar_id].extend(page.get('items', []))
+            if page.get('nextPageToken'):
+                continue
+            # 該日曆的最後一頁：一次寫入，讓鏡像不會停在半同步的狀態
+            items = pages.pop(calendar_id)
+            full = 'syncToken' not in requests[calendar_id]
+            sync_token = page.get('nextSyncToken')
+            if full and not sync_token:
+                logger.warning(f"日曆 {calendar_id} 完整同步沒有取得 syncToken，下次仍會完整同步")
+            self._apply(calendar_id, items, sync_token, full)
+            self._failed_at.pop(calendar_id, None)
+            count += len(items)
+            if full:
+                self.full_syncs += 1
+                logger.info(f"日曆 {calendar_id} 完整同步完成，共 {len(items)} 筆事件")
+            else:
+                self.incremental_syncs += 1
+                if items:
+                    logger.info(f"日曆 {calendar_id} 增量同步：{len(items)} 筆變動")
+        return count, gone, errors
+
+    def sync(self, calendar_ids=None):
+        """
+        有 syncToken 的日曆增量同步，其餘（或 token 失效時）完整同步；回傳取回的事件數。
+        calendar_ids：只同步這些日曆（預設全部）
+        """
+        with self._sync_lock:
+            requests = {}
+            for calendar_id, (sync_token, _, _, _) in self._sync_states().items():
+                if calendar_ids is not None and calendar_id not in calendar_ids:
+                    continue
+                if sync_token:
+                    requests[calendar_id] = dict(SYNC_PARAMS, syncToken=sync_token)
+                else:
+                    requests[calendar_id] = self._full_params()
+            count, gone, errors = self._fetch(requests)
+            if gone:
+                logger.info(f"日曆 {', '.join(gone)} 的 syncToken 已失效，重新完整同步")
+                retried, _, more_errors = self._fetch({calendar_id: self._full_params() for calendar_id in gone})
+                count += retried
+                errors.extend(more_errors)
+            if errors:
+                calendar_id, error = errors[0]
+                raise RuntimeError(f"同步日曆 {calendar_id} 失敗: {error}") from error
+            return count
+
+    def full_sync(self):
+        """清除鏡像並重新取回所有日曆的完整清單"""
+        with self._sync_lock:
+            count, _, errors = self._fetch({calendar_id: self._full_params() for calendar_id in self._calendar_ids})
+            if errors:
+                calendar_id, error = errors[0]
+                raise RuntimeError(f"同步日曆 {calendar_id} 失敗: {error}") from error
+            return count
+
+    def _sync_quietly(self, calendar_ids=None):
+        try:
+            self.sync(calendar_ids)
+        except Exception as e:
+            self.sync_errors += 1
+            logger.error(f"同步日曆時出錯，使用現有鏡像資料（{self._sync_interval} 秒後重試）: {e}")
+
+    def _synced_at(self):
+        # 以最久沒同步的日曆為準
+        return min((state[1] for state in self._sync_states().values()), default=0.0)
+
+    @property
+    def ready(self):
+        """所有日曆都至少同步成功過一次"""
+        if not self._ready:
+            self._ready = all(state[1] for state in self._sync_states().values())
+        return self._ready
+
+    def ensure_fresh(self, background=False):
+        """
+        同步距離上次同步（或上次同步失敗）超過 sync_interval 秒的日曆（成功的同步時間由所有 worker 共用）；
+        失敗時沿用現有資料，等 sync_interval 秒後才重試。
+        background=True 時在背景執行緒同步、立即返回（從未同步過也不等待，請以 ready 判斷資料是否可用）。
+        """
+        now = time.time()
+        if now - self._checked_at < self._sync_interval:
+            return
+        # 各日曆最後一次成功同步或同步失敗的時間
+        attempted = {
+            calendar_id: max(state[1], self._failed_at.get(calendar_id, 0.0))
+            for calendar_id, state in self._sync_states().items()
+        }
+        due = [calendar_id for calendar_id, at in attempted.items() if now - at >= self._sync_interval]
+        if not due:
+            self._checked_at = min(attempted.values(), default=now)
+            return
+        # 同步結束前（或失敗後的 sync_interval 秒內）不再重複觸發
+        self._checked_at = now
+        if background:
+            threading.Thread(target=self._sync_quietly, args=(due,), name='calendar-sync', daemon=True).start()
+            return
+        self._sync_quietly(due)
+
+    # --- 查詢 ---
+    def _in_calendars(self):
+        return ','.join('?' * len(self._calendar_ids))
+
+    def events_between(self, start, end, refresh=True):
+        """
+        回傳與 [start, end) 重疊的各次事件（與 singleEvents=True 相同的格式，另加 calendarId），依開始時間排序。
+        重複事件在本機展開，被修改或取消的那一次以例外事件取代。
+        """
+        if refresh:
+            self.ensure_fresh()
+        start_ts, end_ts = start.timestamp(), end.timestamp()
+        conn = get_connection(self._db_path)
+        in_calendars = self._in_calendars()
+        rows = conn.execute(
+            f'SELECT calendar_id, event_id, data FROM calendar_events WHERE calendar_id IN ({in_calendars}) '
+            'AND cancelled = 0 AND start_ts < ? AND end_ts > ?',
+            (*self._calendar_ids, end_ts, start_ts)
+        ).fetchall()
+        # 原本那一次落在範圍內的例外事件（含取消的），即使已被移到範圍外也要用來排除原本那一次
+        rows += conn.execute(
+            f'SELECT calendar_id, event_id, data FROM calendar_events WHERE calendar_id IN ({in_calendars}) '
+            'AND original_ts >= ? AND original_ts < ?',
+            (*self._calendar_ids, start_ts, end_ts)
+        ).fetchall()
+        events = {(calendar_id, event_id): data for calendar_id, event_id, data in rows}
+        return expand_events([json.loads(data) for data in events.values()], start_ts, end_ts, self._expander)
+
+    def changes_since(self, generation, version):
+        """
+        回傳 (generation, version, full, 事件列表)，供其他元件增量更新；generation/version 請視為不透明的值。
+        曾完整同步時回傳所有事件且 full=True；否則只回傳 version 之後變動的事件（含已取消）。
+        """
+        states = self._sync_states()
+        current_generation = tuple(state[3] for state in states.values())
+        current_version = tuple(state[2] for state in states.values())
+        conn = get_connection(self._db_path)
+        if current_generation != generation:
+            rows = conn.execute(
+                # 取消的例外事件也要回傳，用來排除重複事件的那一次
+                f'SELECT data FROM calendar_events WHERE calendar_id IN ({self._in_calendars()}) '
+                'AND (cancelled = 0 OR series_id IS NOT NULL)',
+                self._calendar_ids
+            ).fetchall()
+            full = True
+        elif current_version != version:
+            rows = []
+            for calendar_id, seen, current in zip(self._calendar_ids, version, current_version):
+                if current != seen:
+                    rows.extend(conn.execute(
+                        'SELECT data FROM calendar_events WHERE calendar_id = ? AND version > ?', (calendar_id, seen)
+                    ).fetchall())
+            full = False
+        else:
+            return generation, version, False, []
+        return current_generation, current_version, full, [json.loads(row[0]) for row in rows]
+
+    def stats(self):
+        return {
+            'calendars': len(self._calendar_ids),
+            'synced_at': self._synced_at(),
+            'ready': self.ready,
+            'failing': sorted(self._failed_at),
+            'full_syncs': self.full_syncs,
+            'incremental_syncs': self.incremental_syncs,
+            'sync_errors': self.sync_errors,
+            'recurrence': self._expander.stats(),
+        }
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite 連線輔助：
+- 每條執行緒各自持有連線（sqlite3 連線不可跨執行緒共用）
+- 啟用 WAL 模式，讓多個 gunicorn worker 可以同時讀寫同一個檔案
+"""
+
+import os
+import sqlite3
+import threading
+
+_local = threading.local()
+
+
+def data_path(filename):
+    """
+    回傳資料目錄下的檔案路徑，必要時建立目錄。
+    資料目錄（DATA_DIR，預設 data，同一台機器上的所有 worker 共用）在呼叫時才讀取，
+    讓呼叫前以 load_dotenv() 載入的設定也會生效。
+    """
+    data_dir = os.getenv('DATA_DIR', 'data')
+    os.makedirs(data_dir, exist_ok=True)
+    return os.path.join(data_dir, filename)
+
+
+def get_connection(path):
+    """取得目前執行緒對應 path 的 SQLite 連線（autocommit、WAL 模式）"""
+    conns = getattr(_local, 'conns', None)
+    if conns is None:
+        conns = _local.conns = {}
+    conn = conns.get(path)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=10000')
+        conns[path] = conn
+    return conn
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Webhook 事件去重：
+LINE 在回應太慢時會重送 webhook（deliveryContext.isRedelivery = true），
+以 webhookEventId 記錄已處理過的事件，重複的事件直接略過。
+- 本機記憶體索引：OrderedDict，依到期順序排列，查詢與淘汰皆為 O(1)
+- 共用索引（選用）：SQLite 檔案，讓同一台機器上的多個 gunicorn worker 共用
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from db import get_connection
+
+logger = logging.getLogger(__name__)
+
+
+class SeenEventIndex:
+    """有容量上限、依 TTL 淘汰的已處理事件索引"""
+
+    def __init__(self, ttl=86400, max_entries=20000, db_path=None, max_db_rows=200000):
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._db_path = db_path
+        self._max_db_rows = max_db_rows
+        self._seen = OrderedDict() # event_id -> 到期時間
+        self._lock = threading.Lock()
+        self._inserts_since_prune = 0
+        # 統計數據
+        self.hits = 0 # 重複事件
+        self.misses = 0 # 第一次看到的事件
+        self.redeliveries = 0 # 帶有 isRedelivery 標記的事件
+        if db_path:
+            self._init_db()
+
+    def _init_db(self):
+        conn = get_connection(self._db_path)
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS seen_events ('
+            ' event_id TEXT PRIMARY KEY,'
+            ' expires_at REAL NOT NULL)'
+        )
+
+    def _evict_local(self, now):
+        # 依插入順序即到期順序，從最舊的開始淘汰
+        while self._seen:
+            event_id, expires_at = next(iter(self._seen.items()))
+            if expires_at > now and len(self._seen) <= self._max_entries:
+                break
+            self._seen.popitem(last=False)
+
+    def _claim_shared(self, event_id, now):
+        """在共用索引中登記事件，回傳 True 代表本 worker 第一個登記"""
+        conn = get_connection(self._db_path)
+        cur = conn.execute(
+            'INSERT INTO seen_events (event_id, expires_at) VALUES (?, ?) '
+            'ON CONFLICT(event_id) DO UPDATE SET expires_at = excluded.expires_at '
+            'WHERE seen_events.expires_at < ?',
+            (event_id, now + self._ttl, now)
+        )
+        claimed = cur.rowcount > 0
+        self._inserts_since_prune += 1
+        if self._inserts_since_prune >= 500:
+            self._inserts_since_prune = 0
+            conn.execute('DELETE FROM seen_events WHERE expires_at < ?', (now,))
+            conn.execute(
+                'DELETE FROM seen_events WHERE rowid <= (SELECT MAX(rowid) FROM seen_events) - ?',
+                (self._max_db_rows,)
+            )
+        return claimed
+
+    def check_and_add(self, event_id, is_redelivery=False):
+        """第一次看到此事件回傳 True 並記錄；重複事件回傳 False"""
+        if not event_id:
+            return True
+        now = time.time()
+        with self._lock:
+            if is_redelivery:
+                self.redeliveries += 1
+            expires_at = self._seen.get(event_id)
+            if expires_at is not None and expires_at > now:
+                self.hits += 1
+                return False
+            self._seen[event_id] = now + self._ttl
+            self._seen.move_to_end(event_id)
+            self._evict_local(now)
+
+        if self._db_path:
+            try:
+                if not self._claim_shared(event_id, now):
+                    with self._lock:
+                        self.hits += 1
+                    return False
+            except Exception as e:
+                # 共用索引失效時仍以本機索引為準，避免漏處理事件
+                logger.error(f"寫入共用去重索引時出錯: {e}")
+
+        with self._lock:
+            self.misses += 1
+        return True
+
+    def stats(self):
+        """回傳去重索引統計"""
+        with self._lock:
+            return {
+                'entries': len(self._seen),
+                'max_entries': self._max_entries,
+                'ttl': self._ttl,
+                'shared': bool(self._db_path),
+                'hits': self.hits,
+                'misses': self.misses,
+                'redeliveries': self.redeliveries,
+            }
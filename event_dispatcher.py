@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Webhook 事件派送：
+- /callback 驗證簽章後把事件丟進記憶體佇列，立即回 200 給 LINE
+- 背景工作執行緒依 user_id 分片處理，同一位用戶的事件維持先後順序
+- 佇列深度、等待時間、丟棄數量可透過 stats() 取得
+- 同步模式下，同一個 body 內不同用戶的事件以執行緒池平行處理
+"""
+
+import inspect
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from linebot.v3.webhooks import MessageEvent
+
+logger = logging.getLogger(__name__)
+
+
+def get_shard_key(event):
+    """取得事件的分片鍵：優先使用 user_id，其次群組/聊天室 ID"""
+    source = getattr(event, 'source', None)
+    for attr in ('user_id', 'group_id', 'room_id'):
+        value = getattr(source, attr, None)
+        if value:
+            return value
+    return getattr(event, 'webhook_event_id', None) or ''
+
+
+def find_handler_func(handler, event):
+    """依照 WebhookHandler.handle 相同的規則找出事件對應的處理函式"""
+    func = None
+    if isinstance(event, MessageEvent):
+        key = f"{event.__class__.__name__}_{event.message.__class__.__name__}"
+        func = handler._handlers.get(key)
+    if func is None:
+        func = handler._handlers.get(event.__class__.__name__)
+    if func is None:
+        func = handler._default
+    return func
+
+
+def dispatch_event(handler, event, destination=None):
+    """呼叫 handler 上註冊的處理函式（與 WebhookHandler 的參數規則一致）"""
+    func = find_handler_func(handler, event)
+    if func is None:
+        logger.info(f"No handler for {event.__class__.__name__} and no default handler")
+        return
+    arg_spec = inspect.getfullargspec(func)
+    if arg_spec.varargs is not None or len(arg_spec.args) == 2:
+        func(event, destination)
+    elif len(arg_spec.args) == 1:
+        func(event)
+    else:
+        func()
+
+
+def group_by_shard(events):
+    """依分片鍵將事件分組，每組內維持原本的先後順序"""
+    groups = OrderedDict()
+    for event in events:
+        groups.setdefault(get_shard_key(event), []).append(event)
+    return list(groups.values())
+
+
+class ShardedExecutor:
+    """同步處理一個 webhook body：不同用戶平行處理，同一用戶依序處理"""
+
+    def __init__(self, dispatch, max_workers=4, name='webhook-sync'):
+        self._dispatch = dispatch
+        self._pool = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix=name)
+        self._name = name
+
+    def _run_group(self, group, destination):
+        for event in group:
+            try:
+                self._dispatch(event, destination)
+            except Exception:
+                logger.exception(f"{self._name} 處理事件時發生錯誤:")
+
+    def run(self, events, destination=None, timeout=None):
+        """處理所有事件並等待完成，耗時約等於最慢的那位用戶"""
+        groups = group_by_shard(events)
+        if len(groups) <= 1:
+            # 只有一位用戶時直接在目前執行緒處理，省去切換執行緒的成本
+            for group in groups:
+                self._run_group(group, destination)
+            return
+        futures = [self._pool.submit(self._run_group, group, destination) for group in groups]
+        wait(futures, timeout=timeout)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+
+
+class ShardedEventQueue:
+    """依 user_id 分片的有界工作佇列，每個分片由一條執行緒依序處理"""
+
+    def __init__(self, dispatch, workers=4, max_queue_size=200, name='webhook'):
+        self._dispatch = dispatch
+        self._workers = max(1, workers)
+        self._max_queue_size = max_queue_size
+        self._name = name
+        self._queues = []
+        self._threads = []
+        self._lock = threading.Lock()
+        self._started = False
+        # 統計數據
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _start(self):
+        with self._lock:
+            if self._started:
+                return
+            for idx in range(self._workers):
+                q = queue.Queue(maxsize=self._max_queue_size)
+                t = threading.Thread(target=self._run, args=(q,), name=f"{self._name}-worker-{idx}", daemon=True)
+                self._queues.append(q)
+                self._threads.append(t)
+                t.start()
+            self._started = True
+            logger.info(f"{self._name} 佇列啟動：{self._workers} 條工作執行緒，每個分片上限 {self._max_queue_size}")
+
+    def submit(self, event, destination=None):
+        """將事件放入對應分片的佇列；佇列已滿時丟棄並回傳 False"""
+        if not self._started:
+            self._start()
+        shard = hash(get_shard_key(event)) % self._workers
+        try:
+            self._queues[shard].put_nowait((time.monotonic(), event, destination))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            logger.warning(f"{self._name} 分片 {shard} 佇列已滿，丟棄事件 {getattr(event, 'webhook_event_id', '')}")
+            return False
+        with self._lock:
+            self.enqueued += 1
+        return True
+
+    def _run(self, q):
+        while True:
+            item = q.get()
+            if item is None:
+                q.task_done()
+                return
+            enqueued_at, event, destination = item
+            waited = time.monotonic() - enqueued_at
+            try:
+                self._dispatch(event, destination)
+                ok = True
+            except Exception:
+                ok = False
+                logger.exception(f"{self._name} 處理事件時發生錯誤:")
+            finally:
+                q.task_done()
+            with self._lock:
+                self.total_wait += waited
+                self.max_wait = max(self.max_wait, waited)
+                if ok:
+                    self.processed += 1
+                else:
+                    self.failed += 1
+
+    def depth(self):
+        """目前佇列中等待處理的事件總數"""
+        return sum(q.qsize() for q in self._queues)
+
+    def stats(self):
+        """回傳佇列統計（深度、等待時間、丟棄數量等）"""
+        with self._lock:
+            done = self.processed + self.failed
+            return {
+                'workers': self._workers,
+                'max_queue_size': self._max_queue_size,
+                'depth': self.depth(),
+                'shard_depths': [q.qsize() for q in self._queues],
+                'enqueued': self.enqueued,
+                'processed': self.processed,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'avg_wait_ms': round(self.total_wait / done * 1000, 2) if done else 0.0,
+                'max_wait_ms': round(self.max_wait * 1000, 2),
+            }
+
+    def shutdown(self, timeout=5.0):
+        """通知所有工作執行緒在處理完手上事件後結束"""
+        if not self._started:
+            return
+        for q in self._queues:
+            try:
+                q.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+        deadline = time.monotonic() + timeout
+        for t in self._threads:
+            t.join(max(0.0, deadline - time.monotonic()))
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+加入好友的用戶清單（持久化）：
+- 存在 SQLite（WAL 模式），所有 gunicorn worker 共用，服務重啟也不會遺失
+- handle_follow 只把 user_id 放進待寫入集合，由背景執行緒批次寫入（write-behind）
+- iter_followers() 以 user_id 分頁逐批讀取，群發時記憶體用量不隨好友數增加
+- 查詢是否為好友時先查記憶體快取，沒有再查資料庫（read-through）
+"""
+
+import atexit
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from db import get_connection
+
+logger = logging.getLogger(__name__)
+
+
+class FollowerStore:
+    """以 SQLite 保存的好友清單，介面與原本的 set 相近（add / remove / in / len）"""
+
+    def __init__(self, db_path, flush_interval=1.0, batch_size=200, cache_size=10000):
+        self._db_path = db_path
+        self._flush_interval = flush_interval
+        self._batch_size = batch_size
+        self._cache_size = cache_size
+        self._cache = OrderedDict() # user_id -> 是否為好友
+        self._pending = OrderedDict() # user_id -> (是否為好友, 時間)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._flusher = None
+        self._stopped = False
+        self._init_db()
+        atexit.register(self.close)
+
+    def _init_db(self):
+        conn = get_connection(self._db_path)
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS followers ('
+            ' user_id TEXT PRIMARY KEY,'
+            ' followed_at REAL NOT NULL,'
+            ' active INTEGER NOT NULL DEFAULT 1)'
+        )
+
+    # --- 寫入（write-behind） ---
+    def _remember(self, user_id, active):
+        self._cache[user_id] = active
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+    def _enqueue(self, user_id, active):
+        with self._lock:
+            self._pending[user_id] = (active, time.time())
+            self._remember(user_id, active)
+            pending = len(self._pending)
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._run, name='follower-store-flusher', daemon=True)
+                self._flusher.start()
+        if pending >= self._batch_size:
+            self._wakeup.set()
+
+    def add(self, user_id):
+        """記錄新的好友"""
+        if user_id:
+            self._enqueue(user_id, True)
+
+    def remove(self, user_id):
+        """標記用戶已封鎖/退出好友"""
+        if user_id:
+            self._enqueue(user_id, False)
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self._flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"寫入好友清單時出錯: {e}")
+
+    def flush(self):
+        """立即將待寫入的資料批次寫入資料庫"""
+        with self._lock:
+            if not self._pending:
+                return 0
+            batch = [(user_id, at, 1 if active else 0) for user_id, (active, at) in self._pending.items()]
+            self._pending.clear()
+        conn = get_connection(self._db_path)
+        try:
+            conn.execute('BEGIN')
+            conn.executemany(
+                'INSERT INTO followers (user_id, followed_at, active) VALUES (?, ?, ?) '
+                'ON CONFLICT(user_id) DO UPDATE SET active = excluded.active, '
+                'followed_at = CASE WHEN excluded.active = 1 THEN excluded.followed_at ELSE followers.followed_at END',
+                batch
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            # 寫入失敗時放回待寫入集合，下次再試（較新的狀態優先）
+            with self._lock:
+                for user_id, at, active in batch:
+                    self._pending.setdefault(user_id, (bool(active), at))
+            raise
+        logger.debug(f"已寫入 {len(batch)} 筆好友資料")
+        return len(batch)
+
+    def close(self):
+        """停止背景寫入並寫入剩餘資料"""
+        self._stopped = True
+        self._wakeup.set()
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f"關閉好友清單時寫入失敗: {e}")
+
+    # --- 讀取 ---
+    def __contains__(self, user_id):
+        with self._lock:
+            active = self._cache.get(user_id)
+            if active is not None:
+                self._cache.move_to_end(user_id)
+                return active
+        row = get_connection(self._db_path).execute(
+            'SELECT active FROM followers WHERE user_id = ?', (user_id,)
+        ).fetchone()
+        active = bool(row and row[0])
+        with self._lock:
+            if user_id not in self._pending:
+                self._remember(user_id, active)
+        return active
+
+    def __len__(self):
+        self.flush()
+        row = get_connection(self._db_path).execute('SELECT COUNT(*) FROM followers WHERE active = 1').fetchone()
+        return row[0]
+
+    def iter_batches(self, batch_size=1000, after=''):
+        """依 user_id 順序逐批讀取好友（從 after 之後開始），每批一個短查詢，不會長時間鎖住資料庫"""
+        self.flush()
+        conn = get_connection(self._db_path)
+        last_user_id = after
+        while True:
+            rows = conn.execute(
+                'SELECT user_id FROM followers WHERE active = 1 AND user_id > ? ORDER BY user_id LIMIT ?',
+                (last_user_id, batch_size)
+            ).fetchall()
+            if not rows:
+                return
+            batch = [row[0] for row in rows]
+            yield batch
+            last_user_id = batch[-1]
+
+    def iter_followers(self, batch_size=1000):
+        """逐一產生好友的 user_id"""
+        for batch in self.iter_batches(batch_size):
+            yield from batch
@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+"""
+gunicorn 設定（gunicorn 啟動時自動讀取目前目錄的 gunicorn.conf.py）：
+每個 worker 載入 app 後啟動背景服務；排程以檔案鎖選出單一 leader，不會因 worker 數量重複執行。
+"""
+
+
+def post_worker_init(worker):
+    import app
+    app.start_background_services()
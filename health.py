@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+輕量健康檢查：
+- 以 WSGI middleware 直接回應 GET/HEAD /healthz，不經過 Flask 的路由、request context 與 after_request，
+  冷啟動期間或背景工作繁忙時也能快速回應
+- check() 回傳的 dict 原樣輸出為 JSON；ready 為 True 時回應 200，否則 503（讓負載平衡器/監控判斷是否就緒）
+"""
+
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class HealthCheckMiddleware:
+    """攔截健康檢查路徑，其餘請求交給原本的 WSGI app"""
+
+    def __init__(self, wsgi_app, check, path='/healthz'):
+        self.wsgi_app = wsgi_app
+        self._check = check
+        self._path = path
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') != self._path or environ.get('REQUEST_METHOD') not in ('GET', 'HEAD'):
+            return self.wsgi_app(environ, start_response)
+        try:
+            status = self._check()
+        except Exception as e:
+            logger.error(f"健康檢查時出錯: {e}")
+            status = {'ready': False, 'error': str(e)}
+        body = json.dumps(status, ensure_ascii=False, default=str).encode('utf-8')
+        start_response('200 OK' if status.get('ready') else '503 Service Unavailable', [
+            ('Content-Type', 'application/json; charset=utf-8'),
+            ('Content-Length', str(len(body))),
+            ('Cache-Control', 'no-store'),
+        ])
+        return [b''] if environ['REQUEST_METHOD'] == 'HEAD' else [body]
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+排程服務（多個 worker / 行程中只有一個執行）：
+- 每個 worker 都會呼叫 start()，以本機檔案鎖（fcntl.flock）選出唯一的 leader 執行排程
+- 沒搶到鎖的 worker 定期重試；leader 結束時鎖由作業系統自動釋放，由其他 worker 接手
+- 每個工作最後一次成功執行的時間記錄在 SQLite，leader 上任時補跑寬限時間內錯過的最近一次
+- 錯過多次只補跑一次；工作本身應可重複執行（例如群發工作以工作 ID 續傳）
+- APScheduler 只在成為 leader 時才匯入，其他 worker 與冷啟動不需載入
+"""
+
+import datetime
+import logging
+import os
+import threading
+import time
+
+from db import data_path, get_connection
+from recurrence import TW_TIMEZONE
+
+try:
+    import fcntl
+except ImportError: # Windows 本機開發：沒有 flock，單一行程直接視為 leader
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_LOCK_RETRY = int(os.getenv('SCHEDULER_LOCK_RETRY', '30')) # 非 leader 重試取得鎖的間隔秒數
+SCHEDULER_MISFIRE_GRACE = int(os.getenv('SCHEDULER_MISFIRE_GRACE', '21600')) # 錯過的排程在多少秒內仍會補跑
+
+
+class LeaderLock:
+    """以檔案鎖選出 leader；持有者結束（含當機）時鎖會自動釋放"""
+
+    def __init__(self, path):
+        self._path = path
+        self._file = None
+
+    @property
+    def held(self):
+        return self._file is not None
+
+    def acquire(self):
+        """嘗試取得鎖（不等待），回傳是否為 leader"""
+        if self._file is not None:
+            return True
+        f = open(self._path, 'a+')
+        if fcntl is not None:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                return False
+        # 記錄目前 leader 的 PID，方便除錯
+        f.seek(0)
+        f.truncate()
+        f.write(f"{os.getpid()}\n")
+        f.flush()
+        self._file = f
+        return True
+
+    def release(self):
+        if self._file is None:
+            return
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+
+
+class RunStore:
+    """各工作最後一次執行的時間與結果"""
+
+    def __init__(self, db_path):
+        self._db_path = db_path
+        get_connection(db_path).execute(
+            'CREATE TABLE IF NOT EXISTS scheduler_runs ('
+            'job_id TEXT PRIMARY KEY, last_run REAL, last_status TEXT, last_error TEXT, finished_at REAL)'
+        )
+
+    def last_run(self, job_id):
+        row = get_connection(self._db_path).execute(
+            'SELECT last_run FROM scheduler_runs WHERE job_id = ?', (job_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def record(self, job_id, run_at, status, error=None):
+        """成功時更新 last_run；失敗時只記錄狀態（下次上任時仍會補跑）"""
+        conn = get_connection(self._db_path)
+        conn.execute(
+            'INSERT INTO scheduler_runs (job_id, last_run, last_status, last_error, finished_at) '
+            'VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT(job_id) DO UPDATE SET '
+            'last_run = COALESCE(excluded.last_run, last_run), last_status = excluded.last_status, '
+            'last_error = excluded.last_error, finished_at = excluded.finished_at',
+            (job_id, run_at if status != 'error' else None, status, error, time.time())
+        )
+
+    def all(self):
+        rows = get_connection(self._db_path).execute(
+            'SELECT job_id, last_run, last_status, last_error, finished_at FROM scheduler_runs'
+        ).fetchall()
+        return {row[0]: {'last_run': row[1], 'status': row[2], 'error': row[3], 'finished_at': row[4]} for row in rows}
+
+
+class LeaderScheduler:
+    """只在 leader 上執行的 APScheduler，附帶錯過排程的補跑"""
+
+    def __init__(self, db_path=None, lock_path=None, tz=TW_TIMEZONE,
+                 misfire_grace=SCHEDULER_MISFIRE_GRACE, retry_interval=SCHEDULER_LOCK_RETRY):
+        self._lock = LeaderLock(lock_path or data_path('scheduler.lock'))
+        self._runs = RunStore(db_path or data_path('scheduler.db'))
+        self._tz = tz
+        self._misfire_grace = misfire_grace
+        self._retry_interval = retry_interval
+        self._jobs = {} # job_id -> (func, cron 參數)
+        self._triggers = {} # job_id -> CronTrigger（成為 leader 時才建立）
+        self._on_elected = []
+        self._scheduler = None
+        self._started = False
+        self._stop = threading.Event()
+        self._state_lock = threading.Lock()
+
+    def add_job(self, job_id, func, **cron):
+        """登記排程工作（需在 start() 之前）；cron 為 CronTrigger 的參數，例如 day_of_week='fri', hour=9"""
+        self._jobs[job_id] = (func, cron)
+
+    def on_elected(self, func):
+        """登記成為 leader 時要在背景執行一次的工作（例如續傳中斷的群發）"""
+        self._on_elected.append(func)
+        return func
+
+    @property
+    def is_leader(self):
+        return self._lock.held
+
+    def start(self):
+        """嘗試成為 leader；沒搶到時在背景定期重試。可重複呼叫。"""
+        with self._state_lock:
+            if self._started:
+                return
+            self._started = True
+        if self._lock.acquire():
+            self._become_leader()
+        else:
+            logger.info(f"排程由其他行程執行（PID {os.getpid()} 待命）")
+            threading.Thread(target=self._wait_for_leadership, name='scheduler-standby', daemon=True).start()
+
+    def _wait_for_leadership(self):
+        while not self._stop.wait(self._retry_interval):
+            if self._lock.acquire():
+                self._become_leader()
+                return
+
+    def _become_leader(self):
+        logger.info(f"PID {os.getpid()} 成為排程 leader，登記 {len(self._jobs)} 個工作")
+        from apscheduler.schedulers.background import BackgroundScheduler
+        from apscheduler.triggers.cron import CronTrigger
+        self._triggers = {
+            job_id: CronTrigger(**dict({'timezone': self._tz}, **cron)) for job_id, (_, cron) in self._jobs.items()
+        }
+        self._scheduler = BackgroundScheduler(
+            daemon=True,
+            timezone=self._tz,
+            job_defaults={'coalesce': True, 'max_instances': 1, 'misfire_grace_time': self._misfire_grace}
+        )
+        for job_id, trigger in self._triggers.items():
+            self._scheduler.add_job(self._run, trigger, args=[job_id], id=job_id, name=job_id)
+        self._scheduler.start()
+        threading.Thread(target=self._catch_up, name='scheduler-catch-up', daemon=True).start()
+        for func in self._on_elected:
+            threading.Thread(target=func, name=f"scheduler-{func.__name__}", daemon=True).start()
+
+    def _run(self, job_id):
+        func, _ = self._jobs[job_id]
+        started = time.time()
+        logger.info(f"開始執行排程工作 {job_id}")
+        try:
+            func()
+        except Exception as e:
+            logger.exception(f"排程工作 {job_id} 執行失敗: {e}")
+            self._runs.record(job_id, started, 'error', str(e))
+            return
+        self._runs.record(job_id, started, 'ok')
+        logger.info(f"排程工作 {job_id} 完成，耗時 {time.time() - started:.1f} 秒")
+
+    def _missed_run(self, trigger, last_run, now):
+        """回傳 last_run 之後、寬限時間內最近一次應執行的時間；沒有錯過時回傳 None"""
+        since = max(now - self._misfire_grace, last_run)
+        fire = trigger.get_next_fire_time(None, datetime.datetime.fromtimestamp(since, self._tz))
+        missed = None
+        while fire is not None and fire.timestamp() <= now:
+            if fire.timestamp() > last_run:
+                missed = fire
+            fire = trigger.get_next_fire_time(fire, fire + datetime.timedelta(seconds=1))
+        return missed
+
+    def _catch_up(self):
+        now = time.time()
+        for job_id, trigger in self._triggers.items():
+            last_run = self._runs.last_run(job_id)
+            if last_run is None:
+                # 第一次登記的工作沒有歷史可比對，從現在開始計算，避免部署當下意外補發
+                self._runs.record(job_id, now, 'registered')
+                continue
+            missed = self._missed_run(trigger, last_run, now)
+            if missed is not None:
+                logger.warning(f"排程工作 {job_id} 錯過了 {missed:%Y-%m-%d %H:%M}，立即補跑")
+                self._run(job_id)
+
+    def shutdown(self):
+        self._stop.set()
+        if self._scheduler is not None:
+            self._scheduler.shutdown(wait=False)
+            self._scheduler = None
+        self._lock.release()
+
+    def stats(self):
+        runs = self._runs.all()
+        jobs = {}
+        for job_id in self._jobs:
+            job = self._scheduler.get_job(job_id) if self._scheduler is not None else None
+            next_run = getattr(job, 'next_run_time', None)
+            jobs[job_id] = dict(runs.get(job_id, {}), next_run=next_run.isoformat() if next_run else None)
+        return {'leader': self.is_leader, 'pid': os.getpid(), 'jobs': jobs}
@@ -1,12 +1,148 @@
-import requests
+"""
+Render 保活程式：
+- 只在營業時間（台北時間）內 ping /healthz，營業時間外讓服務休眠，節省免費方案的執行時數
+- 營業開始前 KEEPALIVE_LEAD 秒先喚醒，客人開始傳訊息時服務已經就緒
+- 每次間隔加上隨機 jitter，避免固定週期
+- 記錄回應時間，定期輸出 p50 / p90 / p99
+- 回應時間遠高於平常，或 /healthz 回報的 uptime 小於兩次 ping 的間隔時，判定為冷啟動（服務曾經休眠或重啟）
+"""
+
+import datetime
+import os
+import random
 import time
 
-RENDER_URL = "https://xuantian-line-bot.onrender.com"
+import pytz
+import requests
+
+RENDER_URL = os.getenv('KEEPALIVE_URL', "https://xuantian-line-bot.onrender.com/healthz")
+KEEPALIVE_INTERVAL = int(os.getenv('KEEPALIVE_INTERVAL', '720')) # 12分鐘 = 720秒（Render 免費方案閒置 15 分鐘後休眠）
+KEEPALIVE_JITTER = int(os.getenv('KEEPALIVE_JITTER', '60')) # 每次間隔隨機增減的秒數
+KEEPALIVE_HOURS = os.getenv('KEEPALIVE_HOURS', '8-23') # 保持喚醒的時段（台北時間，開始-結束 小時）
+KEEPALIVE_WEEKDAYS = os.getenv('KEEPALIVE_WEEKDAYS', '0,1,2,3,4,5,6') # 0 = 星期一
+KEEPALIVE_LEAD = int(os.getenv('KEEPALIVE_LEAD', '300')) # 營業開始前提早喚醒的秒數
+KEEPALIVE_TIMEOUT = float(os.getenv('KEEPALIVE_TIMEOUT', '60')) # 冷啟動可能需要數十秒
+COLD_START_FACTOR = float(os.getenv('COLD_START_FACTOR', '5')) # 回應時間超過中位數幾倍視為冷啟動
+COLD_START_MIN_SECONDS = float(os.getenv('COLD_START_MIN_SECONDS', '2')) # 低於此秒數不視為冷啟動
+SUMMARY_EVERY = 10 # 每幾次 ping 輸出一次統計
+WINDOW = 200 # 計算百分位數的最近樣本數
+
+TW_TIMEZONE = pytz.timezone('Asia/Taipei')
+OPEN_HOUR, CLOSE_HOUR = (int(h) for h in KEEPALIVE_HOURS.split('-'))
+WEEKDAYS = {int(d) for d in KEEPALIVE_WEEKDAYS.split(',') if d.strip()}
+
+
+def log(message):
+    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {message}", flush=True)
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def awake_window(day):
+    """回傳該日的 (喚醒開始, 結束) 台北時間；不營業的日子回傳 None"""
+    if day.weekday() not in WEEKDAYS:
+        return None
+    start = TW_TIMEZONE.localize(datetime.datetime.combine(day, datetime.time(OPEN_HOUR)))
+    if CLOSE_HOUR >= 24:
+        end = TW_TIMEZONE.localize(datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time(0)))
+    else:
+        end = TW_TIMEZONE.localize(datetime.datetime.combine(day, datetime.time(CLOSE_HOUR)))
+    return start - datetime.timedelta(seconds=KEEPALIVE_LEAD), end
+
+
+def seconds_until_awake(now):
+    """在喚醒時段內回傳 0，否則回傳距離下一個喚醒時段開始的秒數"""
+    for offset in range(8):
+        window = awake_window(now.date() + datetime.timedelta(days=offset))
+        if window is None:
+            continue
+        start, end = window
+        if start <= now < end:
+            return 0
+        if now < start:
+            return (start - now).total_seconds()
+    return KEEPALIVE_INTERVAL
 
-while True:
+
+class PingStats:
+    """回應時間統計與冷啟動偵測"""
+
+    def __init__(self):
+        self.latencies = []
+        self.pings = 0
+        self.failures = 0
+        self.cold_starts = 0
+
+    def is_cold_start(self, latency, uptime, since_last_ping):
+        if uptime is not None and since_last_ping is not None and uptime < since_last_ping:
+            return True # 上次 ping 之後服務重新啟動過
+        if len(self.latencies) < 5 or latency < COLD_START_MIN_SECONDS:
+            return False
+        return latency > COLD_START_FACTOR * percentile(self.latencies, 50)
+
+    def record(self, latency):
+        self.latencies.append(latency)
+        del self.latencies[:-WINDOW]
+
+    def summary(self):
+        if not self.latencies:
+            return f"尚無成功的 ping（失敗 {self.failures} 次）"
+        return (
+            f"統計：ping {self.pings} 次，失敗 {self.failures} 次，冷啟動 {self.cold_starts} 次，"
+            f"回應時間 p50 {percentile(self.latencies, 50) * 1000:.0f} ms / "
+            f"p90 {percentile(self.latencies, 90) * 1000:.0f} ms / p99 {percentile(self.latencies, 99) * 1000:.0f} ms"
+        )
+
+
+def ping(session, stats, since_last_ping):
+    stats.pings += 1
+    started = time.monotonic()
     try:
-        response = requests.get(RENDER_URL)
-        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Ping! 狀態碼: {response.status_code}")
+        response = session.get(RENDER_URL, timeout=KEEPALIVE_TIMEOUT)
     except Exception as e:
-        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Ping 失敗: {e}")
-    time.sleep(720)  # 12分鐘 = 720秒 
\ No newline at end of file
+        stats.failures += 1
+        log(f"Ping 失敗: {e}")
+        return
+    latency = time.monotonic() - started
+    try:
+        uptime = response.json().get('uptime')
+    except ValueError:
+        uptime = None
+    cold = stats.is_cold_start(latency, uptime, since_last_ping)
+    if cold:
+        stats.cold_starts += 1
+    else:
+        stats.record(latency) # 冷啟動的回應時間不列入平常的統計
+    if response.status_code >= 500 and response.status_code != 503:
+        stats.failures += 1
+    log(f"Ping! 狀態碼: {response.status_code}，回應時間: {latency * 1000:.0f} ms"
+        + (f"，uptime: {uptime} 秒" if uptime is not None else "")
+        + ("（冷啟動）" if cold else ""))
+
+
+def main():
+    session = requests.Session()
+    stats = PingStats()
+    last_ping = None
+    log(f"保活開始：{RENDER_URL}，時段 {OPEN_HOUR}-{CLOSE_HOUR} 點（提早 {KEEPALIVE_LEAD} 秒），"
+        f"間隔 {KEEPALIVE_INTERVAL}±{KEEPALIVE_JITTER} 秒")
+    while True:
+        wait = seconds_until_awake(datetime.datetime.now(TW_TIMEZONE))
+        if wait > 0:
+            log(f"非營業時段，{wait / 3600:.1f} 小時後再開始 ping")
+            time.sleep(wait)
+            continue
+        now = time.monotonic()
+        ping(session, stats, None if last_ping is None else now - last_ping)
+        last_ping = now
+        if stats.pings % SUMMARY_EVERY == 0:
+            log(stats.summary())
+        time.sleep(max(1, KEEPALIVE_INTERVAL + random.uniform(-KEEPALIVE_JITTER, KEEPALIVE_JITTER)))
+
+
+if __name__ == "__main__":
+    main()
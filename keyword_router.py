@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+關鍵字路由：
+將 (優先順序, 關鍵字, 處理函式) 的路由表在載入時編譯成 Aho-Corasick 自動機，
+對正規化後的訊息只掃描一次，就能找出優先順序最高的命中路由。
+優先順序數字越小越優先；同一優先順序以路由表中的先後為準。
+
+比對前先用正規表示式（C 實作）找出「只由關鍵字用字組成」的片段，
+自動機只需要走這些片段，其餘字元不可能命中任何關鍵字，直接跳過。
+"""
+
+import re
+from collections import deque
+
+
+class Route:
+    """一條路由：任一關鍵字出現在訊息中即命中"""
+
+    __slots__ = ('priority', 'keywords', 'handler', 'order')
+
+    def __init__(self, priority, keywords, handler, order):
+        self.priority = priority
+        self.keywords = tuple(keywords)
+        self.handler = handler
+        self.order = order
+
+    @property
+    def rank(self):
+        return (self.priority, self.order)
+
+    def __repr__(self):
+        return f"Route(priority={self.priority}, keywords={self.keywords}, handler={getattr(self.handler, '__name__', self.handler)})"
+
+
+class KeywordRouter:
+    """以 Aho-Corasick 自動機實作的多關鍵字路由器"""
+
+    def __init__(self, routes):
+        """routes: 可迭代的 (優先順序, 關鍵字 tuple, 處理函式)"""
+        self.routes = [Route(priority, keywords, handler, order)
+                       for order, (priority, keywords, handler) in enumerate(routes)]
+        self._compile()
+
+    def _compile(self):
+        # goto[state] = {字元: 下一個狀態}；output[state] = 此狀態可命中的最佳路由
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [None]
+        for route in self.routes:
+            for keyword in route.keywords:
+                state = 0
+                for ch in keyword:
+                    nxt = self._goto[state].get(ch)
+                    if nxt is None:
+                        nxt = len(self._goto)
+                        self._goto.append({})
+                        self._fail.append(0)
+                        self._output.append(None)
+                        self._goto[state][ch] = nxt
+                    state = nxt
+                self._output[state] = self._better(self._output[state], route)
+
+        # 以 BFS 建立失敗連結，並把失敗狀態的輸出合併進來（只保留最佳路由）
+        order = []
+        pending = deque(self._goto[0].values())
+        while pending:
+            state = pending.popleft()
+            order.append(state)
+            for ch, nxt in self._goto[state].items():
+                pending.append(nxt)
+                if state:
+                    fail = self._fail[state]
+                    while fail and ch not in self._goto[fail]:
+                        fail = self._fail[fail]
+                    self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._output[nxt] = self._better(self._output[nxt], self._output[self._fail[nxt]])
+
+        # 把失敗連結展開成完整的轉移表（DFA），比對時每個字元只需一次 dict 查詢
+        self._delta = [None] * len(self._goto)
+        self._delta[0] = dict(self._goto[0])
+        for state in order:
+            delta = dict(self._delta[self._fail[state]])
+            delta.update(self._goto[state])
+            self._delta[state] = delta
+
+        # 每個狀態的命中結果轉成整數名次（0 為最優先），比對迴圈中只需比較整數
+        ranked = sorted(self.routes, key=lambda route: route.rank)
+        self._ranked_routes = ranked
+        position = {id(route): idx for idx, route in enumerate(ranked)}
+        no_hit = len(ranked)
+        self._no_hit = no_hit
+        self._state_rank = [no_hit if out is None else position[id(out)] for out in self._output]
+
+        # 只有關鍵字用到的字元才可能推進自動機，長度不足最短關鍵字的片段也不必掃描
+        keywords = [keyword for route in self.routes for keyword in route.keywords]
+        if keywords:
+            alphabet = ''.join(sorted(set(''.join(keywords))))
+            min_len = min(len(keyword) for keyword in keywords)
+            self._segments = re.compile(f"[{re.escape(alphabet)}]{{{min_len},}}")
+        else:
+            self._segments = None
+
+    @staticmethod
+    def _better(a, b):
+        if a is None:
+            return b
+        if b is None:
+            return a
+        return a if a.rank <= b.rank else b
+
+    def match(self, text):
+        """掃描一次 text，回傳優先順序最高的命中路由；沒有命中時回傳 None"""
+        if self._segments is None:
+            return None
+        delta = self._delta
+        state_rank = self._state_rank
+        best = self._no_hit
+        for segment in self._segments.findall(text):
+            state = 0
+            for ch in segment:
+                state = delta[state].get(ch, 0)
+                rank = state_rank[state]
+                if rank < best:
+                    best = rank
+                    if not best:
+                        return self._ranked_routes[0] # 已命中最高優先的路由，不必再掃描
+        return self._ranked_routes[best] if best < self._no_hit else None
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+共用的 LINE Messaging API 用戶端：
+- 整個行程只建立一個 ApiClient（延遲到第一次使用時才建立），所有執行緒共用
+- urllib3 連線池保持 keep-alive，避免每次呼叫都重新建立 TLS 連線
+- 每次呼叫自動帶入連線/讀取逾時，並經過共用的速率限制（收到 429 時依 Retry-After 重試）
+- 行程結束時自動關閉
+"""
+
+import atexit
+import logging
+import os
+import socket
+import threading
+from contextlib import contextmanager
+
+from linebot.v3.messaging import (
+    Configuration,
+    ApiClient,
+    MessagingApi,
+    MessagingApiBlob
+)
+from urllib3.connection import HTTPConnection
+
+from rate_limiter import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+# 連線設定
+LINE_POOL_SIZE = int(os.getenv('LINE_POOL_SIZE', '10')) # 同時連到 api.line.me 的最大連線數
+LINE_CONNECT_TIMEOUT = float(os.getenv('LINE_CONNECT_TIMEOUT', '5'))
+LINE_READ_TIMEOUT = float(os.getenv('LINE_READ_TIMEOUT', '10'))
+LINE_TCP_KEEPALIVE = os.getenv('LINE_TCP_KEEPALIVE', 'true').lower() == 'true'
+
+_lock = threading.Lock()
+_api_client = None
+_messaging_api = None
+_messaging_blob_api = None
+_owner_pid = None
+
+# 整個行程共用一個速率限制器（MessagingApi 與 MessagingApiBlob 共用各類別的額度）
+rate_limiter = RateLimiter()
+
+
+class _ManagedApi:
+    """包裝 MessagingApi：未指定 _request_timeout 的呼叫自動帶入預設逾時，並經過速率限制"""
+
+    def __init__(self, api, timeout, limiter):
+        self._api = api
+        self._timeout = timeout
+        self._limiter = limiter
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            kwargs.setdefault('_request_timeout', self._timeout)
+            return self._limiter.call(name, attr, *args, **kwargs)
+
+        call.__name__ = name
+        return call
+
+
+def _build_configuration():
+    configuration = Configuration(access_token=os.getenv('LINE_CHANNEL_ACCESS_TOKEN', 'YOUR_CHANNEL_ACCESS_TOKEN'))
+    configuration.connection_pool_maxsize = LINE_POOL_SIZE
+    if LINE_TCP_KEEPALIVE:
+        configuration.socket_options = HTTPConnection.default_socket_options + [
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        ]
+    return configuration
+
+
+def _ensure_client():
+    global _api_client, _messaging_api, _messaging_blob_api, _owner_pid
+    # gunicorn fork 之後，子行程不可沿用父行程的連線池
+    if _api_client is not None and _owner_pid == os.getpid():
+        return
+    with _lock:
+        if _api_client is not None and _owner_pid == os.getpid():
+            return
+        timeout = (LINE_CONNECT_TIMEOUT, LINE_READ_TIMEOUT)
+        _api_client = ApiClient(_build_configuration())
+        _messaging_api = _ManagedApi(MessagingApi(_api_client), timeout, rate_limiter)
+        _messaging_blob_api = _ManagedApi(MessagingApiBlob(_api_client), timeout, rate_limiter)
+        _owner_pid = os.getpid()
+        logger.info(f"LINE API 用戶端已建立 (pool size={LINE_POOL_SIZE}, timeout={timeout})")
+
+
+def get_messaging_api():
+    """取得共用的 MessagingApi"""
+    _ensure_client()
+    return _messaging_api
+
+
+def get_messaging_blob_api():
+    """取得共用的 MessagingApiBlob（上傳/下載圖文選單圖片等）"""
+    _ensure_client()
+    return _messaging_blob_api
+
+
+@contextmanager
+def messaging_api():
+    """with messaging_api() as line_bot_api: 取得共用的 MessagingApi（離開時不會關閉連線）"""
+    yield get_messaging_api()
+
+
+def close_client():
+    """關閉共用用戶端與連線池（行程結束時呼叫）"""
+    global _api_client, _messaging_api, _messaging_blob_api, _owner_pid
+    with _lock:
+        if _api_client is None or _owner_pid != os.getpid():
+            return
+        try:
+            _api_client.close()
+            _api_client.rest_client.pool_manager.clear()
+        except Exception as e:
+            logger.error(f"關閉 LINE API 用戶端時出錯: {e}")
+        _api_client = _messaging_api = _messaging_blob_api = _owner_pid = None
+
+
+def connection_stats():
+    """回傳連線池統計：建立的連線數與請求數，兩者差即為重用的連線次數"""
+    with _lock:
+        if _api_client is None:
+            return {'connections': 0, 'requests': 0, 'reused': 0}
+        pools = _api_client.rest_client.pool_manager.pools
+        connections = requests = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            connections += pool.num_connections
+            requests += pool.num_requests
+        return {
+            'connections': connections,
+            'requests': requests,
+            'reused': max(requests - connections, 0),
+            'pool_size': LINE_POOL_SIZE,
+        }
+
+
+def rate_limit_stats():
+    """回傳各 API 類別的速率限制統計（等待秒數、收到 429 的次數）"""
+    return rate_limiter.stats()
+
+
+atexit.register(close_client)
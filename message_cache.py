@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+靜態訊息快取：
+選單類的 Flex/Template 訊息內容只會隨著設定常數改變，
+第一次建立後保留已驗證的 model 物件與序列化後的 dict，之後每次回覆直接重用。
+設定常數的指紋（fingerprint）改變時，整個快取自動失效重建。
+SDK 的 ReplyMessageRequest.to_dict() 會先以 pydantic 把整個 messages 重新序列化一次，
+因此送出時請用 message_request() 建立請求，messages 才會直接使用快取的 dict。
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+
+from pydantic.v1 import PrivateAttr
+
+logger = logging.getLogger(__name__)
+
+_frozen_classes = {}
+_frozen_classes_lock = threading.Lock()
+_request_classes = {}
+
+
+def _frozen_class(cls):
+    """為訊息類別建立一個 to_dict() 直接回傳快取內容的子類別"""
+    with _frozen_classes_lock:
+        sub = _frozen_classes.get(cls)
+        if sub is None:
+            def to_dict(self):
+                """回傳建立快取時序列化好的 dict（請勿修改回傳值）"""
+                if self._payload is None:
+                    return cls.to_dict(self)
+                return self._payload
+
+            sub = type(f"Frozen{cls.__name__}", (cls,), {
+                '__module__': __name__,
+                '_payload': PrivateAttr(None),
+                'to_dict': to_dict,
+            })
+            _frozen_classes[cls] = sub
+        return sub
+
+
+def _request_class(cls):
+    """為 Reply/Push/MulticastRequest 建立 to_dict() 不以 pydantic 序列化 messages 的子類別"""
+    with _frozen_classes_lock:
+        sub = _request_classes.get(cls)
+        if sub is None:
+            def to_dict(self):
+                _dict = self.dict(by_alias=True, exclude={'messages'}, exclude_none=True)
+                _dict['messages'] = [message.to_dict() for message in self.messages if message]
+                return _dict
+
+            sub = type(f"Fast{cls.__name__}", (cls,), {'__module__': __name__, 'to_dict': to_dict})
+            _request_classes[cls] = sub
+        return sub
+
+
+def message_request(cls, **fields):
+    """
+    建立送出訊息的請求（例如 message_request(ReplyMessageRequest, reply_token=..., messages=[...])）。
+    序列化時每則訊息只呼叫自己的 to_dict()：快取的訊息直接回傳預先序列化的 dict。
+    """
+    return _request_class(cls)(**fields)
+
+
+def freeze_message(message):
+    """將已驗證的訊息轉成帶有預先序列化內容的版本，以 message_request() 送出時不必再序列化"""
+    payload = message.to_dict()
+    frozen = _frozen_class(type(message)).construct(_fields_set=message.__fields_set__, **message.__dict__)
+    frozen._payload = payload
+    return frozen
+
+
+class MessageCache:
+    """以 key 快取訊息物件；fingerprint() 的結果改變時清空快取"""
+
+    def __init__(self, fingerprint, max_entries=256):
+        self._fingerprint = fingerprint
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self._current = None
+        self._lock = threading.Lock()
+        # 統計數據
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _check_fingerprint(self):
+        current = self._fingerprint()
+        if current != self._current:
+            if self._current is not None:
+                self.invalidations += 1
+                logger.info("訊息內容設定已變更，清除靜態訊息快取")
+            self._entries.clear()
+            self._current = current
+
+    def get(self, key, builder):
+        """取得快取的訊息；沒有快取時呼叫 builder() 建立並凍結"""
+        with self._lock:
+            self._check_fingerprint()
+            message = self._entries.get(key)
+            if message is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return message
+            self.misses += 1
+            fingerprint = self._current
+
+        message = freeze_message(builder())
+
+        with self._lock:
+            if fingerprint == self._current:
+                self._entries[key] = message
+                while len(self._entries) > self._max_entries:
+                    self._entries.popitem(last=False)
+        return message
+
+    def payload(self, key, builder):
+        """取得快取訊息序列化後的 dict（與 LINE API 的 JSON 相同）"""
+        return self.get(key, builder).to_dict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._current = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+            }
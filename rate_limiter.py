@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+LINE API 呼叫的共用速率限制：
+- 依 API 類別（reply / push / multicast / 圖文選單管理 / 其他）各有一個 token bucket
+- 呼叫前先取得 token，超過速率時在呼叫端等待，而不是被 LINE 擋下
+- 收到 429 時依 Retry-After（沒有則以指數退避加隨機抖動）暫停該類別，再重試
+- 速率以單一行程計算；多個 gunicorn worker 時請依 worker 數調低
+"""
+
+import logging
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# 各類別每秒請求數與突發量（預設略低於 LINE 公布的上限）
+RATE_LIMITS = {
+    'reply': (float(os.getenv('LINE_RATE_REPLY', '1000')), 100),
+    'push': (float(os.getenv('LINE_RATE_PUSH', '1000')), 100),
+    'multicast': (float(os.getenv('LINE_RATE_MULTICAST', '100')), 20),
+    'richmenu_admin': (float(os.getenv('LINE_RATE_RICHMENU_ADMIN', '0.025')), 10), # 建立/刪除圖文選單：每小時 100 次
+    'other': (float(os.getenv('LINE_RATE_OTHER', '1000')), 100),
+}
+RATE_LIMIT_MAX_RETRIES = int(os.getenv('LINE_RATE_MAX_RETRIES', '3')) # 收到 429 後最多重試次數
+RATE_LIMIT_MAX_WAIT = float(os.getenv('LINE_RATE_MAX_WAIT', '30')) # 單次等待的上限秒數
+
+# API 方法名稱 -> 類別
+ENDPOINT_CLASSES = {
+    'reply_message': 'reply',
+    'push_message': 'push',
+    'multicast': 'multicast',
+    'create_rich_menu': 'richmenu_admin',
+    'delete_rich_menu': 'richmenu_admin',
+    'set_rich_menu_image': 'richmenu_admin',
+}
+
+
+def endpoint_class(method_name):
+    # 只比對方法名稱前綴，*_with_http_info 等變體也歸在同一類
+    for name, cls in ENDPOINT_CLASSES.items():
+        if method_name.startswith(name):
+            return cls
+    return 'other'
+
+
+class TokenBucket:
+    """執行緒安全的 token bucket；acquire() 會等到有 token 為止"""
+
+    def __init__(self, rate, burst, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = float(burst)
+        self._updated = clock()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        # 統計數據
+        self.acquired = 0
+        self.waited = 0.0
+        self.throttled = 0
+
+    def _reserve(self):
+        """預留一個 token，回傳需要等待的秒數（token 可為負值，代表已被預約）"""
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            self.acquired += 1
+            delay = max(0.0, -self._tokens / self.rate, self._paused_until - now)
+            self.waited += delay
+            return delay
+
+    def acquire(self):
+        delay = self._reserve()
+        if delay > 0:
+            self._sleep(delay)
+        return delay
+
+    def pause(self, seconds):
+        """收到 429 時暫停此類別，所有執行緒都會等到暫停結束"""
+        with self._lock:
+            self.throttled += 1
+            self._paused_until = max(self._paused_until, self._clock() + seconds)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'rate': self.rate,
+                'acquired': self.acquired,
+                'waited': round(self.waited, 3),
+                'throttled': self.throttled,
+            }
+
+
+class RateLimiter:
+    """依 API 類別分開計算的速率限制器"""
+
+    def __init__(self, limits=None, max_retries=RATE_LIMIT_MAX_RETRIES, max_wait=RATE_LIMIT_MAX_WAIT, sleep=time.sleep):
+        limits = limits or RATE_LIMITS
+        self._buckets = {cls: TokenBucket(rate, burst, sleep=sleep) for cls, (rate, burst) in limits.items()}
+        self._max_retries = max_retries
+        self._max_wait = max_wait
+
+    def bucket(self, cls):
+        return self._buckets.get(cls) or self._buckets['other']
+
+    def _retry_after(self, error, attempt):
+        """429 時應等待的秒數：優先使用 Retry-After，否則指數退避；都加上隨機抖動避免同時重試"""
+        seconds = None
+        headers = getattr(error, 'headers', None)
+        if headers:
+            try:
+                seconds = float(headers.get('Retry-After'))
+            except (TypeError, ValueError):
+                seconds = None
+        if seconds is None:
+            seconds = 2 ** attempt
+        return min(self._max_wait, seconds * random.uniform(1.0, 1.5))
+
+    def call(self, method_name, func, *args, **kwargs):
+        """在速率限制下呼叫 func；收到 429 時等待後重試，超過重試次數則拋出原本的例外"""
+        bucket = self.bucket(endpoint_class(method_name))
+        attempt = 0
+        while True:
+            bucket.acquire()
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if getattr(e, 'status', None) != 429 or attempt >= self._max_retries:
+                    raise
+                delay = self._retry_after(e, attempt)
+                attempt += 1
+                bucket.pause(delay)
+                logger.warning(f"LINE API {method_name} 回應 429，{delay:.1f} 秒後重試（第 {attempt} 次）")
+
+    def stats(self):
+        return {cls: bucket.stats() for cls, bucket in self._buckets.items()}
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+重複事件展開：
+- Google Calendar 的重複事件（master）帶有 RRULE / EXDATE / RDATE，在本機展開成實際的各次事件
+- 以事件自己的時區（預設 Asia/Taipei）的「牆上時間」展開，UNTIL / EXDATE 的 UTC 或其他時區時間會先換算
+- 展開結果依「系列 + 版本 + 月份」快取，同一個月重複查詢不必重新計算
+- 例外事件（單次修改或取消，帶有 recurringEventId / originalStartTime）會取代對應的那一次
+"""
+
+import datetime
+import threading
+from collections import OrderedDict
+
+import pytz
+
+TW_TIMEZONE = pytz.timezone('Asia/Taipei')
+_UTC = pytz.utc
+
+
+# --- 解析 ---
+def event_timestamp(when, tz=TW_TIMEZONE):
+    """將事件的 start/end（dateTime 或全天的 date）轉為 epoch 秒"""
+    if not when:
+        return None
+    value = when.get('dateTime')
+    if value:
+        return datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    value = when.get('date')
+    if value:
+        day = datetime.date.fromisoformat(value)
+        return tz.localize(datetime.datetime.combine(day, datetime.time.min)).timestamp()
+    return None
+
+
+def _zone(when, default_tz):
+    name = (when or {}).get('timeZone')
+    if name:
+        try:
+            return pytz.timezone(name)
+        except pytz.UnknownTimeZoneError:
+            pass
+    return default_tz
+
+
+def _parse_ical_time(value, params, zone, all_day):
+    """將 iCalendar 的時間值轉為 zone 的牆上時間（naive）；全天事件回傳 date"""
+    if 'T' not in value:
+        day = datetime.datetime.strptime(value, '%Y%m%d').date()
+        return day if all_day else datetime.datetime.combine(day, datetime.time.min)
+    if value.endswith('Z'):
+        moment = _UTC.localize(datetime.datetime.strptime(value, '%Y%m%dT%H%M%SZ'))
+    else:
+        naive = datetime.datetime.strptime(value, '%Y%m%dT%H%M%S')
+        tzid = params.get('TZID')
+        moment = pytz.timezone(tzid).localize(naive) if tzid else zone.localize(naive)
+    local = moment.astimezone(zone).replace(tzinfo=None)
+    return local.date() if all_day else local
+
+
+def _split_property(line):
+    """'EXDATE;TZID=Asia/Taipei:20261020T100000' -> ('EXDATE', {'TZID': ...}, ['20261020T100000'])"""
+    head, _, value = line.partition(':')
+    name, *param_list = head.split(';')
+    params = dict(p.split('=', 1) for p in param_list if '=' in p)
+    return name.upper(), params, [v for v in value.split(',') if v]
+
+
+def _local_rrule(line, zone, all_day):
+    """把 RRULE 中以 UTC 表示的 UNTIL 換成 zone 的牆上時間，讓 dateutil 以 naive 時間展開"""
+    name, _, body = line.partition(':')
+    parts = []
+    for part in body.split(';'):
+        key, _, value = part.partition('=')
+        if key.upper() == 'UNTIL':
+            until = _parse_ical_time(value, {}, zone, False)
+            if 'T' not in value and not all_day:
+                until = until.replace(hour=23, minute=59, second=59) # UNTIL 只有日期時包含當天
+            value = until.strftime('%Y%m%dT%H%M%S')
+        parts.append(f"{key}={value}" if value else key)
+    return f"{name}:{';'.join(parts)}"
+
+
+class Series:
+    """已解析的重複事件：dtstart（牆上時間）、長度、時區與規則"""
+
+    def __init__(self, master, default_tz=TW_TIMEZONE):
+        start, end = master.get('start') or {}, master.get('end') or {}
+        self.master = master
+        self.all_day = 'date' in start and 'dateTime' not in start
+        self.zone = _zone(start, default_tz)
+        if self.all_day:
+            first = datetime.date.fromisoformat(start['date'])
+            last = datetime.date.fromisoformat(end.get('date', start['date']))
+            self.dtstart = datetime.datetime.combine(first, datetime.time.min)
+            self.duration = datetime.datetime.combine(last, datetime.time.min) - self.dtstart
+        else:
+            begin = datetime.datetime.fromisoformat(start['dateTime'].replace('Z', '+00:00'))
+            finish = datetime.datetime.fromisoformat(end.get('dateTime', start['dateTime']).replace('Z', '+00:00'))
+            self.dtstart = begin.astimezone(self.zone).replace(tzinfo=None)
+            self.duration = finish - begin
+        from dateutil.rrule import rrulestr, rruleset # 第一次展開時才匯入
+        self.rules = rruleset()
+        self.infinite = False
+        self.rules.rdate(self.dtstart)
+        for line in master.get('recurrence') or []:
+            name, params, values = _split_property(line)
+            if name in ('RRULE', 'EXRULE'):
+                rule = rrulestr(_local_rrule(line, self.zone, self.all_day).partition(':')[2], dtstart=self.dtstart)
+                if name == 'RRULE':
+                    self.rules.rrule(rule)
+                    if 'UNTIL=' not in line.upper() and 'COUNT=' not in line.upper():
+                        self.infinite = True
+                else:
+                    self.rules.exrule(rule)
+            elif name in ('EXDATE', 'RDATE'):
+                for value in values:
+                    moment = _parse_ical_time(value, params, self.zone, False)
+                    if name == 'RDATE':
+                        self.rules.rdate(moment)
+                    elif 'T' in value or self.all_day:
+                        self.rules.exdate(moment)
+                    else:
+                        # 計時事件的 EXDATE 只有日期：排除當天那一次
+                        self.rules.exdate(datetime.datetime.combine(moment.date(), self.dtstart.time()))
+
+    def starts_between(self, start, end):
+        """回傳開始時間（牆上時間 naive）落在 [start, end) 的各次"""
+        return [moment for moment in self.rules.between(start, end, inc=True) if moment < end]
+
+    def last_end(self):
+        """最後一次的結束時間（epoch 秒）；無限重複時回傳 None"""
+        if self.infinite:
+            return None
+        last = None
+        for last in self.rules:
+            pass
+        return self._timestamp(last or self.dtstart) + self.duration.total_seconds()
+
+    def _timestamp(self, moment):
+        return self.zone.localize(moment).timestamp()
+
+    def occurrence(self, moment):
+        """依照 Google 單次事件（singleEvents=True）的格式產生一次事件"""
+        master = self.master
+        event = {key: value for key, value in master.items() if key not in ('recurrence', 'id')}
+        finish = moment + self.duration
+        if self.all_day:
+            event['id'] = f"{master['id']}_{moment:%Y%m%d}"
+            event['start'] = {'date': moment.date().isoformat()}
+            event['end'] = {'date': finish.date().isoformat()}
+            event['originalStartTime'] = dict(event['start'])
+        else:
+            begin = self.zone.localize(moment)
+            utc = begin.astimezone(_UTC)
+            event['id'] = f"{master['id']}_{utc:%Y%m%dT%H%M%SZ}"
+            event['start'] = {'dateTime': begin.isoformat(), 'timeZone': self.zone.zone}
+            event['end'] = {'dateTime': self.zone.localize(finish).isoformat(), 'timeZone': self.zone.zone}
+            event['originalStartTime'] = dict(event['start'])
+        event['recurringEventId'] = master['id']
+        return event
+
+
+def is_master(event):
+    return bool(event.get('recurrence')) and not event.get('recurringEventId')
+
+
+def original_start_timestamp(event):
+    """例外事件原本那一次的開始時間（epoch 秒）"""
+    return event_timestamp(event.get('originalStartTime'))
+
+
+def series_end(master, default_tz=TW_TIMEZONE):
+    """重複事件最後一次的結束時間（epoch 秒）；無限重複時回傳 None"""
+    return Series(master, default_tz).last_end()
+
+
+def _duration_hint(master):
+    start = event_timestamp(master.get('start'))
+    end = event_timestamp(master.get('end'))
+    return max(0.0, end - start) if start is not None and end is not None else 0.0
+
+
+def _months(start, end):
+    """[start, end) 涵蓋的 (年, 月)"""
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        yield year, month
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+class RecurrenceExpander:
+    """展開重複事件並依「系列 + 版本 + 月份」快取"""
+
+    def __init__(self, default_tz=TW_TIMEZONE, max_entries=2048):
+        self._default_tz = default_tz
+        self._max_entries = max_entries
+        self._cache = OrderedDict() # (系列, 版本, 年, 月) -> [(開始, 結束, 事件)]
+        self._series = OrderedDict() # (系列, 版本) -> Series
+        self._lock = threading.Lock()
+        # 統計數據
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, master):
+        return f"{master.get('calendarId', '')}/{master['id']}", master.get('etag') or master.get('updated') or ''
+
+    def _get_series(self, key, master):
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = Series(master, self._default_tz)
+            while len(self._series) > self._max_entries:
+                self._series.popitem(last=False)
+        else:
+            self._series.move_to_end(key)
+        return series
+
+    def _month(self, master, year, month):
+        key = self._key(master)
+        cache_key = (*key, year, month)
+        with self._lock:
+            cached = self._cache.get(cache_key)
+            if cached is not None:
+                self._cache.move_to_end(cache_key)
+                self.hits += 1
+                return cached
+            self.misses += 1
+            series = self._get_series(key, master)
+        first = datetime.datetime(year, month, 1)
+        after = datetime.datetime(year + 1, 1, 1) if month == 12 else datetime.datetime(year, month + 1, 1)
+        occurrences = []
+        for moment in series.starts_between(first, after):
+            event = series.occurrence(moment)
+            begin = event_timestamp(event['start'], self._default_tz)
+            occurrences.append((begin, begin + series.duration.total_seconds(), event))
+        with self._lock:
+            self._cache[cache_key] = occurrences
+            while len(self._cache) > self._max_entries:
+                self._cache.popitem(last=False)
+        return occurrences
+
+    def occurrences(self, master, start, end):
+        """回傳與 [start, end)（epoch 秒）重疊的各次事件 [(開始, 結束, 事件)]，依開始時間排序"""
+        zone = _zone(master.get('start'), self._default_tz)
+        duration = _duration_hint(master)
+        first = datetime.datetime.fromtimestamp(start - duration, zone)
+        last = datetime.datetime.fromtimestamp(end - 1, zone)
+        result = []
+        for year, month in _months(first, last):
+            for begin, finish, event in self._month(master, year, month):
+                if begin < end and finish > start:
+                    result.append((begin, finish, event))
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {'months_cached': len(self._cache), 'hits': self.hits, 'misses': self.misses}
+
+
+
+def expand_events(events, start, end, expander):
+    """
+    將事件列表（單次事件、重複事件 master、例外事件）轉成 [start, end)（epoch 秒）內的實際各次事件，依開始時間排序。
+    被例外事件取代或取消的那一次不會出現；未取消的例外事件本身照常列出。
+    """
+    overridden = {} # 系列 -> 被取代的原始開始時間
+    for event in events:
+        series_id = event.get('recurringEventId')
+        if series_id:
+            key = f"{event.get('calendarId', '')}/{series_id}"
+            overridden.setdefault(key, set()).add(original_start_timestamp(event))
+    result = []
+    for event in events:
+        if event.get('status') == 'cancelled':
+            continue
+        if is_master(event):
+            skip = overridden.get(f"{event.get('calendarId', '')}/{event['id']}", ())
+            for begin, finish, occurrence in expander.occurrences(event, start, end):
+                if begin not in skip:
+                    result.append((begin, occurrence))
+            continue
+        begin = event_timestamp(event.get('start'))
+        finish = event_timestamp(event.get('end'))
+        if begin is not None and finish is not None and begin < end and finish > start:
+            result.append((begin, event))
+    result.sort(key=lambda item: item[0])
+    return [event for _, event in result]
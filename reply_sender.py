@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+回覆訊息（reply token 期限感知）：
+- reply token 在事件發生後不久就會失效，期限以事件的 timestamp 計算
+- 剩餘時間足夠時使用 reply_message；快到期、已過期或 LINE 回應 reply token 無效時，
+  改用 push_message 把同樣的內容送給用戶（push 會計入每月訊息額度）
+- push 使用由 webhookEventId 產生的固定 X-Line-Retry-Key，事件重送時不會重複推播
+- 統計兩種路徑的使用次數與回覆當下剩餘的秒數
+"""
+
+import logging
+import os
+import threading
+import time
+import uuid
+
+from linebot.v3.messaging import PushMessageRequest, ReplyMessageRequest
+
+from message_cache import message_request
+
+logger = logging.getLogger(__name__)
+
+REPLY_TOKEN_TTL = float(os.getenv('REPLY_TOKEN_TTL', '60')) # 事件發生後 reply token 的有效秒數（保守估計）
+REPLY_SAFETY_MARGIN = float(os.getenv('REPLY_SAFETY_MARGIN', '5')) # 剩餘秒數低於此值就改用 push
+
+# 回覆當下剩餘秒數的統計區間（秒）
+_REMAINING_BUCKETS = (5, 15, 30, 45)
+
+
+def reply_deadline(event):
+    """回傳 reply token 的到期時間（epoch 秒）；事件沒有 timestamp 時回傳 None"""
+    timestamp = getattr(event, 'timestamp', None)
+    if not timestamp:
+        return None
+    return timestamp / 1000.0 + REPLY_TOKEN_TTL
+
+
+def _push_target(event):
+    source = getattr(event, 'source', None)
+    for attr in ('user_id', 'group_id', 'room_id'):
+        target = getattr(source, attr, None)
+        if target:
+            return target
+    return None
+
+
+def _is_invalid_reply_token(error):
+    if getattr(error, 'status', None) != 400:
+        return False
+    body = getattr(error, 'body', None) or b''
+    if isinstance(body, bytes):
+        body = body.decode('utf-8', 'replace')
+    return 'reply token' in body.lower()
+
+
+class ReplyStats:
+    """reply / push 路徑的統計數據"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.replied = 0
+        self.pushed_deadline = 0 # 接近或超過期限，直接改用 push
+        self.pushed_invalid = 0 # reply 失敗（token 無效）後改用 push
+        self.failed = 0
+        self.remaining = {f"<{b}s": 0 for b in _REMAINING_BUCKETS}
+        self.remaining[f">={_REMAINING_BUCKETS[-1]}s"] = 0
+        self.remaining_min = None
+        self._remaining_total = 0.0
+        self._remaining_count = 0
+
+    def observe_remaining(self, remaining):
+        with self._lock:
+            for b in _REMAINING_BUCKETS:
+                if remaining < b:
+                    self.remaining[f"<{b}s"] += 1
+                    break
+            else:
+                self.remaining[f">={_REMAINING_BUCKETS[-1]}s"] += 1
+            if self.remaining_min is None or remaining < self.remaining_min:
+                self.remaining_min = remaining
+            self._remaining_total += remaining
+            self._remaining_count += 1
+
+    def count(self, field):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'replied': self.replied,
+                'pushed_deadline': self.pushed_deadline,
+                'pushed_invalid_token': self.pushed_invalid,
+                'failed': self.failed,
+                'remaining_seconds': dict(self.remaining),
+                'remaining_min': None if self.remaining_min is None else round(self.remaining_min, 2),
+                'remaining_avg': round(self._remaining_total / self._remaining_count, 2) if self._remaining_count else None,
+            }
+
+
+reply_stats = ReplyStats()
+
+
+def _push(line_bot_api, event, messages):
+    target = _push_target(event)
+    if not target:
+        raise ValueError("事件沒有可推播的對象")
+    event_id = getattr(event, 'webhook_event_id', None)
+    retry_key = str(uuid.uuid5(uuid.NAMESPACE_URL, f"xuantian-reply-fallback/{event_id}")) if event_id else None
+    line_bot_api.push_message(
+        message_request(PushMessageRequest, to=target, messages=messages),
+        x_line_retry_key=retry_key
+    )
+
+
+def send_reply(line_bot_api, event, messages):
+    """
+    回覆 event，必要時改用 push。回傳實際使用的路徑：'reply' / 'push'。
+    送出失敗時拋出例外（與直接呼叫 reply_message 相同）。
+    """
+    deadline = reply_deadline(event)
+    remaining = None if deadline is None else deadline - time.time()
+    if remaining is not None:
+        reply_stats.observe_remaining(remaining)
+    left = None if remaining is None else round(remaining, 1)
+
+    if event.reply_token and (remaining is None or remaining > REPLY_SAFETY_MARGIN):
+        try:
+            line_bot_api.reply_message(
+                message_request(ReplyMessageRequest, reply_token=event.reply_token, messages=messages)
+            )
+            reply_stats.count('replied')
+            return 'reply'
+        except Exception as e:
+            if not _is_invalid_reply_token(e):
+                reply_stats.count('failed')
+                raise
+            logger.warning(f"reply token 已失效（剩餘 {left} 秒），改用 push 回覆")
+            field = 'pushed_invalid'
+    else:
+        logger.info(f"reply token 即將到期或不存在（剩餘 {left} 秒），改用 push 回覆")
+        field = 'pushed_deadline'
+
+    try:
+        _push(line_bot_api, event, messages)
+    except Exception as e:
+        # 409：相同 retry key 的推播先前已送出（例如事件重送）
+        if getattr(e, 'status', None) != 409:
+            reply_stats.count('failed')
+            raise
+    reply_stats.count(field)
+    return 'push'
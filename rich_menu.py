@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+圖文選單佈署（冪等）：
+- 以選單定義與圖片內容計算雜湊，寫在選單名稱後面（例如 XuanTian_RichMenu_v2#1a2b3c4d5e6f），並記錄在本機狀態檔
+- 狀態檔的雜湊相同時不呼叫任何 API；狀態檔不存在（例如重新部署）時只查詢目前的預設選單確認
+- 內容有變動時先建立新選單、上傳圖片並設為預設，成功後才刪除舊版選單；
+  舊選單延後 retire_delay 秒刪除，讓其他 worker 快取中的舊 ID 先過期，用戶不會連結到已刪除的選單
+- 新選單建立失敗時刪除未完成的選單，原本的預設選單保持不變
+- 找不到選單圖片時不建立新選單（LINE 不接受沒有圖片的預設選單），保留目前的預設選單
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from linebot.v3.messaging import RichMenuRequest
+
+logger = logging.getLogger(__name__)
+
+HASH_SEPARATOR = '#'
+HASH_LENGTH = 12
+
+
+def menu_hash(definition, image):
+    """選單定義（不含名稱）與圖片內容的雜湊"""
+    content = {key: value for key, value in definition.items() if key != 'name'}
+    digest = hashlib.sha256(json.dumps(content, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    digest.update(image or b'')
+    return digest.hexdigest()[:HASH_LENGTH]
+
+
+def _read_state(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_state(path, state):
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+
+def _current_default(line_bot_api):
+    """回傳目前預設選單的 (id, 名稱)；沒有預設選單時回傳 (None, None)"""
+    try:
+        rich_menu_id = line_bot_api.get_default_rich_menu_id().rich_menu_id
+    except Exception as e:
+        if getattr(e, 'status', None) == 404:
+            return None, None
+        raise
+    return rich_menu_id, line_bot_api.get_rich_menu(rich_menu_id).name
+
+
+def _retire(line_bot_api, base_name, keep_id):
+    """刪除同名（不論雜湊）但不是 keep_id 的舊版選單"""
+    for menu in line_bot_api.get_rich_menu_list().richmenus:
+        if menu.rich_menu_id == keep_id or menu.name.split(HASH_SEPARATOR)[0] != base_name:
+            continue
+        try:
+            line_bot_api.delete_rich_menu(menu.rich_menu_id)
+            logger.info(f"已刪除舊版圖文選單 {menu.name}（{menu.rich_menu_id}）")
+        except Exception as e:
+            logger.error(f"刪除舊版圖文選單 {menu.rich_menu_id} 時出錯: {e}")
+
+
+def provision_rich_menu(line_bot_api, blob_api, definition, image_path, state_path,
+                        on_changed=None, retire_delay=0):
+    """
+    確保預設圖文選單與 definition / image_path 一致，回傳預設選單 ID。
+    - on_changed(rich_menu_id)：預設選單換成新版後呼叫（例如清除快取）（選填）
+    - retire_delay：新版設為預設後，延後多少秒刪除舊版選單
+    """
+    image = None
+    if image_path and os.path.exists(image_path):
+        with open(image_path, 'rb') as f:
+            image = f.read()
+    base_name = definition['name'].split(HASH_SEPARATOR)[0]
+    digest = menu_hash(definition, image)
+    name = f"{base_name}{HASH_SEPARATOR}{digest}"
+
+    # 1. 本機狀態相同：不需要任何 API 呼叫
+    state = _read_state(state_path)
+    if state.get('hash') == digest and state.get('rich_menu_id'):
+        logger.info(f"圖文選單未變動（{name}），略過設定")
+        return state['rich_menu_id']
+
+    # 2. 目前的預設選單就是這個版本（例如重新部署後沒有狀態檔）
+    default_id, default_name = _current_default(line_bot_api)
+    if default_name == name:
+        _write_state(state_path, {'hash': digest, 'rich_menu_id': default_id})
+        logger.info(f"預設圖文選單已是最新版本（{name}）")
+        return default_id
+
+    # 沒有圖片的選單無法設為預設：不建立新版，也不記錄狀態，等圖片就緒後再佈署
+    if image is None:
+        logger.warning(f"找不到圖文選單圖片 {image_path}，保留目前的預設選單 {default_id}（{default_name}）")
+        return default_id
+
+    # 3. 建立新版、上傳圖片並設為預設，成功後才記錄狀態並移除舊版
+    rich_menu_id = line_bot_api.create_rich_menu(RichMenuRequest.from_dict(dict(definition, name=name))).rich_menu_id
+    try:
+        blob_api.set_rich_menu_image(rich_menu_id=rich_menu_id, body=image, _headers={'Content-Type': 'image/jpeg'})
+        line_bot_api.set_default_rich_menu(rich_menu_id=rich_menu_id)
+    except Exception:
+        logger.error(f"設定新版圖文選單 {rich_menu_id} 失敗，保留原本的預設選單 {default_id}")
+        try:
+            line_bot_api.delete_rich_menu(rich_menu_id)
+        except Exception as e:
+            logger.error(f"刪除未完成的圖文選單 {rich_menu_id} 時出錯: {e}")
+        raise
+    _write_state(state_path, {'hash': digest, 'rich_menu_id': rich_menu_id})
+    logger.info(f"已將圖文選單 {name}（{rich_menu_id}）設為預設（原本為 {default_id}）")
+    if on_changed:
+        on_changed(rich_menu_id)
+
+    if retire_delay > 0:
+        timer = threading.Timer(retire_delay, _retire, args=(line_bot_api, base_name, rich_menu_id))
+        timer.daemon = True
+        timer.start()
+    else:
+        _retire(line_bot_api, base_name, rich_menu_id)
+    return rich_menu_id
@@ -1,110 +1,96 @@
 import os
-import json
 import datetime
 import time
 import logging
+import uuid
 import pytz
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from linebot import LineBotApi
-from linebot.models import TextSendMessage
+import calendar_client
+from broadcast import push_each
+from calendar_mirror import CalendarMirror
+from db import data_path
+from linebot.v3.messaging import TextMessage
 from dotenv import load_dotenv
 
 # 載入環境變數
 load_dotenv()
 
-# 設定日誌
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler()]
-)
 logger = logging.getLogger(__name__)
 
-# LINE Bot API 設定
-CHANNEL_ACCESS_TOKEN = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN', '')
-line_bot_api = LineBotApi(CHANNEL_ACCESS_TOKEN)
-
 # 接收通知的使用者 ID 列表（管理者）
-ADMIN_USER_IDS = os.environ.get('ADMIN_USER_IDS', '').split(',')
+ADMIN_USER_IDS = [user_id.strip() for user_id in os.environ.get('ADMIN_USER_IDS', '').split(',') if user_id.strip()]
+ADMIN_PUSH_CONCURRENCY = int(os.environ.get('ADMIN_PUSH_CONCURRENCY', '8')) # 同時推播給管理者的數量上限
 
 # Google Calendar API 設定
-SCOPES = ['https://www.googleapis.com/auth/calendar.readonly']
 calendar_id = os.environ.get('GOOGLE_CALENDAR_ID', '')
 
 # 時區設定
 TW_TIMEZONE = pytz.timezone('Asia/Taipei')
 
+# 日曆本機鏡像：以 syncToken 增量同步，查詢直接讀本機資料庫
+calendar_mirror = CalendarMirror(
+    data_path('calendar.db'),
+    calendar_id,
+    sync_interval=int(os.environ.get('CALENDAR_SYNC_INTERVAL', '300'))
+)
+
 def get_google_calendar_service():
-    """獲取Google Calendar API服務"""
-    json_str = os.environ.get('GOOGLE_CREDENTIALS', '')
-    if not json_str:
-        return None
-    
-    credentials_info = json.loads(json_str)
-    credentials = service_account.Credentials.from_service_account_info(
-        credentials_info, scopes=SCOPES)
-    service = build('calendar', 'v3', credentials=credentials)
-    return service
+    """獲取Google Calendar API服務（整個行程共用，只在第一次呼叫時建立）"""
+    return calendar_client.get_calendar_service()
+
+def notify_admins(text, notice_id, label):
+    """
+    以共用的 LINE 用戶端（v3 SDK）同時推播給所有管理者，回傳 {user_id: None（已送出）或錯誤訊息}。
+    同一個 notice_id 的推播使用固定的 X-Line-Retry-Key，排程補跑時不會重複發送。
+    """
+    results = push_each(
+        ADMIN_USER_IDS,
+        [TextMessage(text=text)],
+        concurrency=ADMIN_PUSH_CONCURRENCY,
+        retry_key_for=lambda user_id: str(uuid.uuid5(uuid.NAMESPACE_URL, f"xuantian-admin/{notice_id}/{user_id}")),
+        is_success=lambda e: getattr(e, 'status', None) == 409 # 相同 retry key 的推播先前已送出
+    )
+    for user_id, error in results.items():
+        if error is None:
+            logger.info(f"已發送{label}給用戶 {user_id}")
+        else:
+            logger.error(f"發送訊息給用戶 {user_id} 時出錯：{error}")
+    return results
 
 def get_tomorrow_events():
-    """獲取明天的所有事件"""
-    service = get_google_calendar_service()
-    if not service:
+    """獲取明天的所有事件（讀取本機鏡像）"""
+    if not get_google_calendar_service():
         logger.error("無法連接Google日曆")
         return None
     
     # 設定查詢時間範圍（明天）
     tomorrow = datetime.datetime.now(TW_TIMEZONE).date() + datetime.timedelta(days=1)
-    start_time = datetime.datetime.combine(tomorrow, datetime.time.min).astimezone(TW_TIMEZONE)
-    end_time = datetime.datetime.combine(tomorrow, datetime.time.max).astimezone(TW_TIMEZONE)
-    
-    start_time_str = start_time.isoformat()
-    end_time_str = end_time.isoformat()
+    start_time = TW_TIMEZONE.localize(datetime.datetime.combine(tomorrow, datetime.time.min))
+    end_time = start_time + datetime.timedelta(days=1)
     
     try:
-        events_result = service.events().list(
-            calendarId=calendar_id,
-            timeMin=start_time_str,
-            timeMax=end_time_str,
-            singleEvents=True,
-            orderBy='startTime'
-        ).execute()
-        
-        events = events_result.get('items', [])
-        return events
+        return calendar_mirror.events_between(start_time, end_time)
     except Exception as e:
         logger.error(f"獲取日曆事件時出錯：{str(e)}")
         return None
 
 def get_monthly_events():
-    """獲取本月固定行程"""
-    service = get_google_calendar_service()
-    if not service:
+    """獲取本月的所有事件（讀取本機鏡像）"""
+    if not get_google_calendar_service():
         logger.error("無法連接Google日曆")
         return None
     
     # 設定查詢時間範圍（本月）
     now = datetime.datetime.now(TW_TIMEZONE)
-    first_day = datetime.datetime(now.year, now.month, 1).astimezone(TW_TIMEZONE)
+    first_day = TW_TIMEZONE.localize(datetime.datetime(now.year, now.month, 1))
     
     # 計算下個月的第一天
     if now.month == 12:
-        next_month = datetime.datetime(now.year + 1, 1, 1).astimezone(TW_TIMEZONE)
+        next_month = TW_TIMEZONE.localize(datetime.datetime(now.year + 1, 1, 1))
     else:
-        next_month = datetime.datetime(now.year, now.month + 1, 1).astimezone(TW_TIMEZONE)
+        next_month = TW_TIMEZONE.localize(datetime.datetime(now.year, now.month + 1, 1))
     
     try:
-        events_result = service.events().list(
-            calendarId=calendar_id,
-            timeMin=first_day.isoformat(),
-            timeMax=next_month.isoformat(),
-            singleEvents=False,  # 獲取重複事件
-            orderBy='startTime'
-        ).execute()
-        
-        events = events_result.get('items', [])
-        return events
+        return calendar_mirror.events_between(first_day, next_month)
     except Exception as e:
         logger.error(f"獲取月度事件時出錯：{str(e)}")
         return None
@@ -138,16 +124,8 @@ def send_daily_reminder():
             message += f"{idx}. {time_str} {summary}\n"
     
     # 發送訊息給管理者
-    for user_id in ADMIN_USER_IDS:
-        if user_id:
-            try:
-                line_bot_api.push_message(
-                    user_id,
-                    TextSendMessage(text=message)
-                )
-                logger.info(f"已發送每日提醒給用戶 {user_id}")
-            except Exception as e:
-                logger.error(f"發送訊息給用戶 {user_id} 時出錯：{str(e)}")
+    tomorrow = datetime.datetime.now(TW_TIMEZONE).date() + datetime.timedelta(days=1)
+    return notify_admins(message, f"daily-reminder/{tomorrow.isoformat()}", "每日提醒")
 
 def is_in_mainland_china(month):
     """檢查指定月份是否在大陸地區"""
@@ -163,19 +141,11 @@ def send_monthly_status():
         message = f"{current_month}月命理師在大陸地區，無法進行法事，請知悉。"
         
         # 發送訊息給管理者
-        for user_id in ADMIN_USER_IDS:
-            if user_id:
-                try:
-                    line_bot_api.push_message(
-                        user_id,
-                        TextSendMessage(text=message)
-                    )
-                    logger.info(f"已發送月度狀態給用戶 {user_id}")
-                except Exception as e:
-                    logger.error(f"發送訊息給用戶 {user_id} 時出錯：{str(e)}")
+        return notify_admins(message, f"monthly-status/{now.year}-{current_month:02d}", "月度狀態")
+    return {}
 
 def main_scheduler():
-    """主排程函數，每天運行一次"""
+    """手動執行一次每日排程（明天行程提醒；月初另發送月度狀態）"""
     logger.info("開始運行排程")
     
     # 發送明天的行程提醒
@@ -189,7 +159,13 @@ def main_scheduler():
     logger.info("排程完成")
 
 if __name__ == "__main__":
-    # 可以直接運行這個腳本進行測試
+    # 設定日誌
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[logging.StreamHandler()]
+    )
+    # 可以直接運行這個腳本進行測試（正式環境由 app.py 的排程服務定時執行）
     main_scheduler()
     
     # 實際部署時，可以使用以下代碼每天自動執行
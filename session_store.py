@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+用戶對話狀態（例如法事多選中的項目）：
+- 閒置超過 idle_timeout 秒自動過期；數量超過 max_sessions 時淘汰最久沒用的
+- 過期時間放在 heap 裡，每次存取只處理已到期的項目，不必掃描全部狀態
+- 最近過期的用戶會留下標記，讓處理函式可以提示「選擇已逾時，請重新開始」
+"""
+
+import heapq
+import threading
+import time
+from collections import OrderedDict
+
+
+class SessionStore:
+    """有閒置逾時與數量上限的狀態儲存，用法與 dict 相近"""
+
+    def __init__(self, idle_timeout=1800, max_sessions=10000, expired_memory=3600, clock=time.monotonic):
+        self._idle_timeout = idle_timeout
+        self._max_sessions = max_sessions
+        self._expired_memory = expired_memory
+        self._clock = clock
+        self._sessions = OrderedDict() # user_id -> [狀態, 到期時間]，依最近使用排序
+        self._heap = [] # (到期時間, user_id)；狀態被更新後舊的項目留在 heap 中，取出時再比對
+        self._expired = OrderedDict() # 最近過期的 user_id -> 標記保留到期時間
+        self._lock = threading.RLock()
+        # 統計數據
+        self.created = 0
+        self.expired = 0
+        self.evicted = 0
+
+    # --- 內部 ---
+    def _schedule(self, user_id, now):
+        deadline = now + self._idle_timeout
+        self._sessions[user_id][1] = deadline
+        self._sessions.move_to_end(user_id)
+        heapq.heappush(self._heap, (deadline, user_id))
+        # heap 中過時的項目太多時重建，避免 heap 無限成長
+        if len(self._heap) > 2 * len(self._sessions) + 64:
+            self._heap = [(entry[1], uid) for uid, entry in self._sessions.items()]
+            heapq.heapify(self._heap)
+
+    def _expire(self, now):
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            deadline, user_id = heapq.heappop(heap)
+            entry = self._sessions.get(user_id)
+            if entry is not None and entry[1] == deadline:
+                del self._sessions[user_id]
+                self._mark_expired(user_id, now)
+                self.expired += 1
+        while self._expired:
+            user_id, until = next(iter(self._expired.items()))
+            if until > now and len(self._expired) <= self._max_sessions:
+                break
+            self._expired.popitem(last=False)
+
+    def _mark_expired(self, user_id, now):
+        self._expired[user_id] = now + self._expired_memory
+        self._expired.move_to_end(user_id)
+
+    # --- dict 介面 ---
+    def get(self, user_id, default=None):
+        """取得狀態並重新計算閒置時間"""
+        with self._lock:
+            now = self._clock()
+            self._expire(now)
+            entry = self._sessions.get(user_id)
+            if entry is None:
+                return default
+            self._schedule(user_id, now)
+            return entry[0]
+
+    def __getitem__(self, user_id):
+        value = self.get(user_id, _MISSING)
+        if value is _MISSING:
+            raise KeyError(user_id)
+        return value
+
+    def __setitem__(self, user_id, value):
+        with self._lock:
+            now = self._clock()
+            self._expire(now)
+            if user_id not in self._sessions:
+                self.created += 1
+                self._sessions[user_id] = [value, 0.0]
+                # 超過數量上限時淘汰最久沒使用的狀態
+                while len(self._sessions) > self._max_sessions:
+                    evicted_id, _ = self._sessions.popitem(last=False)
+                    self._mark_expired(evicted_id, now)
+                    self.evicted += 1
+            else:
+                self._sessions[user_id][0] = value
+            self._expired.pop(user_id, None)
+            self._schedule(user_id, now)
+
+    def __delitem__(self, user_id):
+        with self._lock:
+            del self._sessions[user_id]
+
+    def pop(self, user_id, default=None):
+        with self._lock:
+            entry = self._sessions.pop(user_id, None)
+            return default if entry is None else entry[0]
+
+    def __contains__(self, user_id):
+        with self._lock:
+            self._expire(self._clock())
+            return user_id in self._sessions
+
+    def __len__(self):
+        with self._lock:
+            self._expire(self._clock())
+            return len(self._sessions)
+
+    # --- 過期處理 ---
+    def pop_expired(self, user_id):
+        """若此用戶的狀態最近因逾時被清除，回傳 True 並清除標記"""
+        with self._lock:
+            self._expire(self._clock())
+            return self._expired.pop(user_id, None) is not None
+
+    def stats(self):
+        with self._lock:
+            self._expire(self._clock())
+            return {
+                'live': len(self._sessions),
+                'created': self.created,
+                'expired': self.expired,
+                'evicted': self.evicted,
+                'idle_timeout': self._idle_timeout,
+                'max_sessions': self._max_sessions,
+            }
+
+
+_MISSING = object()
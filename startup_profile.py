@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+冷啟動分析（設定 STARTUP_PROFILE=1 時啟用，未啟用時所有函式都不做任何事）：
+- 記錄每個頂層套件的匯入耗時（不含它再匯入的其他套件），依耗時排序輸出，總和即為匯入總時間
+- 記錄各啟動階段（例如 app 建立完成、第一個請求完成）距離開始分析的時間
+- 結果輸出到 stderr（gunicorn 尚未設定日誌時也看得到），每行以 [startup] 開頭
+"""
+
+import builtins
+import os
+import sys
+import threading
+import time
+
+ENABLED = os.getenv('STARTUP_PROFILE', '').lower() in ('1', 'true')
+
+_started = time.perf_counter()
+_original_import = builtins.__import__
+_main_thread = threading.get_ident()
+_stack = [] # 匯入中的 [套件, 開始時間, 子套件耗時]
+_import_times = {} # 頂層套件 -> 秒
+_phases = {} # 階段名稱 -> 距離開始的秒數
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    # 只記錄主執行緒第一次匯入的絕對匯入
+    if level or name in sys.modules or threading.get_ident() != _main_thread:
+        return _original_import(name, globals, locals, fromlist, level)
+    frame = [name.partition('.')[0], time.perf_counter(), 0.0]
+    _stack.append(frame)
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        _stack.pop()
+        elapsed = time.perf_counter() - frame[1]
+        _import_times[frame[0]] = _import_times.get(frame[0], 0.0) + elapsed - frame[2]
+        if _stack:
+            _stack[-1][2] += elapsed
+
+
+def enable():
+    """開始記錄匯入時間（請在匯入其他套件之前呼叫）"""
+    global _started
+    if ENABLED and builtins.__import__ is not _timed_import:
+        _started = time.perf_counter()
+        builtins.__import__ = _timed_import
+
+
+def mark(phase):
+    """記錄某個階段第一次完成的時間"""
+    if ENABLED and phase not in _phases:
+        _phases[phase] = time.perf_counter() - _started
+        print(f"[startup] {phase}: {_phases[phase] * 1000:.1f} ms", file=sys.stderr, flush=True)
+
+
+def report(limit=15):
+    """停止記錄匯入時間並輸出耗時最多的套件；回傳 {套件: 毫秒}"""
+    if not ENABLED:
+        return {}
+    if builtins.__import__ is _timed_import:
+        builtins.__import__ = _original_import
+    ranked = sorted(_import_times.items(), key=lambda item: item[1], reverse=True)
+    total = sum(_import_times.values())
+    print(f"[startup] imports total: {total * 1000:.1f} ms", file=sys.stderr)
+    for package, seconds in ranked[:limit]:
+        print(f"[startup]   {package:<28} {seconds * 1000:8.1f} ms", file=sys.stderr)
+    sys.stderr.flush()
+    return {package: round(seconds * 1000, 1) for package, seconds in ranked}
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+群發工作測試：
+- 同一個行程中同時執行同一個工作時，只有一次執行會送出
+- 過期的工作不再續傳；重試次數用完的批次不再重送
+
+執行方式：
+    python -m pytest test_broadcast_jobs.py
+"""
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+os.environ.setdefault('DATA_DIR', tempfile.mkdtemp(prefix='broadcast-jobs-test-'))
+
+from linebot.v3.messaging import TextMessage
+
+import broadcast_jobs
+
+
+USER_ID = 'U' + '0' * 32
+
+
+class FakeSummary:
+    def as_dict(self):
+        return {'sent': 0, 'failed': 0}
+
+
+def failing_broadcast(sent_batches):
+    """每一批都送出失敗的 broadcast()，記錄實際嘗試送出的批次"""
+    def fake_broadcast(client, messages, on_batch_done=None, batches=(), **kwargs):
+        for batch_no, user_ids in batches:
+            sent_batches.append(batch_no)
+            on_batch_done(batch_no, user_ids, False, 'timeout')
+        return FakeSummary()
+    return fake_broadcast
+
+
+class ConcurrentClaimTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        patcher = mock.patch.object(broadcast_jobs, 'JOBS_DB_PATH', os.path.join(self._tmp.name, 'jobs.db'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self._tmp.cleanup)
+
+    def test_claims_from_same_process_are_exclusive(self):
+        job_id = broadcast_jobs.create_job('job-1', [TextMessage(text='hello')])
+        owners = [broadcast_jobs._new_owner(), broadcast_jobs._new_owner()]
+        barrier = threading.Barrier(len(owners))
+        results = []
+
+        def claim(owner):
+            barrier.wait()
+            results.append(broadcast_jobs._claim(job_id, owner))
+
+        threads = [threading.Thread(target=claim, args=(owner,)) for owner in owners]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results), [False, True])
+
+    def test_run_job_skips_while_same_process_run_is_sending(self):
+        job_id = broadcast_jobs.create_job('job-2', [TextMessage(text='hello')])
+        sending = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def fake_broadcast(*args, **kwargs):
+            calls.append(threading.current_thread().name)
+            sending.set()
+            release.wait(5)
+            return FakeSummary()
+
+        with mock.patch.object(broadcast_jobs, 'broadcast', fake_broadcast):
+            first = threading.Thread(target=broadcast_jobs.run_job, args=(job_id, lambda cursor: iter(['U1'])))
+            first.start()
+            self.assertTrue(sending.wait(5))
+            # 例如排程補跑與 resume 執行緒同時觸發同一個工作
+            self.assertIsNone(broadcast_jobs.run_job(job_id, lambda cursor: iter(['U1'])))
+            release.set()
+            first.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertIsNone(broadcast_jobs.job_status(job_id)['owner'])
+
+
+class ExpiryAndAttemptsTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        patcher = mock.patch.object(broadcast_jobs, 'JOBS_DB_PATH', os.path.join(self._tmp.name, 'jobs.db'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self._tmp.cleanup)
+
+    def test_expired_job_is_abandoned_instead_of_resumed(self):
+        job_id = broadcast_jobs.create_job('weekly-fortune-2026-W40', [TextMessage(text='hello')])
+        sent_batches = []
+        with mock.patch.object(broadcast_jobs, 'broadcast', failing_broadcast(sent_batches)):
+            broadcast_jobs.run_job(job_id, lambda cursor: iter([USER_ID] if not cursor else []))
+            self.assertEqual(sent_batches, [0])
+            # 超過有效期間（例如數週後 worker 重啟）
+            with mock.patch.object(time, 'time', return_value=time.time() + broadcast_jobs.JOB_TTL + 1):
+                results = broadcast_jobs.resume_unfinished_jobs(lambda cursor: iter([]))
+                self.assertEqual(results, [])
+                self.assertEqual(broadcast_jobs.job_status(job_id)['status'], 'abandoned')
+                self.assertIsNone(broadcast_jobs.run_job(job_id, lambda cursor: iter([])))
+        self.assertEqual(sent_batches, [0])
+
+    def test_batch_is_not_retried_after_max_attempts(self):
+        job_id = broadcast_jobs.create_job('job-3', [TextMessage(text='hello')])
+        sent_batches = []
+        with mock.patch.object(broadcast_jobs, 'broadcast', failing_broadcast(sent_batches)):
+            for _ in range(broadcast_jobs.BATCH_MAX_ATTEMPTS + 2):
+                broadcast_jobs.run_job(job_id, lambda cursor: iter([USER_ID] if not cursor else []))
+        self.assertEqual(len(sent_batches), broadcast_jobs.BATCH_MAX_ATTEMPTS)
+        self.assertEqual(broadcast_jobs.job_status(job_id)['status'], 'abandoned')
+        self.assertEqual(broadcast_jobs.unfinished_jobs(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()